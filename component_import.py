@@ -1,5 +1,110 @@
+import functools
+import hashlib
+import json
+import os
+
 import pvlib
-import numpy as np
+import pandas as pd
+
+from settings import CACHE_DIR
+from pv3_inverter_fitting import sandia_fit_arrays
+
+SAM_CACHE_DIR = os.path.join(CACHE_DIR, 'sam')
+INVERTER_CACHE_DIR = os.path.join(CACHE_DIR, 'inverters')
+
+
+def _cache_key(*values):
+    """Short content hash of JSON-serialisable values, used in file names."""
+    content = json.dumps(values, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(content).hexdigest()[:16]
+
+
+def retrieve_sam(name):
+    """
+    Load a SAM component table once per process
+
+    The parsed table is stored as pickle file in `SAM_CACHE_DIR`, so later
+    processes skip parsing the SAM CSV file. The cache file is keyed on the
+    table name, the pvlib version, which ships the CSV files, and the pandas
+    version, which writes the pickle file.
+    The returned DataFrame is shared, use `.copy()` before modifying it.
+
+    :param name: name of the SAM table, see `pvlib.pvsystem.retrieve_sam`
+    :return:
+    DataFrame with one column per component
+    """
+    # normalise before the lookup, 'CECMod' and 'cecmod' share one entry
+    return _retrieve_sam_cached(name.lower())
+
+
+@functools.lru_cache(maxsize=None)
+def _retrieve_sam_cached(name):
+    """Load a SAM component table by its lower case name"""
+    cache_file = os.path.join(
+        SAM_CACHE_DIR,
+        f'{name}_{_cache_key(name, pvlib.__version__, pd.__version__)}.pkl')
+    if os.path.isfile(cache_file):
+        return pd.read_pickle(cache_file)
+
+    sam_data = pvlib.pvsystem.retrieve_sam(name)
+    os.makedirs(SAM_CACHE_DIR, exist_ok=True)
+    # write to temporary file first, parallel workers may read the cache
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+    sam_data.to_pickle(tmp_file)
+    os.replace(tmp_file, cache_file)
+    return sam_data
+
+
+@functools.lru_cache(maxsize=None)
+def _fit_sandia_cached(eta_min, eta_nom, eta_max, dc_voltage, p_dc_nom,
+                       p_ac_0, p_nt):
+    """Fit sandia inverter once per process and efficiency curve input"""
+    cache_file = os.path.join(INVERTER_CACHE_DIR, 'sandia_{}.json'.format(
+        _cache_key(pvlib.__version__, eta_min, eta_nom, eta_max, dc_voltage,
+                   p_dc_nom, p_ac_0, p_nt)))
+    if os.path.isfile(cache_file):
+        with open(cache_file, encoding='utf-8') as file:
+            return json.load(file)
+
+    # ac and dc power at all power points and voltage levels
+    ac_power, dc_power, dc_voltage_values, dc_voltage_level = \
+        sandia_fit_arrays([eta_min, eta_nom, eta_max], dc_voltage, p_dc_nom)
+
+    # call method that creates sandia inverter model
+    inverter = pvlib.inverter.fit_sandia(
+        ac_power, dc_power, dc_voltage_values, dc_voltage_level,
+        p_ac_0, p_nt)
+    inverter = {key: float(value) for key, value in inverter.items()}
+
+    os.makedirs(INVERTER_CACHE_DIR, exist_ok=True)
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as file:
+        json.dump(inverter, file, indent=4)
+    os.replace(tmp_file, cache_file)
+    return inverter
+
+
+def fit_sandia_inverter(eta_min, eta_nom, eta_max, dc_voltage, p_dc_nom,
+                        p_ac_0, p_nt):
+    """
+    Fit a sandia inverter model to efficiencies at min, nom and max voltage
+
+    Fitted parameters are memoized per process and stored in
+    `INVERTER_CACHE_DIR`, keyed on a hash of the efficiency curve inputs.
+
+    :param eta_min: efficiency at P/P_max = 0, 0.2, 0.3, 0.5, 0.75, 1 and min voltage
+    :param eta_nom: efficiency at the same power points and nom voltage
+    :param eta_max: efficiency at the same power points and max voltage
+    :param dc_voltage: dc voltage at min, nom and max
+    :param p_dc_nom: nominal dc power
+    :param p_ac_0: maximum ac power
+    :param p_nt: power consumed while inverter is not delivering AC power
+    :return:
+    inverter dictionary, type: sandia model
+    """
+    return dict(_fit_sandia_cached(tuple(eta_min), tuple(eta_nom),
+                                   tuple(eta_max), tuple(dc_voltage),
+                                   p_dc_nom, p_ac_0, p_nt))
 
 
 def get_sma_sb_3000hf():
@@ -14,37 +119,10 @@ def get_sma_sb_3000hf():
     eta_nom = [0, 0.953, 0.961, 0.963, 0.96, 0.954]  # P/P_max = 0, 0.2, 0.3, 0.5, 0.75, 1; U = 530V
     eta_max = [0, 0.951, 0.959, 0.96, 0.96, 0.955]  # P/P_max = 0, 0.2, 0.3, 0.5, 0.75, 1; U = 560V
     # dc voltage at min, nom and max
-    dc_voltage = [[210.], [530.], [560.]]
-    # calculate dc power
-    p_dc_nom = 3150
-    p_dc = [0, 0.2 * p_dc_nom, 0.3 * p_dc_nom, 0.5 * p_dc_nom, 0.75 * p_dc_nom, 1 * p_dc_nom]
-    p_ac_min = []
-    p_ac_nom = []
-    p_ac_max = []
-    val_count = len(eta_min)
-
-    # calculate ac power
-    for i in range(val_count):
-        p_ac_min.append(p_dc[i] * eta_min[i])
-        p_ac_nom.append(p_dc[i] * eta_nom[i])
-        p_ac_max.append(p_dc[i] * eta_max[i])
-
-    ac_power = np.array(p_ac_min + p_ac_nom + p_ac_max)
-
-    # save all necessary inverter data to a dictionary
-    sma_sb_data = {
-        "ac_power": ac_power,
-        "dc_power": np.array(p_dc + p_dc + p_dc),  # Annahme: Strom bleibt in allen Punkten gleich
-        "dc_voltage": np.array(dc_voltage[0] * val_count + dc_voltage[1] * val_count + dc_voltage[2] * val_count),
-        "dc_voltage_level": np.array(["Vmin"] * val_count + ["Vnom"] * val_count + ["Vmax"] * val_count),
-        "p_ac_0": 3000.,
-        "p_nt": 1.
-    }
+    dc_voltage = [210., 530., 560.]
 
-    # call method that creates sandia inverter model
-    inverter = pvlib.inverter.fit_sandia(sma_sb_data["ac_power"], sma_sb_data["dc_power"], sma_sb_data["dc_voltage"],
-                                         sma_sb_data["dc_voltage_level"], sma_sb_data["p_ac_0"], sma_sb_data["p_nt"])
-    return inverter
+    return fit_sandia_inverter(eta_min, eta_nom, eta_max, dc_voltage,
+                               p_dc_nom=3150, p_ac_0=3000., p_nt=1.)
 
 
 def get_danfoss_dlx_2_9():
@@ -59,42 +137,16 @@ def get_danfoss_dlx_2_9():
     eta_nom = [0, 0.961, 0.967, 0.971, 0.969, 0.967]  # P/P_max = 0, 0.2, 0.3, 0.5, 0.75, 1; U = 530V
     eta_max = [0, 0.952, 0.958, 0.962, 0.96, 0.958]  # P/P_max = 0, 0.2, 0.3, 0.5, 0.75, 1; U = 560V
     # dc voltage at min, nom and max
-    dc_voltage = [[230.], [350.], [480.]]
-    # calculate dc power
-    p_dc_nom = 3750
-    p_dc = [0, 0.2 * p_dc_nom, 0.3 * p_dc_nom, 0.5 * p_dc_nom, 0.75 * p_dc_nom, 1 * p_dc_nom]
-    p_ac_min = []
-    p_ac_nom = []
-    p_ac_max = []
-    val_count = len(eta_min)
-
-    # calculate ac power
-    for i in range(val_count):
-        p_ac_min.append(p_dc[i] * eta_min[i])
-        p_ac_nom.append(p_dc[i] * eta_nom[i])
-        p_ac_max.append(p_dc[i] * eta_max[i])
-
-    ac_power = np.array(p_ac_min + p_ac_nom + p_ac_max)
-
-    # save all necessary inverter data to a dictionary
-    sma_sb_data = {
-        "ac_power": ac_power,
-        "dc_power": np.array(p_dc + p_dc + p_dc),  # Annahme: Strom bleibt in allen Punkten gleich
-        "dc_voltage": np.array(dc_voltage[0] * val_count + dc_voltage[1] * val_count + dc_voltage[2] * val_count),
-        "dc_voltage_level": np.array(["Vmin"] * val_count + ["Vnom"] * val_count + ["Vmax"] * val_count),
-        "p_ac_0": 2900.,
-        "p_nt": 1.  # power consumed while inverter is not delivering AC power
-    }
+    dc_voltage = [230., 350., 480.]
 
-    # call method that creates sandia inverter model
-    inverter = pvlib.inverter.fit_sandia(sma_sb_data["ac_power"], sma_sb_data["dc_power"], sma_sb_data["dc_voltage"],
-                                         sma_sb_data["dc_voltage_level"], sma_sb_data["p_ac_0"], sma_sb_data["p_nt"])
-    return inverter
+    # p_nt: power consumed while inverter is not delivering AC power
+    return fit_sandia_inverter(eta_min, eta_nom, eta_max, dc_voltage,
+                               p_dc_nom=3750, p_ac_0=2900., p_nt=1.)
 
 
 def get_aleo_s18_240():
     """Import Aleo S18 240 W PV-Modul"""
-    sam_cec_mod = pvlib.pvsystem.retrieve_sam('CECMod')
+    sam_cec_mod = retrieve_sam('CECMod')
     aleo_s18_240 = sam_cec_mod['Aleo_Solar_S18y250'].copy()
     aleo_s18_240['STC'] = 240.
     aleo_s18_240['PTC'] = 215.04
@@ -113,7 +165,7 @@ def get_aleo_s18_240():
     # adding the specific Modul parameters for aleo_s19_245
 def get_aleo_s19_245():
     """Import Aleo S19 245 W PV-Modul"""
-    sam_cec_mod = pvlib.pvsystem.retrieve_sam('CECMod')
+    sam_cec_mod = retrieve_sam('CECMod')
     aleo_s19_245 = sam_cec_mod['Aleo_Solar_S19Y270'].copy()
     aleo_s19_245['STC'] = 245.
     aleo_s19_245['PTC'] = 220.
@@ -132,7 +184,7 @@ def get_aleo_s19_245():
     # adding data for aleo_s19_285, even though the module is in the CEC-Database
 def get_aleo_s19_285():
     """Import Aleo S19 285 W PV-Modul"""
-    sam_cec_mod = pvlib.pvsystem.retrieve_sam('CECMod')
+    sam_cec_mod = retrieve_sam('CECMod')
     aleo_s19_285 = sam_cec_mod['Aleo_Solar_S19y285'].copy()
     aleo_s19_285['STC'] = 285.
     aleo_s19_285['PTC'] = 261.25
@@ -150,7 +202,7 @@ def get_aleo_s19_285():
 
 def get_schott_asi_105():
     """Import Schott a-Si 105 W PV-Modul"""
-    sam_cec_mod = pvlib.pvsystem.retrieve_sam('CECMod')
+    sam_cec_mod = retrieve_sam('CECMod')
     schott = sam_cec_mod['Bosch_Solar_Thin_Film_um_Si_plus_105'].copy()
     schott['I_sc_ref'] = 3.98
     schott['V_oc_ref'] = 41.0
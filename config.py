@@ -21,6 +21,7 @@ import configparser as cp
 """parameter"""
 cfg = cp.RawConfigParser()
 config_file = 'config.ini'
+_loaded = False
 
 # Datenbankzugriffe, Host, Port, User, Passwort, ...
 def config_section_set(config_section, host, port, user, pw):
@@ -97,6 +98,27 @@ def config_file_get(config_section, port):
             except:
                 return cfg.get(config_section, port)
 
+# Alle Einträge einer Section als Strings auslesen
+def config_section_get(config_section):
+    """Read all entries of a section without type conversion.
+
+    Parameters
+    ----------
+    config_section : str
+        Section in config file.
+
+    Returns
+    -------
+    dict
+        Entries of the section, empty if file or section do not exist.
+    """
+
+    if not _loaded and os.path.isfile(config_file):
+        config_file_init()
+    if not cfg.has_section(config_section):
+        return {}
+    return dict(cfg.items(config_section))
+
 # Ausagebemessage, wenn file nicht gefunden wurde
 def config_file_not_found_message():
     """Show error message if file not found."""
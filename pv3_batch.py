@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+HTW-PV3 - Vectorized model for many PV systems
+
+Evaluates PVSystems at one location in a single array pass
+(systems x timesteps). Transposition is calculated once per orientation,
+cell temperature, single diode DC and sandia AC power for all systems at
+once. Equivalent to `setup_modelchain` (no AOI and spectral losses, CEC
+modules, sandia inverters, SAPM cell temperature).
+
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+__copyright__ = "© Ludwig Hülk"
+__license__ = "GNU Affero General Public License Version 3 (AGPL-3.0)"
+__url__ = "https://www.gnu.org/licenses/agpl-3.0.en.html"
+__author__ = "Ludee;"
+__version__ = "v0.0.2"
+
+import numpy as np
+import pandas as pd
+import pvlib
+
+from pv3_cache import get_location_solarposition
+from pv3_surrogate import CEC_PARAMETERS, DIODE_TABLE_COLUMNS, \
+    get_diode_table
+
+import logging
+log = logging.getLogger(__name__)
+
+SANDIA_INVERTER_PARAMETERS = ['Paco', 'Pdco', 'Vdco', 'Pso',
+                              'C0', 'C1', 'C2', 'C3', 'Pnt']
+SAPM_TEMPERATURE_PARAMETERS = ['a', 'b', 'deltaT']
+RESULT_COLUMNS = ['poa_global', 'effective_irradiance', 'cell_temperature',
+                  'i_sc', 'v_oc', 'i_mp', 'v_mp', 'p_mp', 'ac']
+
+
+def stack_parameters(parameter_dicts, parameters, name):
+    """
+    Stacks parameters of many systems into column vectors.
+
+    Parameters
+    ----------
+    parameter_dicts : :obj:`list`
+        Module, inverter or temperature model parameters per system.
+    parameters : :obj:`list` or :obj:`dict`
+        Names of the parameters to stack. If a dictionary, its values are
+        used as defaults (None: required).
+    name : :obj:`str`
+        Name of the parameter set, used in error messages.
+
+    Returns
+    -------
+    :obj:`dict`
+        Parameter names as keys and arrays of shape (systems, 1) as values.
+
+    """
+    if not isinstance(parameters, dict):
+        parameters = dict.fromkeys(parameters)
+    stacked = {}
+    for parameter, default in parameters.items():
+        values = []
+        for parameter_dict in parameter_dicts:
+            value = parameter_dict.get(parameter, default)
+            if value is None:
+                raise ValueError(f'{name} parameter {parameter} is missing')
+            values.append(value)
+        stacked[parameter] = np.array(values, dtype=float)[:, np.newaxis]
+    return stacked
+
+
+def get_array(pv_system):
+    """
+    Returns the only :pvlib:`Array` of a PVSystem.
+
+    pvlib before 0.9 has no arrays, the PVSystem itself is returned. Newer
+    pvlib versions keep orientation, module and string layout on the
+    arrays only.
+    """
+    arrays = getattr(pv_system, 'arrays', None)
+    if arrays is None:
+        return pv_system
+    if len(arrays) != 1:
+        raise ValueError(f'PVSystem {pv_system.name} has {len(arrays)} '
+                         f'arrays, only one is supported')
+    return arrays[0]
+
+
+def get_orientation(pv_system):
+    """Returns (surface_tilt, surface_azimuth, albedo) of a PVSystem."""
+    array = get_array(pv_system)
+    # pvlib 0.9 moved the orientation to the mount of the array
+    mount = getattr(array, 'mount', array)
+    return mount.surface_tilt, mount.surface_azimuth, array.albedo
+
+
+def get_string_layout(pv_system):
+    """Returns (modules_per_string, strings_per_inverter) of a PVSystem."""
+    array = get_array(pv_system)
+    if array is pv_system:
+        return pv_system.modules_per_string, pv_system.strings_per_inverter
+    return array.modules_per_string, array.strings
+
+
+def calculate_poa_irradiance(pv_systems, solar_position, weather, airmass,
+                             transposition_model='haydavies'):
+    """
+    Calculates plane of array irradiance once per unique orientation.
+
+    Parameters
+    ----------
+    pv_systems : :obj:`list`
+        List of :pvlib:`PVSystem`.
+    solar_position : :pandas:`DataFrame`
+    weather : :pandas:`DataFrame`
+        Weather data with 'ghi', 'dhi' and 'dni'.
+    airmass : :pandas:`Series`
+        Relative airmass.
+    transposition_model : :obj:`str`
+        Default: 'haydavies'.
+
+    Returns
+    -------
+    :obj:`dict`
+        'poa_global', 'poa_direct' and 'poa_diffuse' as arrays of shape
+        (systems, timesteps).
+
+    """
+    orientations = [get_orientation(pv_system) for pv_system in pv_systems]
+    dni_extra = pvlib.irradiance.get_extra_radiation(weather.index)
+
+    poa = {key: np.empty((len(pv_systems), len(weather)))
+           for key in ['poa_global', 'poa_direct', 'poa_diffuse']}
+    for orientation in dict.fromkeys(orientations):
+        surface_tilt, surface_azimuth, albedo = orientation
+        total_irrad = pvlib.irradiance.get_total_irradiance(
+            surface_tilt, surface_azimuth,
+            solar_position['apparent_zenith'], solar_position['azimuth'],
+            weather['dni'], weather['ghi'], weather['dhi'],
+            dni_extra=dni_extra, airmass=airmass, albedo=albedo,
+            model=transposition_model)
+        rows = [idx for idx, system_orientation in enumerate(orientations)
+                if system_orientation == orientation]
+        for key in poa:
+            poa[key][rows] = total_irrad[key].values
+    log.info(f'Transposition for {len(pv_systems)} systems in '
+             f'{len(set(orientations))} orientations')
+    return poa
+
+
+def sandia_inverter(v_dc, p_dc, inverters):
+    """
+    Sandia inverter model like `pvlib.inverter.sandia`, with inverter
+    parameters given as arrays of shape (systems, 1).
+    """
+    Paco = inverters['Paco']
+    Pdco = inverters['Pdco']
+    Vdco = inverters['Vdco']
+    Pso = inverters['Pso']
+    C0 = inverters['C0']
+    C1 = inverters['C1']
+    C2 = inverters['C2']
+    C3 = inverters['C3']
+    Pnt = inverters['Pnt']
+
+    A = Pdco * (1 + C1 * (v_dc - Vdco))
+    B = Pso * (1 + C2 * (v_dc - Vdco))
+    C = C0 * (1 + C3 * (v_dc - Vdco))
+    power_ac = (Paco / (A - B) - C * (A - B)) * (p_dc - B) + C * (p_dc - B)**2
+
+    # limit to maximum power and apply night tare below start power
+    power_ac = np.minimum(Paco, power_ac)
+    return np.where(p_dc < Pso, -1.0 * np.abs(Pnt), power_ac)
+
+
+def _surrogate_dc(pv_systems, effective_irradiance, cell_temperature,
+                  grid=None):
+    """
+    Returns the DC output of one module per system from the diode tables
+    of `pv3_surrogate`, one table per distinct module.
+    """
+    irradiance, temperature = (None, None) if grid is None else grid
+    groups = {}
+    for row, pv_system in enumerate(pv_systems):
+        table = get_diode_table(get_array(pv_system).module_parameters,
+                                irradiance=irradiance,
+                                temperature=temperature)
+        groups.setdefault(id(table), (table, []))[1].append(row)
+    dc = {key: np.empty(effective_irradiance.shape)
+          for key in DIODE_TABLE_COLUMNS}
+    for table, rows in groups.values():
+        values = table.interpolate(effective_irradiance[rows],
+                                   cell_temperature[rows])
+        for key in dc:
+            dc[key][rows] = values[key]
+    return dc
+
+
+def calculate_dc_ac(pv_systems, poa, weather, surrogate_dc=False,
+                    surrogate_grid=None):
+    """
+    Calculates cell temperature, DC and AC power for all systems at once.
+
+    Parameters
+    ----------
+    pv_systems : :obj:`list`
+        List of :pvlib:`PVSystem` with CEC modules, sandia inverters and
+        SAPM temperature model parameters.
+    poa : :obj:`dict`
+        Plane of array irradiance, see `calculate_poa_irradiance`.
+    weather : :pandas:`DataFrame`
+        Weather data with 'temp_air' and 'wind_speed'.
+    surrogate_dc : :obj:`bool`
+        If True, DC output is interpolated in the diode tables of
+        `pv3_surrogate` instead of solving the single diode equation.
+        Default: False.
+    surrogate_grid : :obj:`tuple`, optional
+        (irradiance, temperature) grid of the diode tables, see
+        `pv3_surrogate.DiodeTable.from_module`. Default: None (grids of
+        `pv3_surrogate`).
+
+    Returns
+    -------
+    :obj:`dict`
+        Arrays of shape (systems, timesteps) for all `RESULT_COLUMNS`.
+
+    """
+    arrays = [get_array(pv_system) for pv_system in pv_systems]
+    modules = stack_parameters(
+        [array.module_parameters for array in arrays],
+        CEC_PARAMETERS, 'CEC module')
+    inverters = stack_parameters(
+        [pv_system.inverter_parameters for pv_system in pv_systems],
+        SANDIA_INVERTER_PARAMETERS, 'Sandia inverter')
+    temperature_models = stack_parameters(
+        [array.temperature_model_parameters for array in arrays],
+        SAPM_TEMPERATURE_PARAMETERS, 'SAPM temperature model')
+    fd = stack_parameters(
+        [array.module_parameters for array in arrays],
+        {'FD': 1.}, 'module')['FD']
+    layouts = stack_parameters(
+        [dict(zip(['modules_per_string', 'strings_per_inverter'],
+                  get_string_layout(pv_system)))
+         for pv_system in pv_systems],
+        ['modules_per_string', 'strings_per_inverter'], 'PVSystem')
+    modules_per_string = layouts['modules_per_string']
+    strings_per_inverter = layouts['strings_per_inverter']
+
+    # no AOI and spectral losses
+    effective_irradiance = poa['poa_direct'] + fd * poa['poa_diffuse']
+
+    cell_temperature = pvlib.temperature.sapm_cell(
+        poa['poa_global'], weather['temp_air'].values,
+        weather['wind_speed'].values, **temperature_models)
+
+    if surrogate_dc:
+        dc = _surrogate_dc(pv_systems, effective_irradiance,
+                           cell_temperature, grid=surrogate_grid)
+    else:
+        # the single diode equation is solved for lit timesteps only,
+        # without irradiance the ModelChain returns zero (or nan replaced by
+        # zero)
+        lit = effective_irradiance > 0
+        diode_params = pvlib.pvsystem.calcparams_cec(
+            effective_irradiance[lit], cell_temperature[lit],
+            **{parameter: np.broadcast_to(values, lit.shape)[lit]
+               for parameter, values in modules.items()})
+        solved = pvlib.pvsystem.singlediode(*diode_params)
+        dc = {}
+        for key in DIODE_TABLE_COLUMNS:
+            dc[key] = np.zeros(lit.shape)
+            dc[key][lit] = solved[key]
+
+    # scale to string layout and replace nan like the ModelChain does
+    voltage = modules_per_string
+    current = strings_per_inverter
+    result = {}
+    for key, scale in [('v_oc', voltage), ('v_mp', voltage),
+                       ('i_mp', current), ('i_sc', current),
+                       ('p_mp', voltage * current)]:
+        values = dc[key] * scale
+        values[np.isnan(values)] = 0
+        result[key] = values
+
+    result['ac'] = sandia_inverter(result['v_mp'], result['p_mp'], inverters)
+    result['poa_global'] = poa['poa_global']
+    result['effective_irradiance'] = effective_irradiance
+    result['cell_temperature'] = cell_temperature
+    return result
+
+
+def batch_model_arrays(pv_systems, location, weather,
+                       transposition_model='haydavies',
+                       airmass_model='kastenyoung1989', surrogate_dc=False,
+                       surrogate_grid=None):
+    """
+    Runs the model for many PVSystems at one location in one array pass.
+
+    See `run_batch_model` for the parameters.
+
+    Returns
+    -------
+    :obj:`dict`
+        Arrays of shape (systems, timesteps) for all `RESULT_COLUMNS`.
+
+    """
+    weather = weather.copy()
+    if 'wind_speed' not in weather:
+        weather['wind_speed'] = 0
+    if 'temp_air' not in weather:
+        weather['temp_air'] = 20
+
+    solar_position = get_location_solarposition(
+        location, weather.index, pressure=weather.get('pressure'),
+        temperature=weather['temp_air'])
+    airmass = location.get_airmass(solar_position=solar_position,
+                                   model=airmass_model)
+
+    poa = calculate_poa_irradiance(
+        pv_systems, solar_position, weather, airmass['airmass_relative'],
+        transposition_model=transposition_model)
+    return calculate_dc_ac(pv_systems, poa, weather,
+                           surrogate_dc=surrogate_dc,
+                           surrogate_grid=surrogate_grid)
+
+
+def run_batch_model(pv_systems, location, weather,
+                    transposition_model='haydavies',
+                    airmass_model='kastenyoung1989', surrogate_dc=False,
+                    surrogate_grid=None):
+    """
+    Runs the model for many PVSystems at one location in one array pass.
+
+    Parameters
+    ----------
+    pv_systems : :obj:`list`
+        List of :pvlib:`PVSystem` with CEC modules, sandia inverters and
+        SAPM temperature model parameters.
+    location : :pvlib:`Location`
+    weather : :pandas:`DataFrame`
+        Weather data with 'ghi', 'dhi', 'dni', 'temp_air' and 'wind_speed'
+        (optionally 'pressure').
+    transposition_model : :obj:`str`
+        Default: 'haydavies'.
+    airmass_model : :obj:`str`
+        Default: 'kastenyoung1989'.
+    surrogate_dc : :obj:`bool`
+        If True, DC output is interpolated in the diode tables of
+        `pv3_surrogate`, see `calculate_dc_ac`. Default: False.
+    surrogate_grid : :obj:`tuple`, optional
+        Grid of the diode tables, see `calculate_dc_ac`. Default: None.
+
+    Returns
+    -------
+    :pandas:`DataFrame`
+        Tidy DataFrame with columns 'system', 'timestamp' and
+        `RESULT_COLUMNS`, one row per system and timestep.
+
+    """
+    result = batch_model_arrays(pv_systems, location, weather,
+                                transposition_model=transposition_model,
+                                airmass_model=airmass_model,
+                                surrogate_dc=surrogate_dc,
+                                surrogate_grid=surrogate_grid)
+
+    df = pd.DataFrame(
+        {key: result[key].ravel() for key in RESULT_COLUMNS})
+    df.insert(0, 'timestamp', weather.index[
+        np.tile(np.arange(len(weather)), len(pv_systems))])
+    df.insert(0, 'system', np.repeat(
+        [pv_system.name for pv_system in pv_systems], len(weather)))
+    return df
@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+HTW-PV3 - Benchmark of the pvlib model pipeline
+
+Generate synthetic weather data (1 to 20 years, 1-min to hourly);
+Time each stage of the pipeline and track its peak memory;
+Append results to a JSON lines history to compare versions;
+
+Usage: python pv3_benchmark.py --years 1 --freq 1min --repeat 3
+
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+__copyright__ = "© Ludwig Hülk"
+__license__ = "GNU Affero General Public License Version 3 (AGPL-3.0)"
+__url__ = "https://www.gnu.org/licenses/agpl-3.0.en.html"
+__author__ = "Ludee;"
+__version__ = "v0.0.2"
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pvlib
+
+from settings import setup_logger, HTW_LAT, HTW_LON
+from pv3_cache import solar_position_cache
+from pv3_decomposition import unix_seconds
+from pv3_weatherdata import calculate_diffuse_irradiation, \
+    setup_htw_pvlib_weather
+from pv3_sonnja_pvlib import setup_pvlib_location_object, setup_modelchain, \
+    run_modelchain, setup_htw_pvsystem_wr1, setup_htw_pvsystem_wr2, \
+    setup_htw_pvsystem_wr3, setup_htw_pvsystem_wr4, setup_htw_pvsystem_wr5
+from pv3_results import results_modelchain, results_modelchain_per_month, \
+    results_modelchain_annual_yield
+
+import logging
+log = logging.getLogger(__name__)
+
+BENCHMARK_HISTORY = os.path.join('data', 'benchmark', 'history.jsonl')
+
+# benchmark cases as (years, frequency)
+BENCHMARK_CASES = {'1y_60min': (1, 'h'),
+                   '1y_1min': (1, '1min'),
+                   '20y_60min': (20, 'h'),
+                   '20y_1min': (20, '1min')}
+
+
+class NullSink:
+    """Result sink that discards all results, to time without disk access."""
+
+    def write(self, table, df, weather, system_name, append=True):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def synthetic_ghi(index, seed=0):
+    """
+    Synthetic global horizontal irradiance at the HTW location.
+
+    Clear sky irradiance from a simple solar geometry, reduced by random
+    cloud cover that changes every hour.
+
+    Parameters
+    ----------
+    index : :pandas:`DatetimeIndex`
+        Timezone aware time index.
+    seed : :obj:`int`
+        Seed of the random number generator. Default: 0.
+
+    Returns
+    -------
+    :numpy:`array`
+        GHI in W/m².
+
+    """
+    rng = np.random.default_rng(seed)
+    index_utc = index.tz_convert('UTC')
+    doy = index_utc.dayofyear.values
+    hour = (index_utc.hour.values + index_utc.minute.values / 60
+            + HTW_LON / 15)
+    declination = np.radians(23.45) * np.sin(2 * np.pi * (284 + doy) / 365)
+    hour_angle = np.radians(15 * (hour - 12))
+    lat = np.radians(HTW_LAT)
+    sin_elevation = (np.sin(lat) * np.sin(declination) +
+                     np.cos(lat) * np.cos(declination) * np.cos(hour_angle))
+    clear_sky = 1100 * np.clip(sin_elevation, 0, None) ** 1.15
+
+    hours = (unix_seconds(index_utc) // 3600).astype(np.int64)
+    hours = hours - hours[0]
+    cloud_cover = rng.uniform(0.2, 1, hours[-1] + 1)[hours]
+    return clear_sky * cloud_cover
+
+
+def synthetic_htw_weather(years=1, freq='h', start='2015-01-01', seed=0):
+    """
+    Synthetic raw weather data like pv3.pv3_weather_2015_filled_mview.
+
+    Parameters
+    ----------
+    years : :obj:`int`
+        Number of years. Default: 1.
+    freq : :obj:`str`
+        Time resolution, e.g. '1min' or 'h'. Default: 'h'.
+    start : :obj:`str`
+        First timestamp. Default: '2015-01-01'.
+    seed : :obj:`int`
+        Seed of the random number generator. Default: 0.
+
+    Returns
+    -------
+    :pandas:`DataFrame`
+        Columns 'g_hor_si', 'v_wind' and 't_luft'.
+
+    """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(start, tz='Europe/Berlin')
+    index = pd.date_range(start, start + pd.DateOffset(years=years),
+                          freq=freq, name='timestamp')[:-1]
+    doy = index.dayofyear.values
+    t_luft = (10 - 10 * np.cos(2 * np.pi * (doy - 20) / 365)
+              + rng.normal(0, 2, len(index)))
+    return pd.DataFrame({'g_hor_si': synthetic_ghi(index, seed=seed),
+                         'v_wind': rng.gamma(2, 1.5, len(index)),
+                         't_luft': t_luft}, index=index)
+
+
+def synthetic_merra_weather(years=1, freq='h', start='2015-01-01', seed=0):
+    """
+    Synthetic weather data for the decomposition models.
+
+    Parameters
+    ----------
+    years : :obj:`int`
+        Number of years. Default: 1.
+    freq : :obj:`str`
+        Time resolution. Default: 'h'.
+    start : :obj:`str`
+        First timestamp. Default: '2015-01-01'.
+    seed : :obj:`int`
+        Seed of the random number generator. Default: 0.
+
+    Returns
+    -------
+    :pandas:`DataFrame`
+        Columns 'ghi', 'i0_h', 'pressure' and 'temp_air'.
+
+    """
+    df_htw = synthetic_htw_weather(years, freq, start=start, seed=seed)
+    i0_h = (pvlib.irradiance.get_extra_radiation(df_htw.index).values *
+            np.clip(df_htw['g_hor_si'].values / 1100, 0, 1))
+    return pd.DataFrame({'ghi': df_htw['g_hor_si'].values,
+                         'i0_h': np.maximum(i0_h, df_htw['g_hor_si'].values),
+                         'pressure': 101325.,
+                         'temp_air': df_htw['t_luft'].values},
+                        index=df_htw.index)
+
+
+def measure(func, *args, repeat=1, memory=True, **kwargs):
+    """
+    Measures run time and peak memory of `func`.
+
+    The run time is the minimum of `repeat` runs. The peak memory is
+    measured with `tracemalloc` in one additional run, as tracing slows
+    down the calculation.
+
+    Returns
+    -------
+    :obj:`tuple`
+        (result of `func`, run time in s, peak memory in MB or None)
+
+    """
+    seconds = []
+    for _ in range(repeat):
+        solar_position_cache.memory.clear()
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds.append(time.perf_counter() - start)
+
+    peak = None
+    if memory:
+        solar_position_cache.memory.clear()
+        tracemalloc.start()
+        try:
+            func(*args, **kwargs)
+            peak = tracemalloc.get_traced_memory()[1] / 1e6
+        finally:
+            tracemalloc.stop()
+
+    return result, min(seconds), peak
+
+
+def run_benchmark(years=1, freq='h', repeat=1, memory=True, seed=0):
+    """
+    Times all stages of the pipeline on synthetic weather data.
+
+    Stages of `pv3_pvlib_sonnja` (decomposition models) are skipped if the
+    module cannot be imported.
+
+    Parameters
+    ----------
+    years : :obj:`int`
+        Number of years. Default: 1.
+    freq : :obj:`str`
+        Time resolution of the raw weather data. Default: 'h'.
+    repeat : :obj:`int`
+        Number of timed runs per stage. Default: 1.
+    memory : :obj:`bool`
+        If True, measure the peak memory of each stage. Default: True.
+    seed : :obj:`int`
+        Seed of the random number generator. Default: 0.
+
+    Returns
+    -------
+    :pandas:`DataFrame`
+        One row per stage with 'rows', 'seconds' and 'peak_mb'.
+
+    """
+    records = []
+
+    def record(stage, rows, func, *args, **kwargs):
+        result, seconds, peak = measure(func, *args, repeat=repeat,
+                                        memory=memory, **kwargs)
+        records.append({'stage': stage, 'rows': rows, 'seconds': seconds,
+                        'peak_mb': peak})
+        log.info(f'Benchmark {stage}: {seconds:.3f} s')
+        return result
+
+    df_raw = synthetic_htw_weather(years, freq, seed=seed)
+    rows = len(df_raw)
+    log.info(f'Benchmark {years} years with frequency {freq}: {rows} rows')
+
+    location = setup_pvlib_location_object()
+    pv_systems = record('setup_htw_pvsystems', 5, lambda: [
+        setup_htw_pvsystem_wr1(), setup_htw_pvsystem_wr2(),
+        setup_htw_pvsystem_wr3(), setup_htw_pvsystem_wr4(),
+        setup_htw_pvsystem_wr5()])
+
+    record('calculate_diffuse_irradiation', rows,
+           calculate_diffuse_irradiation, df_raw, 'g_hor_si',
+           HTW_LAT, HTW_LON)
+    weather = record('setup_htw_pvlib_weather', rows,
+                     setup_htw_pvlib_weather, df_raw, resample_rule=freq)
+
+    mcs = record('run_modelchain', len(weather) * len(pv_systems),
+                 lambda: [run_modelchain(setup_modelchain(pv_system,
+                                                          location), weather)
+                          for pv_system in pv_systems])
+
+    sink = NullSink()
+    dfs = record('results_modelchain', len(weather) * len(mcs),
+                 lambda: [results_modelchain(mc, 'synthetic', sink=sink)
+                          for mc in mcs])
+    record('results_modelchain_per_month', len(weather) * len(mcs),
+           lambda: [results_modelchain_per_month(mc, df, 'synthetic',
+                                                 sink=sink)
+                    for mc, df in zip(mcs, dfs)])
+    record('results_modelchain_annual_yield', len(weather) * len(mcs),
+           lambda: [results_modelchain_annual_yield(mc, 'synthetic',
+                                                    sink=sink)
+                    for mc in mcs])
+
+    try:
+        from pv3_pvlib_sonnja import reindl, apply_decomposition_model
+    except ImportError as e:
+        log.warning(f'Skip decomposition benchmarks: {e}')
+    else:
+        df_merra = synthetic_merra_weather(years, freq, seed=seed)
+        solar_position = solar_position_cache.get(
+            df_merra.index, location.latitude, location.longitude,
+            altitude=location.altitude)
+        record('reindl', rows, reindl, df_merra['ghi'], df_merra['i0_h'],
+               solar_position['elevation'])
+        for model in ['reindl', 'erbs', 'disc']:
+            record(f'apply_decomposition_model_{model}', rows,
+                   apply_decomposition_model, df_merra, model, location)
+
+    df = pd.DataFrame(records)
+    df.insert(0, 'freq', freq)
+    df.insert(0, 'years', years)
+    return df
+
+
+def git_revision():
+    """Returns the short hash of the current git commit or None."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))
+                              ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def append_history(df, file_name=BENCHMARK_HISTORY):
+    """
+    Appends benchmark results to the JSON lines history.
+
+    Every line holds one stage together with the git revision, versions of
+    python, pandas and pvlib and the time of the run.
+    """
+    run = {'time': datetime.datetime.now().isoformat(timespec='seconds'),
+           'revision': git_revision() or __version__,
+           'version': __version__,
+           'python': platform.python_version(),
+           'pandas': pd.__version__,
+           'pvlib': pvlib.__version__,
+           'machine': platform.node()}
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(file_name, 'a') as f:
+        for record in df.to_dict(orient='records'):
+            f.write(json.dumps({**run, **record}) + '\n')
+    log.info(f'Write {len(df)} benchmark results to file: {file_name}')
+
+
+def read_history(file_name=BENCHMARK_HISTORY):
+    """Reads the benchmark history to a :pandas:`DataFrame`."""
+    return pd.read_json(file_name, lines=True)
+
+
+def compare_history(df_history, baseline=None, revision=None):
+    """
+    Compares the run times of two revisions.
+
+    Parameters
+    ----------
+    df_history : :pandas:`DataFrame`
+        History, see `read_history`.
+    baseline : :obj:`str`, optional
+        Revision to compare with. Default: None (second to last revision).
+    revision : :obj:`str`, optional
+        Revision to check. Default: None (last revision).
+
+    Returns
+    -------
+    :pandas:`DataFrame`
+        Minimum run time per case and stage of both revisions and the ratio
+        revision / baseline (> 1 is a regression).
+
+    """
+    revisions = list(dict.fromkeys(df_history['revision']))
+    revision = revision or revisions[-1]
+    if baseline is None:
+        if len(revisions) < 2:
+            raise ValueError('History contains only one revision')
+        baseline = revisions[-2]
+
+    df = (df_history[df_history['revision'].isin([baseline, revision])]
+          .groupby(['years', 'freq', 'stage', 'revision'])['seconds'].min()
+          .unstack('revision')[[baseline, revision]])
+    df['ratio'] = df[revision] / df[baseline]
+    return df
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--case', choices=list(BENCHMARK_CASES),
+                        action='append',
+                        help='Benchmark case, can be given multiple times')
+    parser.add_argument('--years', type=int, default=1)
+    parser.add_argument('--freq', default='h')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Do not measure the peak memory')
+    parser.add_argument('--history', default=BENCHMARK_HISTORY)
+    args = parser.parse_args()
+
+    log = setup_logger()
+    cases = ([BENCHMARK_CASES[case] for case in args.case] if args.case
+             else [(args.years, args.freq)])
+
+    df_results = pd.concat([run_benchmark(years, freq, repeat=args.repeat,
+                                          memory=not args.no_memory)
+                            for years, freq in cases], ignore_index=True)
+    append_history(df_results, args.history)
+    print(df_results.to_string(index=False))
+
+    df_history = read_history(args.history)
+    if df_history['revision'].nunique() > 1:
+        print(compare_history(df_history).to_string())
@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+HTW-PV3 - Cache functions
+
+Content hashes for pandas and numpy objects;
+Bounded in-memory cache with least recently used eviction;
+Solar position cache shared by decomposition models and ModelChain runs;
+Plane of array irradiance cache shared by systems of the same orientation;
+Run cache that stores ModelChain results of unchanged scenarios;
+
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+__copyright__ = "© Ludwig Hülk"
+__license__ = "GNU Affero General Public License Version 3 (AGPL-3.0)"
+__url__ = "https://www.gnu.org/licenses/agpl-3.0.en.html"
+__author__ = "Ludee;"
+__version__ = "v0.0.2"
+
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import pvlib
+from pvlib.location import Location
+
+from settings import SOLARPOSITION_CACHE_DIR
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def _update_hash(sha, value):
+    """Adds the content of `value` to the hash object `sha`."""
+    if isinstance(value, pd.Index):
+        sha.update(f'index:{value.dtype}:{getattr(value, "tz", None)}:'
+                   f'{len(value)}'.encode('utf-8'))
+        sha.update(pd.util.hash_pandas_object(value).values.tobytes())
+    elif isinstance(value, pd.Series):
+        sha.update(f'series:{value.name}:{value.dtype}'.encode('utf-8'))
+        _update_hash(sha, value.index)
+        sha.update(pd.util.hash_pandas_object(value, index=False)
+                   .values.tobytes())
+    elif isinstance(value, pd.DataFrame):
+        sha.update(f'frame:{list(value.columns)}:{list(value.dtypes)}'
+                   .encode('utf-8'))
+        _update_hash(sha, value.index)
+        sha.update(pd.util.hash_pandas_object(value, index=False)
+                   .values.tobytes())
+    elif isinstance(value, np.ndarray):
+        sha.update(f'array:{value.dtype}:{value.shape}'.encode('utf-8'))
+        sha.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        sha.update(b'dict')
+        for key in sorted(value, key=str):
+            _update_hash(sha, key)
+            _update_hash(sha, value[key])
+    elif isinstance(value, (list, tuple)):
+        sha.update(f'{type(value).__name__}:{len(value)}'.encode('utf-8'))
+        for item in value:
+            _update_hash(sha, item)
+    else:
+        sha.update(f'{type(value).__name__}:{value!r}'.encode('utf-8'))
+
+
+def fingerprint(*values):
+    """
+    Content hash of the given values.
+
+    Parameters
+    ----------
+    values
+        :pandas:`DataFrame`, :pandas:`Series`, :pandas:`Index`,
+        :numpy:`array`, dicts, lists, tuples or scalars.
+
+    Returns
+    -------
+    :obj:`str`
+        Hexadecimal SHA-1 digest.
+
+    """
+    sha = hashlib.sha1()
+    for value in values:
+        _update_hash(sha, value)
+    return sha.hexdigest()
+
+
+def write_pickle(obj, file_name):
+    """
+    Writes `obj` to a pickle file via a temporary file, so that parallel
+    processes never read a partially written cache file.
+    """
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    tmp_file = f'{file_name}.{os.getpid()}.tmp'
+    pd.to_pickle(obj, tmp_file)
+    os.replace(tmp_file, file_name)
+
+
+class LRUCache:
+    """
+    In-memory cache holding at most `maxsize` entries.
+
+    The least recently used entry is evicted first. Hits and misses are
+    counted for diagnostics.
+
+    Parameters
+    ----------
+    maxsize : :obj:`int`
+        Maximum number of entries. Default: 16.
+
+    """
+
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """Returns the cached value for `key` and marks it as recently used."""
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Stores `value` and evicts the least recently used entries."""
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        """Removes all entries and resets the counters."""
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """Returns a dictionary with hits, misses, size and maxsize."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._data), 'maxsize': self.maxsize}
+
+
+class SolarPositionCache:
+    """
+    Cache for `pvlib.solarposition.get_solarposition` results.
+
+    Entries are keyed by latitude, longitude, altitude, pressure,
+    temperature, method and a hash of the time index. Results are kept in
+    an :class:`LRUCache` and optionally stored as pickle files in
+    `directory`, so that other processes and later runs can reuse them.
+    Returned DataFrames are shared and must not be modified.
+
+    Parameters
+    ----------
+    maxsize : :obj:`int`
+        Maximum number of solar position DataFrames kept in memory.
+        Default: 16.
+    directory : :obj:`str`, optional
+        Directory of the on-disk store. Default: None (memory only).
+
+    """
+
+    def __init__(self, maxsize=16, directory=None):
+        self.memory = LRUCache(maxsize)
+        self.directory = directory
+
+    def get(self, times, latitude, longitude, altitude=None, pressure=None,
+            temperature=12, method='nrel_numpy', **kwargs):
+        """
+        Returns the solar position, see
+        `pvlib.solarposition.get_solarposition` for the parameters.
+        """
+        key = fingerprint('solarposition', latitude, longitude, altitude,
+                          pressure, temperature, method, kwargs, times)
+        solar_position = self.memory.get(key)
+        if solar_position is not None:
+            return solar_position
+
+        file_name = None
+        if self.directory:
+            file_name = os.path.join(self.directory, f'{key}.pkl')
+        if file_name and os.path.isfile(file_name):
+            solar_position = pd.read_pickle(file_name)
+        else:
+            solar_position = pvlib.solarposition.get_solarposition(
+                times, latitude, longitude, altitude=altitude,
+                pressure=pressure, method=method, temperature=temperature,
+                **kwargs)
+            if file_name:
+                write_pickle(solar_position, file_name)
+
+        self.memory.put(key, solar_position)
+        return solar_position
+
+
+solar_position_cache = SolarPositionCache(directory=SOLARPOSITION_CACHE_DIR)
+
+
+def get_location_solarposition(location, times, pressure=None,
+                               temperature=12, **kwargs):
+    """
+    Cached equivalent of :pvlib:`Location.get_solarposition`.
+
+    Parameters
+    ----------
+    location : :pvlib:`Location`
+    times : :pandas:`DatetimeIndex`
+    pressure : :obj:`float`, optional
+        Air pressure in Pa. Default: None (calculated from the altitude of
+        the location).
+    temperature : :obj:`float` or :pandas:`Series`
+        Air temperature in °C. Default: 12.
+
+    Returns
+    -------
+    :pandas:`DataFrame`
+        Solar position.
+
+    """
+    if pressure is None:
+        pressure = pvlib.atmosphere.alt2pres(location.altitude)
+    return solar_position_cache.get(
+        times, location.latitude, location.longitude,
+        altitude=location.altitude, pressure=pressure,
+        temperature=temperature, **kwargs)
+
+
+class CachedLocation(Location):
+    """
+    :pvlib:`Location` that serves solar positions from the shared
+    `solar_position_cache`, e.g. to all ModelChains of the same weather data.
+    """
+
+    def get_solarposition(self, times, pressure=None, temperature=12,
+                          **kwargs):
+        return get_location_solarposition(self, times, pressure=pressure,
+                                          temperature=temperature, **kwargs)
+
+
+class PoaCache:
+    """
+    Cache for plane of array irradiance of fixed orientations.
+
+    Entries are keyed by the coordinates of the location, a fingerprint of
+    the weather data, surface tilt, surface azimuth, albedo, transposition
+    model and airmass model, so all PVSystems with the same orientation
+    share one `pvlib.irradiance.get_total_irradiance` result. Inputs are
+    prepared like in `pvlib.modelchain.ModelChain.prepare_inputs`, the
+    results equal `ModelChain.total_irrad`. Returned DataFrames are shared
+    and must not be modified.
+
+    Parameters
+    ----------
+    maxsize : :obj:`int`
+        Maximum number of POA DataFrames kept in memory. Default: 64.
+
+    """
+
+    def __init__(self, maxsize=64):
+        self.memory = LRUCache(maxsize)
+
+    def get(self, location, weather, surface_tilt, surface_azimuth,
+            albedo=0.25, transposition_model='haydavies',
+            airmass_model='kastenyoung1989', weather_fingerprint=None):
+        """
+        Returns the plane of array irradiance of one orientation.
+
+        Parameters
+        ----------
+        location : :pvlib:`Location`
+        weather : :pandas:`DataFrame`
+            Weather data with 'ghi', 'dhi' and 'dni', optionally 'temp_air'
+            and 'pressure'.
+        surface_tilt, surface_azimuth, albedo : :obj:`float`
+        transposition_model : :obj:`str`
+            Default: 'haydavies'.
+        airmass_model : :obj:`str`
+            Default: 'kastenyoung1989'.
+        weather_fingerprint : :obj:`str`, optional
+            `fingerprint` of the weather data, if already known.
+
+        Returns
+        -------
+        :pandas:`DataFrame`
+            'poa_global', 'poa_direct', 'poa_diffuse', 'poa_sky_diffuse' and
+            'poa_ground_diffuse'.
+
+        """
+        if weather_fingerprint is None:
+            weather_fingerprint = fingerprint(weather)
+        key = fingerprint('poa', location.latitude, location.longitude,
+                          location.altitude, weather_fingerprint,
+                          surface_tilt, surface_azimuth, albedo,
+                          transposition_model, airmass_model)
+        poa = self.memory.get(key)
+        if poa is not None:
+            return poa
+
+        solar_position = get_location_solarposition(
+            location, weather.index, pressure=weather.get('pressure'),
+            temperature=weather.get('temp_air', 12))
+        airmass = location.get_airmass(solar_position=solar_position,
+                                       model=airmass_model)
+        poa = pvlib.irradiance.get_total_irradiance(
+            surface_tilt, surface_azimuth,
+            solar_position['apparent_zenith'], solar_position['azimuth'],
+            weather['dni'], weather['ghi'], weather['dhi'],
+            dni_extra=pvlib.irradiance.get_extra_radiation(weather.index),
+            airmass=airmass['airmass_relative'], albedo=albedo,
+            model=transposition_model)
+        self.memory.put(key, poa)
+        return poa
+
+    def info(self):
+        """Returns a dictionary with hits, misses, size and maxsize."""
+        return self.memory.info()
+
+
+poa_cache = PoaCache()
+
+
+def _array_parameters(array):
+    """
+    Returns the model relevant attributes of a :pvlib:`Array`, or of a
+    PVSystem of pvlib before 0.9 which has no arrays.
+    """
+    # pvlib 0.9 moved the orientation to the mount of the array
+    mount = getattr(array, 'mount', array)
+    strings = getattr(array, 'strings', None)
+    if strings is None:
+        strings = getattr(array, 'strings_per_inverter', None)
+    return {'module_parameters': array.module_parameters,
+            'temperature_model_parameters':
+                array.temperature_model_parameters,
+            'surface_tilt': mount.surface_tilt,
+            'surface_azimuth': mount.surface_azimuth,
+            'albedo': array.albedo,
+            'modules_per_string': array.modules_per_string,
+            'strings': strings}
+
+
+def _pv_system_parameters(pv_system):
+    """
+    Returns the model relevant attributes of a :pvlib:`PVSystem` as
+    dictionary, with the module, temperature model, orientation and string
+    layout of every array and the inverter parameters.
+    """
+    arrays = getattr(pv_system, 'arrays', None)
+    if arrays is None:
+        arrays = [pv_system]
+    return {'arrays': [_array_parameters(array) for array in arrays],
+            'inverter_parameters': pv_system.inverter_parameters}
+
+
+class RunCache:
+    """
+    On-disk store of ModelChain runs.
+
+    A run is keyed by a content hash of the PVSystem, the Location, the
+    ModelChain options, the weather data, the pvlib version and `version`.
+    Changing any of these (e.g. one module parameter) changes the key, so
+    only the affected scenarios are recomputed.
+
+    Parameters
+    ----------
+    directory : :obj:`str`
+        Directory of the pickled :pvlib:`ModelChain` objects.
+    version : :obj:`str`
+        Code or data version, e.g. `DATA_VERSION` of `pv3_main.py`.
+
+    """
+
+    def __init__(self, directory, version):
+        self.directory = directory
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, pv_system, location, options, weather_fingerprint):
+        """
+        Returns the key of a scenario.
+
+        Parameters
+        ----------
+        pv_system : :pvlib:`PVSystem`
+        location : :pvlib:`Location`
+        options : :obj:`dict`
+            Keyword arguments of the :pvlib:`ModelChain`.
+        weather_fingerprint : :obj:`str`
+            `fingerprint` of the weather data, calculated once per data set.
+
+        """
+        # the arrays of pvlib 0.9 are hashed by their repr, which omits the
+        # module parameters, so the parameters are added explicitly
+        return fingerprint('modelchain', self.version, pvlib.__version__,
+                           type(pv_system).__name__, vars(pv_system),
+                           _pv_system_parameters(pv_system),
+                           type(location).__name__, vars(location), options,
+                           weather_fingerprint)
+
+    def _file_name(self, key):
+        return os.path.join(self.directory, f'{key}.pkl')
+
+    def get(self, key):
+        """Returns the stored ModelChain of `key` or None."""
+        file_name = self._file_name(key)
+        if not os.path.isfile(file_name):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pd.read_pickle(file_name)
+
+    def put(self, key, mc):
+        """Stores the ModelChain `mc` under `key`."""
+        write_pickle(mc, self._file_name(key))
+
+    def info(self):
+        """Returns a dictionary with hits and misses."""
+        return {'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+HTW-PV3 - Catalogue of PV systems
+
+Read PV systems with module and inverter references, string layout and
+orientation from a YAML file;
+Validate the catalogue once and resolve every component only once;
+Create and cache the PVSystem objects of the catalogue;
+
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+__copyright__ = "© Ludwig Hülk"
+__license__ = "GNU Affero General Public License Version 3 (AGPL-3.0)"
+__url__ = "https://www.gnu.org/licenses/agpl-3.0.en.html"
+__author__ = "Ludee;"
+__version__ = "v0.0.2"
+
+import os
+
+import yaml
+from pvlib.pvsystem import PVSystem
+from pvlib.temperature import TEMPERATURE_MODEL_PARAMETERS
+
+from settings import SYSTEM_CATALOGUE
+from pv3_cache import LRUCache
+from pv3_inverter_fitting import get_fitted_inverter
+import component_import
+
+import logging
+log = logging.getLogger(__name__)
+
+# keys of a system entry, after applying the defaults
+SYSTEM_KEYS = ['module', 'inverter', 'modules_per_string',
+               'strings_per_inverter', 'surface_tilt', 'surface_azimuth',
+               'albedo', 'temperature_model', 'module_parameters',
+               'inverter_parameters']
+REQUIRED_SYSTEM_KEYS = SYSTEM_KEYS[:7]
+
+# loaded catalogues, keyed by file name and modification time
+_catalogues = LRUCache(maxsize=4)
+
+
+def _validate_component(kind, key, entry):
+    """Returns the problems of a module or inverter entry."""
+    errors = []
+    if not isinstance(entry, dict):
+        return [f'{kind} {key}: entry is not a mapping']
+    if 'function' in entry:
+        if not callable(getattr(component_import, entry['function'], None)):
+            errors.append(f'{kind} {key}: unknown function '
+                          f'{entry["function"]}')
+    elif 'fitted' in entry:
+        if kind != 'inverter':
+            errors.append(f'{kind} {key}: only inverters can be fitted')
+    elif 'sam' not in entry or 'name' not in entry:
+        errors.append(f'{kind} {key}: needs function, fitted or sam and '
+                      f'name')
+    if not isinstance(entry.get('parameters', {}), dict):
+        errors.append(f'{kind} {key}: parameters is not a mapping')
+    return errors
+
+
+def _validate_system(name, entry, modules, inverters):
+    """Returns the problems of a system entry with defaults applied."""
+    errors = [f'system {name}: missing {key}'
+              for key in REQUIRED_SYSTEM_KEYS if key not in entry]
+    errors += [f'system {name}: unknown key {key}'
+               for key in entry if key not in SYSTEM_KEYS]
+    if entry.get('module') not in modules:
+        errors.append(f'system {name}: unknown module {entry.get("module")}')
+    if entry.get('inverter') not in inverters:
+        errors.append(f'system {name}: unknown inverter '
+                      f'{entry.get("inverter")}')
+    for key in ['modules_per_string', 'strings_per_inverter']:
+        value = entry.get(key)
+        if key in entry and (not isinstance(value, int) or value < 1):
+            errors.append(f'system {name}: {key} must be a positive integer')
+    bounds = {'surface_tilt': (0, 90), 'surface_azimuth': (0, 360),
+              'albedo': (0, 1)}
+    for key, (lower, upper) in bounds.items():
+        value = entry.get(key)
+        if key in entry and (not isinstance(value, (int, float)) or
+                             not lower <= value <= upper):
+            errors.append(f'system {name}: {key} must be between {lower} '
+                          f'and {upper}')
+    temperature_model = entry.get('temperature_model')
+    if temperature_model is not None:
+        try:
+            TEMPERATURE_MODEL_PARAMETERS[temperature_model[0]][
+                temperature_model[1]]
+        except (KeyError, IndexError, TypeError):
+            errors.append(f'system {name}: unknown temperature model '
+                          f'{temperature_model}')
+    return errors
+
+
+class SystemCatalogue:
+    """
+    PV systems defined by a catalogue, see `pv3_systems.yml`.
+
+    The catalogue is validated on creation. Components are resolved on
+    first use and shared by all systems that reference them, PVSystem
+    objects are created on first use and cached. Like the tables of
+    `component_import.retrieve_sam`, the returned PVSystems are shared and
+    must not be modified.
+
+    Parameters
+    ----------
+    catalogue : :obj:`dict`
+        Content of a catalogue file.
+
+    """
+
+    def __init__(self, catalogue):
+        self.version = catalogue.get('version')
+        self.modules = catalogue.get('modules') or {}
+        self.inverters = catalogue.get('inverters') or {}
+        self.defaults = catalogue.get('defaults') or {}
+        self.entries = {name: {**self.defaults, **(entry or {})}
+                        for name, entry in
+                        (catalogue.get('systems') or {}).items()}
+
+        errors = []
+        for kind, components in [('module', self.modules),
+                                 ('inverter', self.inverters)]:
+            for key, entry in components.items():
+                errors += _validate_component(kind, key, entry)
+        for name, entry in self.entries.items():
+            errors += _validate_system(name, entry, self.modules,
+                                       self.inverters)
+        if errors:
+            raise ValueError('Invalid system catalogue:\n' +
+                             '\n'.join(errors))
+
+        self._components = {}
+        self._systems = {}
+
+    @classmethod
+    def from_yaml(cls, file_name):
+        """Reads a catalogue from a YAML file."""
+        with open(file_name, encoding='utf-8') as f:
+            catalogue = cls(yaml.safe_load(f))
+        log.info(f'Read {len(catalogue)} PV systems from catalogue: '
+                 f'{file_name}')
+        return catalogue
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    @property
+    def names(self):
+        return list(self.entries)
+
+    def component(self, kind, key):
+        """
+        Returns the parameters of a module or inverter.
+
+        Parameters
+        ----------
+        kind : :obj:`str`
+            'module' or 'inverter'.
+        key : :obj:`str`
+            Key of the component in the catalogue.
+
+        Returns
+        -------
+        :pandas:`Series` or :obj:`dict`
+
+        """
+        if (kind, key) not in self._components:
+            entry = (self.modules if kind == 'module' else
+                     self.inverters)[key]
+            if 'function' in entry:
+                parameters = getattr(component_import, entry['function'])()
+            elif 'fitted' in entry:
+                parameters = get_fitted_inverter(entry['fitted'])
+            else:
+                table = component_import.retrieve_sam(entry['sam'])
+                if entry['name'] not in table:
+                    raise KeyError(f'{kind} {key}: {entry["name"]} not in '
+                                   f'SAM table {entry["sam"]}')
+                parameters = table[entry['name']].copy()
+            for parameter, value in (entry.get('parameters') or {}).items():
+                parameters[parameter] = value
+            self._components[(kind, key)] = parameters
+        return self._components[(kind, key)]
+
+    def system(self, name):
+        """
+        Returns the PVSystem of a catalogue entry.
+
+        Parameters
+        ----------
+        name : :obj:`str`
+            Name of the system, used as name of the PVSystem.
+
+        Returns
+        -------
+        :pvlib:`PVSystem`
+
+        """
+        if name not in self._systems:
+            if name not in self.entries:
+                raise KeyError(f'PV system {name} not in catalogue')
+            entry = self.entries[name]
+            module_parameters = self.component('module',
+                                               entry['module']).copy()
+            inverter_parameters = self.component('inverter',
+                                                 entry['inverter']).copy()
+            for parameter, value in (entry.get('module_parameters')
+                                     or {}).items():
+                module_parameters[parameter] = value
+            for parameter, value in (entry.get('inverter_parameters')
+                                     or {}).items():
+                inverter_parameters[parameter] = value
+            temperature_model = entry.get('temperature_model')
+            if temperature_model is not None:
+                temperature_model = TEMPERATURE_MODEL_PARAMETERS[
+                    temperature_model[0]][temperature_model[1]]
+
+            self._systems[name] = PVSystem(
+                module=self.modules[entry['module']].get(
+                    'label', entry['module']),
+                inverter=self.inverters[entry['inverter']].get(
+                    'label', entry['inverter']),
+                module_parameters=module_parameters,
+                inverter_parameters=inverter_parameters,
+                surface_tilt=entry['surface_tilt'],
+                surface_azimuth=entry['surface_azimuth'],
+                albedo=entry['albedo'],
+                modules_per_string=entry['modules_per_string'],
+                strings_per_inverter=entry['strings_per_inverter'],
+                temperature_model_parameters=temperature_model,
+                name=name)
+        return self._systems[name]
+
+    def systems(self, names=None):
+        """
+        Returns the PVSystems of the given names, all systems by default.
+        """
+        return [self.system(name) for name in names or self.names]
+
+    def with_systems(self, systems):
+        """
+        Returns a catalogue with the components and defaults of this one and
+        the given systems. Resolved components are shared.
+
+        Parameters
+        ----------
+        systems : :obj:`dict`
+            System names as keys and system entries as values.
+
+        Returns
+        -------
+        :class:`SystemCatalogue`
+
+        """
+        catalogue = SystemCatalogue({
+            'version': self.version, 'modules': self.modules,
+            'inverters': self.inverters, 'defaults': self.defaults,
+            'systems': systems})
+        catalogue._components = self._components
+        return catalogue
+
+
+def get_system_catalogue(file_name=SYSTEM_CATALOGUE):
+    """
+    Returns the :class:`SystemCatalogue` of a YAML file.
+
+    The file is read and validated once and kept in memory as long as it is
+    unchanged.
+    """
+    key = (os.path.abspath(file_name), os.path.getmtime(file_name))
+    catalogue = _catalogues.get(key)
+    if catalogue is None:
+        catalogue = SystemCatalogue.from_yaml(file_name)
+        _catalogues.put(key, catalogue)
+    return catalogue
+
+
+def get_pvsystem(name, file_name=SYSTEM_CATALOGUE):
+    """Returns the PVSystem `name` of the catalogue `file_name`."""
+    return get_system_catalogue(file_name).system(name)
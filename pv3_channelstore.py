@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+HTW-PV3 - Memory-mapped channel store for measured data
+
+Store measured time series as one .npy file per channel with a shared
+datetime64 index;
+Read channels and time ranges through memory maps without loading the rest
+of the file, so that processes share the same pages;
+Build the stores of the SonnJA inverters and the HTW weather station from
+the original csv files;
+
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+__copyright__ = "© Ludwig Hülk"
+__license__ = "GNU Affero General Public License Version 3 (AGPL-3.0)"
+__url__ = "https://www.gnu.org/licenses/agpl-3.0.en.html"
+__author__ = "Ludee;"
+__version__ = "v0.0.2"
+
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from settings import CHANNEL_STORE_DIR
+
+import logging
+log = logging.getLogger(__name__)
+
+# original csv files of the SonnJA inverters, formatted with the converter
+CONVERTER_FILE = os.path.join('data', 'htw_2015', 'einleuchtend_data_2015',
+                              'einleuchtend_wrdata_2015_{}.csv')
+
+# original csv file of the HTW weather station
+HTW_WEATHER_FILE = os.path.join('data', 'pv3_2015',
+                                'htw_wetter_weatherdata_2015.csv')
+
+# time zone of the timestamps in the inverter and weather station files
+CONVERTER_TZ = 'Etc/GMT-1'
+
+
+def _replace_directory(source, destination):
+    """Moves the directory `source` to `destination`, replacing it."""
+    old_directory = None
+    if os.path.exists(destination):
+        old_directory = f'{destination}.{os.getpid()}.old'
+        shutil.rmtree(old_directory, ignore_errors=True)
+        os.replace(destination, old_directory)
+    os.replace(source, destination)
+    if old_directory is not None:
+        # memory maps of the old store stay valid until they are closed
+        shutil.rmtree(old_directory, ignore_errors=True)
+
+
+class ChannelStore:
+    """
+    Measured time series stored as memory-mapped arrays.
+
+    A store is a directory with `index.npy` (timestamps as datetime64[ns],
+    UTC for time zone aware data), one `<channel>.npy` per channel and
+    `meta.json` with the channel names, the time zone and the source file.
+    Arrays are opened with `numpy.load(mmap_mode='r')`, so only the pages of
+    the requested channels and time range are read, and processes reading
+    the same store share them in the page cache. A store is written to a
+    temporary directory and moved into place when complete.
+
+    Parameters
+    ----------
+    directory : :obj:`str`
+        Directory of the store.
+
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.tz = self.meta.get('tz')
+        self._index = np.load(os.path.join(directory, 'index.npy'),
+                              mmap_mode='r')
+        if len(self._index) != self.meta['rows']:
+            raise ValueError(f'Channel store {directory} has '
+                             f'{len(self._index)} timestamps, expected '
+                             f'{self.meta["rows"]}.')
+        self._arrays = {}
+
+    @classmethod
+    def write(cls, df, directory, source=None):
+        """
+        Writes the numeric columns of a DataFrame to a store.
+
+        Parameters
+        ----------
+        df : :pandas:`DataFrame`
+            Time series with sorted :pandas:`DatetimeIndex`, one column
+            per channel.
+        directory : :obj:`str`
+            Directory of the store. An existing store is replaced as a
+            whole, including its resolution pyramid.
+        source : :obj:`dict`, optional
+            Information on the source file, saved to `meta.json`.
+
+        Returns
+        -------
+        :class:`ChannelStore`
+
+        """
+        if not isinstance(df.index, pd.DatetimeIndex):
+            raise ValueError('Channel store needs a DatetimeIndex.')
+        if not df.index.is_monotonic_increasing:
+            raise ValueError('Channel store needs a sorted DatetimeIndex.')
+
+        numeric = df.select_dtypes('number')
+        skipped = df.columns.difference(numeric.columns)
+        if len(skipped):
+            log.warning(f'Skip non-numeric channels: {list(skipped)}')
+
+        # an interrupted write leaves the temporary directory, never a
+        # store with channels of different versions
+        directory = os.path.normpath(directory)
+        tmp_directory = f'{directory}.{os.getpid()}.tmp'
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        os.makedirs(tmp_directory)
+        index = df.index
+        tz = None if index.tz is None else str(index.tz)
+        if tz is not None:
+            index = index.tz_convert('UTC').tz_localize(None)
+        np.save(os.path.join(tmp_directory, 'index.npy'),
+                index.values.astype('datetime64[ns]'))
+        for channel in numeric.columns:
+            np.save(os.path.join(tmp_directory, f'{channel}.npy'),
+                    np.ascontiguousarray(numeric[channel].values))
+
+        meta = {'channels': [str(channel) for channel in numeric.columns],
+                'index_name': df.index.name, 'tz': tz, 'rows': len(df),
+                'source': source}
+        with open(os.path.join(tmp_directory, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        _replace_directory(tmp_directory, directory)
+        log.info(f'Write {len(numeric.columns)} channels with {len(df)} '
+                 f'timesteps to channel store: {directory}')
+        return cls(directory)
+
+    @property
+    def channels(self):
+        return list(self.meta['channels'])
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, channel):
+        return channel in self.meta['channels']
+
+    def _timestamp(self, value):
+        """Converts a time range bound to datetime64[ns] in store time."""
+        timestamp = pd.Timestamp(value)
+        if self.tz is not None:
+            if timestamp.tz is None:
+                timestamp = timestamp.tz_localize(self.tz)
+            timestamp = timestamp.tz_convert('UTC').tz_localize(None)
+        elif timestamp.tz is not None:
+            raise ValueError('Channel store has no time zone, use naive '
+                             'timestamps.')
+        return timestamp.to_datetime64()
+
+    def positions(self, start=None, end=None):
+        """
+        Returns the slice of the rows from `start` to `end` (both
+        inclusive, like label based slicing in pandas), found by binary
+        search on the index.
+        """
+        first = 0 if start is None else int(np.searchsorted(
+            self._index, self._timestamp(start), side='left'))
+        last = len(self) if end is None else int(np.searchsorted(
+            self._index, self._timestamp(end), side='right'))
+        return slice(first, last)
+
+    def array(self, channel):
+        """Returns the memory-mapped array of a channel."""
+        if channel not in self:
+            raise KeyError(f'Channel {channel} not in store {self.directory}')
+        if channel not in self._arrays:
+            values = np.load(os.path.join(self.directory, f'{channel}.npy'),
+                             mmap_mode='r')
+            if len(values) != len(self):
+                raise ValueError(f'Channel {channel} of store '
+                                 f'{self.directory} has {len(values)} '
+                                 f'values, expected {len(self)}.')
+            self._arrays[channel] = values
+        return self._arrays[channel]
+
+    def values(self, channel, start=None, end=None):
+        """
+        Returns the values of a channel from `start` to `end` as read-only
+        view of the memory map, without copying.
+        """
+        return self.array(channel)[self.positions(start, end)]
+
+    def index(self, start=None, end=None):
+        """
+        Returns the timestamps from `start` to `end`.
+
+        Returns
+        -------
+        :pandas:`DatetimeIndex`
+            In the time zone of the stored data.
+
+        """
+        index = pd.DatetimeIndex(self._index[self.positions(start, end)],
+                                 name=self.meta.get('index_name'))
+        if self.tz is not None:
+            index = index.tz_localize('UTC').tz_convert(self.tz)
+        return index
+
+    def read(self, channels=None, start=None, end=None):
+        """
+        Reads channels from `start` to `end` into a DataFrame.
+
+        Only the selected rows of the selected channels are copied from
+        the memory maps.
+
+        Parameters
+        ----------
+        channels : :obj:`list` or :obj:`str`, optional
+            Channel names. Default: all channels.
+        start, end : :obj:`str` or :pandas:`Timestamp`, optional
+            First and last timestamp. Naive timestamps are in the time zone
+            of the stored data. Default: whole time range.
+
+        Returns
+        -------
+        :pandas:`DataFrame`
+
+        """
+        if channels is None:
+            channels = self.channels
+        elif isinstance(channels, str):
+            channels = [channels]
+        rows = self.positions(start, end)
+        return pd.DataFrame({channel: np.array(self.array(channel)[rows])
+                             for channel in channels},
+                            index=self.index(start, end), columns=channels)
+
+
+def _source_info(file_name):
+    stat = os.stat(file_name)
+    return {'file': os.path.abspath(file_name), 'mtime_ns': stat.st_mtime_ns,
+            'size': stat.st_size}
+
+
+def get_csv_store(file_name, store_directory, tz=None):
+    """
+    Returns the channel store of a csv file with timestamps in the first
+    column, as written by the HTW measurement systems (';' separated).
+
+    The store is built on first use and rebuilt if the csv file changed.
+
+    Parameters
+    ----------
+    file_name : :obj:`str`
+        Name of the csv file.
+    store_directory : :obj:`str`
+        Directory of the store.
+    tz : :obj:`str`, optional
+        Time zone the timestamps of the file are localized to.
+
+    Returns
+    -------
+    :class:`ChannelStore`
+
+    """
+    source = _source_info(file_name)
+    if os.path.isfile(os.path.join(store_directory, 'meta.json')):
+        store = ChannelStore(store_directory)
+        if store.meta.get('source') == source:
+            return store
+    # the store is the cache of the csv file
+    data = pd.read_csv(file_name, sep=';', header=[0], index_col=[0],
+                       parse_dates=True).sort_index()
+    if tz is not None:
+        data = data.tz_localize(tz)
+    return ChannelStore.write(data, store_directory, source=source)
+
+
+def get_converter_store(converter, directory=CHANNEL_STORE_DIR):
+    """
+    Returns the channel store of a SonnJA inverter, with timestamps
+    localized to `CONVERTER_TZ`.
+
+    Parameters
+    ----------
+    converter : :obj:`str`
+        'wr1', 'wr2', 'wr3', 'wr4' or 'wr5'.
+    directory : :obj:`str`
+        Directory of the channel stores. Default: `CHANNEL_STORE_DIR`.
+
+    Returns
+    -------
+    :class:`ChannelStore`
+
+    """
+    return get_csv_store(CONVERTER_FILE.format(converter),
+                         os.path.join(directory, converter), tz=CONVERTER_TZ)
+
+
+def get_htw_weather_store(directory=CHANNEL_STORE_DIR):
+    """
+    Returns the channel store of the HTW weather station, with timestamps
+    localized to `CONVERTER_TZ`.
+    """
+    return get_csv_store(HTW_WEATHER_FILE,
+                         os.path.join(directory, 'htw_weather'),
+                         tz=CONVERTER_TZ)
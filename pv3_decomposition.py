@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+HTW-PV3 - Decomposition models
+
+Reindl model to calculate DNI and DHI from GHI, evaluated on a fixed set
+of preallocated buffers (numpy) or as fused expressions (numexpr, if
+installed). Works on time series of one site and on 2-D arrays
+(sites x timesteps);
+Solar position, clear sky DNI and decomposition models for many sites in
+one vectorized pass;
+
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+__copyright__ = "© Ludwig Hülk"
+__license__ = "GNU Affero General Public License Version 3 (AGPL-3.0)"
+__url__ = "https://www.gnu.org/licenses/agpl-3.0.en.html"
+__author__ = "Ludee;"
+__version__ = "v0.0.2"
+
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import pvlib
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+import logging
+log = logging.getLogger(__name__)
+
+REINDL_BACKENDS = ['auto', 'numpy', 'numexpr']
+# elements per block of the numpy backend, small enough to keep the
+# buffers in the CPU cache
+REINDL_BLOCK_SIZE = 16384
+
+# diffuse fraction of the reindl model with the limits of Case 1 and Case 2,
+# a and b are the fractions for kt > 0.78 and 0.3 < kt <= 0.78, fmax and
+# fmin are written as where with the same result for nan
+_REINDL_DF_EXPRESSION = (
+    'where(kt > 0.78, where(a > 0.1, a, 0.1), '
+    'where((kt > 0.3) & (kt <= 0.78), '
+    'where(b > 0.1, where(b < 0.97, b, 0.97), 0.1), '
+    '1.02 - 0.254 * kt + 0.0123 * es))')
+_REINDL_LIMIT_EXPRESSION = (
+    'where(((df < 0.9) & (kt < 0.2)) | ((df > 0.8) & (kt > 0.6)) | '
+    '(df > 1) | (ghi - i0_h > 0), 0, df) * ghi')
+
+
+def _reindl_numpy(ghi, i0_h, es, dni, dhi, kt, df, mask, mask_a, mask_b):
+    """
+    Reindl model with in-place operations, writes the results to dni, dhi
+    and kt. df and the masks are buffers of the same shape, dni and dhi are
+    used as buffers until they are calculated.
+    """
+    # clearness index kt
+    np.multiply(i0_h, es, out=dni)
+    np.divide(ghi, dni, out=kt)
+    np.maximum(0, kt, out=kt)
+
+    # diffuse fraction for kt <= 0.3
+    np.multiply(0.254, kt, out=df)
+    np.subtract(1.02, df, out=df)
+    np.multiply(0.0123, es, out=dni)
+    np.add(df, dni, out=df)
+
+    # for kt > 0.3 and kt <= 0.78
+    np.multiply(1.794, kt, out=dhi)
+    np.subtract(1.4, dhi, out=dhi)
+    np.multiply(0.177, es, out=dni)
+    np.add(dhi, dni, out=dhi)
+    np.fmax(0.1, dhi, out=dhi)
+    np.fmin(0.97, dhi, out=dhi)
+    np.greater(kt, 0.3, out=mask_a)
+    np.less_equal(kt, 0.78, out=mask_b)
+    np.logical_and(mask_a, mask_b, out=mask)
+    np.copyto(df, dhi, where=mask)
+
+    # for kt > 0.78
+    np.multiply(0.486, kt, out=dhi)
+    np.multiply(0.182, es, out=dni)
+    np.add(dhi, dni, out=dhi)
+    np.fmax(0.1, dhi, out=dhi)
+    np.greater(kt, 0.78, out=mask)
+    np.copyto(df, dhi, where=mask)
+
+    # eliminate extreme data according to limits Case 1 and Case 2 in Reindl
+    np.less(df, 0.9, out=mask_a)
+    np.less(kt, 0.2, out=mask_b)
+    np.logical_and(mask_a, mask_b, out=mask)
+    np.greater(df, 0.8, out=mask_a)
+    np.greater(kt, 0.6, out=mask_b)
+    np.logical_and(mask_a, mask_b, out=mask_a)
+    np.logical_or(mask, mask_a, out=mask)
+    np.greater(df, 1, out=mask_a)
+    np.logical_or(mask, mask_a, out=mask)
+    np.subtract(ghi, i0_h, out=dni)
+    np.greater(dni, 0, out=mask_a)
+    np.logical_or(mask, mask_a, out=mask)
+    np.copyto(df, 0, where=mask)
+
+    np.multiply(df, ghi, out=dhi)
+    np.subtract(ghi, dhi, out=dni)
+    np.divide(dni, es, out=dni)
+
+
+def _reindl_numexpr(ghi, i0_h, es, dni, dhi, kt, df):
+    """
+    Reindl model as fused numexpr expressions, writes the results to dni,
+    dhi and kt.
+    """
+    variables = {'ghi': ghi, 'i0_h': i0_h, 'es': es, 'kt': kt, 'df': df,
+                 'a': dni, 'b': dhi, 'dhi': dhi}
+
+    def evaluate(expression, out):
+        numexpr.evaluate(expression, local_dict=variables, out=out,
+                         casting='same_kind')
+
+    evaluate('ghi / (i0_h * es)', kt)
+    evaluate('where(kt < 0, 0, kt)', kt)
+    evaluate('0.486 * kt + 0.182 * es', dni)
+    evaluate('1.4 - 1.794 * kt + 0.177 * es', dhi)
+    evaluate(_REINDL_DF_EXPRESSION, df)
+    evaluate(_REINDL_LIMIT_EXPRESSION, dhi)
+    evaluate('(ghi - dhi) / es', dni)
+
+
+def reindl_kernel(ghi, i0_h, sin_elevation, dtype=np.float64,
+                  backend='auto'):
+    """
+    Array kernel of the Reindl model.
+
+    Inputs are broadcast against each other, e.g. (sites, timesteps) with
+    (timesteps,). The numpy backend works through blocks of
+    `REINDL_BLOCK_SIZE` elements with a fixed set of buffers.
+
+    Parameters
+    ----------
+    ghi : :numpy:`array`
+        Global horizontal irradiance in W/m².
+    i0_h : :numpy:`array`
+        Irradiance on top of atmosphere in W/m².
+    sin_elevation : :numpy:`array`
+        Sine of the solar elevation.
+    dtype : :numpy:`dtype`
+        Data type of the calculation and the results, e.g. np.float32.
+        Default: np.float64.
+    backend : :obj:`str`
+        'numpy', 'numexpr' or 'auto' (numexpr if installed and running
+        on more than one thread, numpy otherwise). Default: 'auto'.
+
+    Returns
+    -------
+    :obj:`tuple`
+        Arrays of DNI, DHI and clearness index kt.
+
+    """
+    if backend not in REINDL_BACKENDS:
+        raise ValueError(f'Unknown backend {backend}, choose from '
+                         f'{REINDL_BACKENDS}')
+    if backend == 'auto':
+        use_numexpr = numexpr is not None and numexpr.nthreads > 1
+        backend = 'numexpr' if use_numexpr else 'numpy'
+    if backend == 'numexpr' and numexpr is None:
+        raise ImportError('Backend numexpr requires the numexpr package')
+
+    arrays = np.broadcast_arrays(*[
+        np.atleast_1d(np.asarray(values, dtype=dtype))
+        for values in (ghi, i0_h, sin_elevation)])
+    shape = arrays[0].shape
+    dni, dhi, kt = [np.empty(shape, dtype=dtype) for _ in range(3)]
+
+    if backend == 'numexpr':
+        _reindl_numexpr(*arrays, dni, dhi, kt, np.empty(shape, dtype=dtype))
+        return dni, dhi, kt
+
+    # blocks of rows along the first axis
+    rows = max(1, REINDL_BLOCK_SIZE // max(1, int(np.prod(shape[1:]))))
+    block_shape = (min(rows, shape[0]),) + shape[1:]
+    df = np.empty(block_shape, dtype=dtype)
+    masks = [np.empty(block_shape, dtype=bool) for _ in range(3)]
+    for start in range(0, shape[0], rows):
+        block = slice(start, start + rows)
+        size = len(range(*block.indices(shape[0])))
+        _reindl_numpy(*[values[block] for values in arrays],
+                      dni[block], dhi[block], kt[block], df[:size],
+                      *[mask[:size] for mask in masks])
+    return dni, dhi, kt
+
+
+def reindl(ghi, i0_h, elevation, dtype=np.float64, backend='auto'):
+    """
+    Reindl model to calculate DNI and DHI from GHI and I0_h.
+
+    Parameters
+    -----------
+    ghi : :pandas:`Series` or :numpy:`array`
+        Global horizontal irradiance in W/m², 2-D arrays hold one site per
+        row.
+    i0_h : :pandas:`Series` or :numpy:`array`
+        Irradiance on top of atmosphere in W/m².
+    elevation : :pandas:`Series` or :numpy:`array`
+        Solar elevation in degrees.
+    dtype : :numpy:`dtype`
+        Data type of the results. Default: np.float64.
+    backend : :obj:`str`
+        See `reindl_kernel`. Default: 'auto'.
+
+    Returns
+    -------
+    :collections:`OrderedDict` or :pandas:`DataFrame`
+        DNI, DHI and clearness index kt, as DataFrame if `ghi` is a
+        Series.
+
+    """
+    sin_elevation = np.sin(np.radians(np.asarray(elevation,
+                                                 dtype=np.float64)))
+    dni, dhi, kt = reindl_kernel(ghi, i0_h, sin_elevation, dtype=dtype,
+                                 backend=backend)
+
+    data = OrderedDict()
+    data['dni'] = dni
+    data['dhi'] = dhi
+    data['kt'] = kt
+
+    if isinstance(ghi, pd.Series):
+        data = pd.DataFrame(data, index=ghi.index)
+
+    return data
+
+
+def unix_seconds(times):
+    """
+    Seconds since 1970-01-01 UTC of a :pandas:`DatetimeIndex` of any time
+    unit (pandas 3 creates microsecond indexes by default).
+    """
+    if hasattr(times, 'as_unit'):
+        times = times.as_unit('ns')
+    return np.array(times.asi8 / 10**9)
+
+
+def solar_position_sites(times, latitude, longitude, altitude=0,
+                         pressure=101325., temperature=12, delta_t=67.0,
+                         atmos_refract=0.5667):
+    """
+    Solar position of many sites in one pass.
+
+    Same as `pvlib.solarposition.spa_python` (method 'nrel_numpy' of
+    :pvlib:`Location.get_solarposition`), but the time dependent terms are
+    calculated once for all sites.
+
+    Parameters
+    ----------
+    times : :pandas:`DatetimeIndex`
+    latitude, longitude : :numpy:`array`
+        Coordinates of the sites in degrees, shape (sites,).
+    altitude : :numpy:`array` or :obj:`float`
+        Altitude of the sites in m. Default: 0.
+    pressure : :numpy:`array` or :obj:`float`
+        Air pressure per site in Pa. Default: 101325.
+    temperature : :numpy:`array` or :obj:`float`
+        Air temperature per site in °C. Default: 12.
+
+    Returns
+    -------
+    :obj:`dict`
+        'apparent_zenith', 'zenith', 'apparent_elevation', 'elevation',
+        'azimuth' and 'equation_of_time' as arrays of shape
+        (sites, timesteps).
+
+    """
+    def column(values):
+        return np.reshape(np.asarray(values, dtype=np.float64), (-1, 1))
+
+    unixtime = unix_seconds(times)
+    app_zenith, zenith, app_elevation, elevation, azimuth, eot = \
+        pvlib.spa.solar_position_numpy(
+            unixtime, column(latitude), column(longitude), column(altitude),
+            column(pressure) / 100, column(temperature), delta_t,
+            atmos_refract, numthreads=None)
+    shape = (len(np.atleast_1d(latitude)), len(times))
+    return {'apparent_zenith': app_zenith, 'zenith': zenith,
+            'apparent_elevation': app_elevation, 'elevation': elevation,
+            'azimuth': azimuth,
+            'equation_of_time': np.broadcast_to(eot, shape)}
+
+
+def clearsky_dni_sites(times, latitude, longitude, altitude,
+                       apparent_zenith):
+    """
+    Clear sky DNI of many sites like :pvlib:`Location.get_clearsky`
+    (ineichen model, looked up Linke turbidity).
+
+    Parameters
+    ----------
+    times : :pandas:`DatetimeIndex`
+    latitude, longitude, altitude : :numpy:`array`
+        Coordinates and altitude of the sites, shape (sites,).
+    apparent_zenith : :numpy:`array`
+        Apparent solar zenith of shape (sites, timesteps).
+
+    Returns
+    -------
+    :numpy:`array`
+        Clear sky DNI of shape (sites, timesteps).
+
+    """
+    altitude = np.reshape(np.asarray(altitude, dtype=np.float64), (-1, 1))
+    linke_turbidity = np.vstack([
+        pvlib.clearsky.lookup_linke_turbidity(times, lat, lon).values
+        for lat, lon in zip(latitude, longitude)])
+    airmass_relative = pvlib.atmosphere.get_relative_airmass(apparent_zenith)
+    airmass_absolute = pvlib.atmosphere.get_absolute_airmass(
+        airmass_relative, pvlib.atmosphere.alt2pres(altitude))
+    dni_extra = pvlib.irradiance.get_extra_radiation(times).values
+    clearsky = pvlib.clearsky.ineichen(
+        apparent_zenith, airmass_absolute, linke_turbidity,
+        altitude=altitude, dni_extra=dni_extra)
+    return np.broadcast_to(clearsky['dni'], apparent_zenith.shape)
+
+
+def dni_sites(ghi, dhi, zenith, clearsky_dni=None, clearsky_tolerance=1.1,
+              zenith_threshold_for_zero_dni=88.0,
+              zenith_threshold_for_clearsky_limit=80.0):
+    """
+    `pvlib.irradiance.dni` for arrays of shape (sites, timesteps).
+    """
+    dni = (ghi - dhi) / pvlib.tools.cosd(zenith)
+    dni = np.where(dni < 0, np.nan, dni)
+    dni = np.where((zenith >= zenith_threshold_for_zero_dni) & (dni != 0),
+                   np.nan, dni)
+    if clearsky_dni is not None:
+        max_dni = clearsky_dni * clearsky_tolerance
+        dni = np.where((zenith >= zenith_threshold_for_clearsky_limit) &
+                       (zenith < zenith_threshold_for_zero_dni) &
+                       (dni > max_dni), max_dni, dni)
+    return dni
+
+
+def apply_decomposition_model_sites(weather, times, latitude, longitude,
+                                    model, altitude=0):
+    """
+    Applies a decomposition model to many sites in one vectorized pass.
+
+    Equivalent to `pv3_pvlib_sonnja.apply_decomposition_model` for every
+    site, with the solar position calculated from the mean pressure and
+    air temperature of each site.
+
+    Parameters
+    ----------
+    weather : :obj:`dict`
+        Arrays of shape (sites, timesteps) for 'ghi', 'pressure' (Pa),
+        'temp_air' (°C) and for model 'reindl' 'i0_h'.
+    times : :pandas:`DatetimeIndex`
+        Time index of the weather data.
+    latitude, longitude : :numpy:`array`
+        Coordinates of the sites, shape (sites,).
+    model : :obj:`str`
+        Decomposition model to use. Choose from 'reindl', 'erbs' or 'disc'.
+    altitude : :numpy:`array` or :obj:`float`
+        Altitude of the sites in m. Default: 0.
+
+    Returns
+    -------
+    :obj:`dict`
+        Arrays of shape (sites, timesteps): 'dni', 'dhi' and 'kt' and
+        'dni_corrected' (reindl and erbs) or 'gni' (disc).
+
+    """
+    latitude = np.atleast_1d(np.asarray(latitude, dtype=np.float64))
+    longitude = np.atleast_1d(np.asarray(longitude, dtype=np.float64))
+    altitude = np.broadcast_to(np.asarray(altitude, dtype=np.float64),
+                               latitude.shape)
+    ghi = weather['ghi']
+    pressure = np.nanmean(weather['pressure'], axis=1)
+
+    solar_position = solar_position_sites(
+        times, latitude, longitude, altitude=altitude, pressure=pressure,
+        temperature=np.nanmean(weather['temp_air'], axis=1))
+    zenith = solar_position['zenith']
+
+    if model == 'reindl':
+        data = reindl(ghi, weather['i0_h'], solar_position['elevation'])
+    elif model == 'erbs':
+        data = pvlib.irradiance.erbs(ghi, zenith, times.dayofyear.values)
+    elif model == 'disc':
+        data = pvlib.irradiance.disc(ghi, zenith, times.dayofyear.values,
+                                     pressure[:, np.newaxis])
+        data = dict(data)
+        data['dhi'] = ghi - data['dni'] * pvlib.tools.cosd(zenith)
+        data['gni'] = data['dni'] + data['dhi']
+        return data
+    else:
+        raise ValueError(f'Unknown decomposition model {model}')
+
+    data = dict(data)
+    data['dni_corrected'] = dni_sites(
+        ghi, data['dhi'], zenith,
+        clearsky_dni=clearsky_dni_sites(times, latitude, longitude, altitude,
+                                        solar_position['apparent_zenith']))
+    return data
@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+HTW-PV3 - Fleet simulation of many PV systems
+
+Read a table of PV systems with site, orientation, components and string
+layout;
+Group the systems by site, so that solar position and transposition are
+calculated once per site and orientation;
+Run the groups in batches with the vectorized model in a process pool;
+Return the yield of every system and the AC power of the fleet;
+
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+__copyright__ = "© Ludwig Hülk"
+__license__ = "GNU Affero General Public License Version 3 (AGPL-3.0)"
+__url__ = "https://www.gnu.org/licenses/agpl-3.0.en.html"
+__author__ = "Ludee;"
+__version__ = "v0.0.2"
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from pvlib.location import Location
+
+from settings import setup_logger, write_to_csv, MODEL_WORKERS
+from pv3_batch import batch_model_arrays, get_array, get_string_layout
+from pv3_catalogue import SYSTEM_KEYS, get_system_catalogue
+from pv3_instrumentation import Instrumentation, instrumentation
+
+import logging
+log = logging.getLogger(__name__)
+
+# columns of a fleet table, 'altitude' and the remaining `SYSTEM_KEYS`
+# (e.g. 'albedo') are optional
+FLEET_COLUMNS = ['name', 'latitude', 'longitude', 'surface_tilt',
+                 'surface_azimuth', 'module', 'inverter',
+                 'modules_per_string', 'strings_per_inverter']
+
+# systems whose coordinates agree to this number of decimals share a site
+SITE_PRECISION = 2
+
+# maximum number of systems evaluated in one array pass
+FLEET_BATCH_SIZE = 500
+
+
+def read_fleet(file_name, sep=','):
+    """
+    Reads a fleet table from a csv file with the columns `FLEET_COLUMNS`.
+    """
+    fleet = pd.read_csv(file_name, sep=sep)
+    missing = [column for column in FLEET_COLUMNS
+               if column not in fleet.columns]
+    if missing:
+        raise ValueError(f'Fleet table {file_name} misses columns: '
+                         f'{missing}')
+    log.info(f'Read {len(fleet)} PV systems from file: {file_name}')
+    return fleet
+
+
+def fleet_sites(fleet, precision=SITE_PRECISION):
+    """
+    Groups the systems of a fleet table by site.
+
+    Parameters
+    ----------
+    fleet : :pandas:`DataFrame`
+        Fleet table.
+    precision : :obj:`int`
+        Number of decimals of the coordinates that define a site.
+        Default: `SITE_PRECISION` (about 1 km).
+
+    Returns
+    -------
+    :obj:`tuple`
+        Site number of every system and a :pandas:`DataFrame` with
+        'latitude', 'longitude' and 'altitude' (mean of the systems) per
+        site number.
+
+    """
+    keys = pd.DataFrame({'latitude': fleet['latitude'].round(precision),
+                         'longitude': fleet['longitude'].round(precision),
+                         'altitude': fleet.get('altitude', 0.)})
+    keys['altitude'] = keys['altitude'].fillna(0.)
+    codes = keys.groupby(['latitude', 'longitude'], sort=True).ngroup()
+    sites = keys.groupby(codes).agg(
+        latitude=('latitude', 'first'), longitude=('longitude', 'first'),
+        altitude=('altitude', 'mean'))
+    sites.index.name = 'site'
+    return codes.values, sites
+
+
+def fleet_pvsystems(fleet, catalogue=None):
+    """
+    Creates the PVSystems of a fleet table.
+
+    Module and inverter are keys of the system catalogue, missing values
+    are taken from its defaults.
+
+    Parameters
+    ----------
+    fleet : :pandas:`DataFrame`
+        Fleet table.
+    catalogue : :class:`pv3_catalogue.SystemCatalogue`, optional
+        Catalogue with the components. Default: `get_system_catalogue()`.
+
+    Returns
+    -------
+    :obj:`list`
+        List of :pvlib:`PVSystem` in the order of the table.
+
+    """
+    if fleet['name'].duplicated().any():
+        raise ValueError('Names of the fleet table are not unique: '
+                         f'{list(fleet["name"][fleet["name"].duplicated()])}')
+    if catalogue is None:
+        catalogue = get_system_catalogue()
+    columns = [column for column in fleet.columns if column in SYSTEM_KEYS]
+    systems = {}
+    for record in fleet[['name'] + columns].to_dict('records'):
+        name = record.pop('name')
+        systems[name] = {key: value for key, value in record.items()
+                         if not pd.isna(value)}
+    return catalogue.with_systems(systems).systems(list(systems))
+
+
+def merra_site_weather(store, sites, model='erbs'):
+    """
+    Returns weather data of every site from the closest MERRA grid point,
+    with DNI and DHI of one vectorized decomposition pass.
+
+    Parameters
+    ----------
+    store : :class:`pv3_merra.MerraStore`
+    sites : :pandas:`DataFrame`
+        Sites, see `fleet_sites`.
+    model : :obj:`str`
+        Decomposition model. Default: 'erbs'.
+
+    Returns
+    -------
+    :obj:`dict`
+        Site numbers as keys and weather :pandas:`DataFrame` as values.
+
+    """
+    latitude = sites['latitude'].values
+    longitude = sites['longitude'].values
+    decomposition = store.decompose(latitude, longitude, model=model,
+                                    altitude=sites['altitude'].values)
+    data = store.select(store.nearest_sites(latitude, longitude),
+                        ['ghi', 'temp_air', 'wind_speed', 'pressure'])
+    dni = np.nan_to_num(decomposition.get('dni_corrected',
+                                          decomposition['dni']))
+    dhi = np.nan_to_num(decomposition['dhi'])
+    return {site: pd.DataFrame({'ghi': data['ghi'][idx], 'dni': dni[idx],
+                                'dhi': dhi[idx],
+                                'temp_air': data['temp_air'][idx],
+                                'wind_speed': data['wind_speed'][idx],
+                                'pressure': data['pressure'][idx]},
+                               index=store.times)
+            for idx, site in enumerate(sites.index)}
+
+
+def _period_starts(index, freq):
+    """Returns labels and first positions of the periods of an index."""
+    if freq is None:
+        return index[:1], np.array([0])
+    first = pd.Series(np.arange(len(index)), index=index).resample(
+        freq).min().dropna()
+    return first.index, first.values.astype(np.int64)
+
+
+def _run_fleet_batch(task):
+    """
+    Runs one batch of systems of a site and returns the system names, the
+    period labels, AC and DC energy per system and period in kWh, the
+    summed AC power in W and the stage record.
+    """
+    site, site_data, pv_systems, weather, freq, surrogate_dc, \
+        surrogate_grid = task
+    recorder = Instrumentation(log_records=False)
+    with recorder.stage('fleet_batch', rows=len(weather) * len(pv_systems),
+                        site=site, systems=len(pv_systems)):
+        location = Location(site_data['latitude'], site_data['longitude'],
+                            tz=str(weather.index.tz or 'UTC'),
+                            altitude=site_data['altitude'])
+        result = batch_model_arrays(pv_systems, location, weather,
+                                    surrogate_dc=surrogate_dc,
+                                    surrogate_grid=surrogate_grid)
+        step_hours = (pd.Series(weather.index).diff().median()
+                      / pd.Timedelta(hours=1))
+        periods, starts = _period_starts(weather.index, freq)
+        ac_energy = np.add.reduceat(result['ac'], starts, axis=1) * \
+            step_hours / 1000
+        dc_energy = np.add.reduceat(result['p_mp'], starts, axis=1) * \
+            step_hours / 1000
+        fleet_ac = pd.Series(result['ac'].sum(axis=0), index=weather.index)
+    return ([pv_system.name for pv_system in pv_systems], periods,
+            ac_energy, dc_energy, fleet_ac, recorder.records[0])
+
+
+def _peak_power_kw(pv_system):
+    """Returns the DC peak power of a PVSystem in kW."""
+    module = get_array(pv_system).module_parameters
+    stc = module.get('STC')
+    if stc is None or pd.isna(stc):
+        stc = module['I_mp_ref'] * module['V_mp_ref']
+    modules_per_string, strings_per_inverter = get_string_layout(pv_system)
+    return stc * modules_per_string * strings_per_inverter / 1000
+
+
+def run_fleet(fleet, weather, catalogue=None, freq=None, workers=None,
+              batch_size=FLEET_BATCH_SIZE, precision=SITE_PRECISION,
+              surrogate_dc=False, surrogate_grid=None):
+    """
+    Simulates all systems of a fleet table.
+
+    The systems are grouped by site and, within a site, sorted by
+    orientation and split into batches of at most `batch_size` systems.
+    Each batch is evaluated in one array pass with
+    `pv3_batch.batch_model_arrays` (solar position once per site,
+    transposition once per orientation). Batches are distributed over a
+    process pool.
+
+    Parameters
+    ----------
+    fleet : :pandas:`DataFrame`
+        Fleet table, see `FLEET_COLUMNS`.
+    weather : :pandas:`DataFrame` or :obj:`dict`
+        Weather data with 'ghi', 'dni', 'dhi', 'temp_air' and 'wind_speed'
+        for all sites, or a dictionary with site numbers (see
+        `fleet_sites`) as keys and weather data as values.
+    catalogue : :class:`pv3_catalogue.SystemCatalogue`, optional
+        Catalogue with the components. Default: `get_system_catalogue()`.
+    freq : :obj:`str`, optional
+        Resample rule of the yields, e.g. 'MS'. Default: None (one yield
+        for the whole time range).
+    workers : :obj:`int`, optional
+        Number of worker processes. If 1, all batches are run in the main
+        process. Default: None (`settings.MODEL_WORKERS`, if that is None
+        too the number of CPUs).
+    batch_size : :obj:`int`
+        Maximum number of systems per batch. Default: `FLEET_BATCH_SIZE`.
+    precision : :obj:`int`
+        Number of decimals of the coordinates that define a site.
+        Default: `SITE_PRECISION`.
+    surrogate_dc : :obj:`bool`
+        If True, DC output is interpolated in the diode tables of
+        `pv3_surrogate` instead of solving the single diode equation.
+        Default: False.
+    surrogate_grid : :obj:`tuple`, optional
+        (irradiance, temperature) grid of the diode tables, see
+        `pv3_surrogate.DiodeTable.from_module`. Default: None (grids of
+        `pv3_surrogate`).
+
+    Returns
+    -------
+    :obj:`tuple`
+        Yields as :pandas:`DataFrame` with one row per system (and period)
+        and the columns 'system', 'site', 'period', 'peak_power_kw',
+        'ac_kwh', 'dc_kwh' and 'specific_yield' (kWh/kWp), and the AC power
+        of the fleet in W as :pandas:`Series`.
+
+    """
+    pv_systems = fleet_pvsystems(fleet, catalogue=catalogue)
+    codes, sites = fleet_sites(fleet, precision=precision)
+    orientation = fleet[['surface_tilt', 'surface_azimuth']].values
+
+    tasks = []
+    for site in sites.index:
+        site_weather = weather[site] if isinstance(weather, dict) \
+            else weather
+        rows = np.flatnonzero(codes == site)
+        rows = rows[np.lexsort((orientation[rows, 1],
+                                orientation[rows, 0]))]
+        for start in range(0, len(rows), batch_size):
+            tasks.append((site, sites.loc[site].to_dict(),
+                          [pv_systems[row]
+                           for row in rows[start:start + batch_size]],
+                          site_weather, freq, surrogate_dc,
+                          surrogate_grid))
+    log.info(f'Run {len(pv_systems)} PV systems at {len(sites)} sites in '
+             f'{len(tasks)} batches')
+
+    if workers is None:
+        workers = MODEL_WORKERS or os.cpu_count()
+    workers = min(workers, len(tasks))
+    if workers <= 1:
+        results = [_run_fleet_batch(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_run_fleet_batch, tasks))
+
+    peak_power = {pv_system.name: _peak_power_kw(pv_system)
+                  for pv_system in pv_systems}
+    site_of_system = dict(zip(fleet['name'], codes))
+    yields = []
+    fleet_ac = None
+    for names, periods, ac_energy, dc_energy, batch_ac, record in results:
+        instrumentation.add(record)
+        yields.append(pd.DataFrame({
+            'system': np.repeat(names, len(periods)),
+            'period': np.tile(periods, len(names)),
+            'ac_kwh': ac_energy.ravel(), 'dc_kwh': dc_energy.ravel()}))
+        fleet_ac = batch_ac if fleet_ac is None else \
+            fleet_ac.add(batch_ac, fill_value=0)
+
+    yields = pd.concat(yields, ignore_index=True)
+    yields.insert(1, 'site', yields['system'].map(site_of_system))
+    yields.insert(3, 'peak_power_kw', yields['system'].map(peak_power))
+    yields['specific_yield'] = yields['ac_kwh'] / yields['peak_power_kw']
+    order = pd.Categorical(yields['system'], categories=fleet['name'])
+    yields = yields.iloc[np.lexsort((yields['period'].values,
+                                     order.codes))].reset_index(drop=True)
+    fleet_ac.name = 'ac'
+    return yields, fleet_ac
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('fleet', help='csv file of the fleet table')
+    parser.add_argument('--weather',
+                        help='csv file with pvlib weather data of all sites')
+    parser.add_argument('--merra', help='MERRA csv file, weather data of the '
+                                        'closest grid point of every site')
+    parser.add_argument('--freq', default=None,
+                        help='Resample rule of the yields, e.g. MS')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--surrogate', action='store_true',
+                        help='Interpolate DC output in diode tables')
+    parser.add_argument('--output', default=os.path.join('data', 'fleet'))
+    args = parser.parse_args()
+
+    log = setup_logger()
+    fleet = read_fleet(args.fleet)
+    if args.merra:
+        from pv3_merra import MerraStore
+        _, sites = fleet_sites(fleet)
+        weather = merra_site_weather(MerraStore.from_csv(args.merra), sites)
+    elif args.weather:
+        weather = pd.read_csv(args.weather, index_col=0, parse_dates=True)
+    else:
+        parser.error('Give weather data with --weather or --merra')
+
+    yields, fleet_ac = run_fleet(fleet, weather, freq=args.freq,
+                                 workers=args.workers,
+                                 surrogate_dc=args.surrogate)
+    write_to_csv(os.path.join(args.output, 'fleet_yields.csv'), yields,
+                 append=False, index=False)
+    write_to_csv(os.path.join(args.output, 'fleet_ac.csv'),
+                 fleet_ac.to_frame(), append=False)
+    log.info(f'Fleet AC energy: {yields["ac_kwh"].sum() / 1000:.1f} MWh')
+    log.info(instrumentation.summary().to_string())
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+HTW-PV3 - Instrumentation of pipeline runs
+
+Record wall time, CPU time, rows and peak memory per pipeline stage;
+Report the records as DataFrame or JSON and append them to a metrics file;
+
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+__copyright__ = "© Ludwig Hülk"
+__license__ = "GNU Affero General Public License Version 3 (AGPL-3.0)"
+__url__ = "https://www.gnu.org/licenses/agpl-3.0.en.html"
+__author__ = "Ludee;"
+__version__ = "v0.0.2"
+
+import datetime
+import functools
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of the process in MB.
+
+    Uses `resource` on Unix and `psutil` on Windows, returns None if
+    neither is available.
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+    try:
+        import psutil
+    except ImportError:
+        return None
+    memory_info = psutil.Process().memory_info()
+    return getattr(memory_info, 'peak_wset', memory_info.rss) / 1e6
+
+
+def format_record(record):
+    """Formats a stage record as one log line."""
+    fields = ', '.join(f'{key}={value}' for key, value in record.items()
+                       if key not in ['stage', 'wall_s', 'cpu_s', 'rows',
+                                      'peak_rss_mb', 'peak_rss_increase_mb',
+                                      'start', 'pid'])
+    message = (f'Stage {record["stage"]}'
+               f'{f" ({fields})" if fields else ""}: '
+               f'{record["wall_s"]:.3f} s wall, {record["cpu_s"]:.3f} s CPU')
+    if record.get('rows') is not None:
+        message += f', {record["rows"]} rows'
+    if record.get('peak_rss_mb') is not None:
+        message += (f', peak RSS {record["peak_rss_mb"]:.0f} MB '
+                    f'(+{record["peak_rss_increase_mb"]:.0f} MB)')
+    return message
+
+
+class Instrumentation:
+    """
+    Collects timing and memory records of pipeline stages.
+
+    Each record holds the stage name, optional fields (e.g. system and
+    weather of a scenario), the number of rows processed, wall and CPU time
+    in seconds, the peak RSS of the process at the end of the stage and its
+    increase during the stage.
+
+    Parameters
+    ----------
+    log_records : :obj:`bool`
+        If True, log every record when it is added. Default: True.
+
+    """
+
+    def __init__(self, log_records=True):
+        self.log_records = log_records
+        self.records = []
+
+    @contextmanager
+    def stage(self, name, rows=None, **fields):
+        """
+        Context manager that records one stage.
+
+        The yielded record can be updated inside the block, e.g. to set the
+        number of rows once it is known.
+
+        Parameters
+        ----------
+        name : :obj:`str`
+            Name of the stage, e.g. 'load' or 'modelchain'.
+        rows : :obj:`int`, optional
+            Number of rows processed.
+        fields
+            Additional fields of the record, e.g. system and weather.
+
+        """
+        record = {'stage': name, **fields, 'rows': rows}
+        start = datetime.datetime.now().isoformat(timespec='seconds')
+        peak_start = peak_rss_mb()
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['wall_s'] = time.perf_counter() - wall_start
+            record['cpu_s'] = time.process_time() - cpu_start
+            record['peak_rss_mb'] = peak_rss_mb()
+            record['peak_rss_increase_mb'] = (
+                None if peak_start is None
+                else record['peak_rss_mb'] - peak_start)
+            record['start'] = start
+            record['pid'] = os.getpid()
+            self.add(record)
+
+    def add(self, record):
+        """Adds a record, e.g. one returned by a worker process."""
+        self.records.append(record)
+        if self.log_records:
+            log.info(format_record(record))
+
+    def clear(self):
+        """Removes all records."""
+        self.records = []
+
+    def report(self):
+        """
+        Returns all records.
+
+        Returns
+        -------
+        :pandas:`DataFrame`
+            One row per record.
+
+        """
+        return pd.DataFrame(self.records)
+
+    def summary(self):
+        """
+        Returns the records aggregated per stage.
+
+        Returns
+        -------
+        :pandas:`DataFrame`
+            Number of calls, sums of wall time, CPU time and rows and the
+            maximum peak RSS increase per stage, sorted by wall time.
+
+        """
+        df = self.report()
+        if df.empty:
+            return df
+        return (df.groupby('stage', sort=False)
+                .agg(calls=('wall_s', 'size'), wall_s=('wall_s', 'sum'),
+                     cpu_s=('cpu_s', 'sum'), rows=('rows', 'sum'),
+                     peak_rss_increase_mb=('peak_rss_increase_mb', 'max'))
+                .sort_values('wall_s', ascending=False))
+
+    def to_json(self):
+        """Returns all records as JSON array."""
+        return json.dumps(self.records, default=str)
+
+    def write_metrics(self, file_name, **run_fields):
+        """
+        Appends all records to a JSON lines metrics file.
+
+        Parameters
+        ----------
+        file_name : :obj:`str`
+            Name of the metrics file.
+        run_fields
+            Fields added to every line, e.g. the data version.
+
+        """
+        directory = os.path.dirname(file_name)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(file_name, 'a') as f:
+            for record in self.records:
+                f.write(json.dumps({**run_fields, **record}, default=str)
+                        + '\n')
+        log.info(f'Write {len(self.records)} stage records to file: '
+                 f'{file_name}')
+
+
+# records of the current run
+instrumentation = Instrumentation()
+
+
+def stage(name, rows=None, **fields):
+    """Records a stage in `instrumentation`, see `Instrumentation.stage`."""
+    return instrumentation.stage(name, rows=rows, **fields)
+
+
+def instrumented(name, rows=None):
+    """
+    Decorator that records every call of a function as a stage.
+
+    Parameters
+    ----------
+    name : :obj:`str`
+        Name of the stage.
+    rows : callable, optional
+        Function that returns the number of rows processed from the first
+        argument of the decorated function, e.g. `len`.
+
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name, rows=rows(args[0]) if rows else None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+HTW-PV3 - Fit sandia inverters to datasheet efficiency tables
+
+Read efficiency tables of many inverters from CSV or JSON datasheets;
+Build the AC and DC power arrays of `pvlib.inverter.fit_sandia` from the
+tables without Python loops;
+Fit all inverters in a process pool, skipping datasheets that are unchanged
+since the last fit;
+Store the fitted parameters in a versioned local catalogue;
+
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+__copyright__ = "© Ludwig Hülk"
+__license__ = "GNU Affero General Public License Version 3 (AGPL-3.0)"
+__url__ = "https://www.gnu.org/licenses/agpl-3.0.en.html"
+__author__ = "Ludee;"
+__version__ = "v0.0.2"
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import pvlib
+
+from settings import setup_logger, INVERTER_CATALOGUE, MODEL_WORKERS
+from pv3_cache import LRUCache, fingerprint
+from pv3_instrumentation import instrumentation, stage
+
+import logging
+log = logging.getLogger(__name__)
+
+# power points of the efficiency tables as fraction of the nominal DC power
+POWER_POINTS = [0., 0.2, 0.3, 0.5, 0.75, 1.]
+# DC voltage levels of `pvlib.inverter.fit_sandia`
+VOLTAGE_LEVELS = ['Vmin', 'Vnom', 'Vmax']
+# scalar datasheet values
+DATASHEET_KEYS = ['p_dc_nom', 'p_ac_0', 'p_nt']
+
+# format version of the inverter catalogue file
+CATALOGUE_FORMAT = 1
+
+# loaded inverter catalogues, keyed by file name and modification time
+_inverter_catalogues = LRUCache(maxsize=4)
+
+
+def sandia_fit_arrays(efficiency, dc_voltage, p_dc_nom,
+                      power_points=POWER_POINTS):
+    """
+    Builds the input arrays of `pvlib.inverter.fit_sandia` from an
+    efficiency table.
+
+    The DC current is assumed equal at all voltage levels, i.e. every level
+    uses the same DC power points.
+
+    Parameters
+    ----------
+    efficiency : :numpy:`array`
+        Efficiency of shape (3, power points), one row per voltage level of
+        `VOLTAGE_LEVELS`.
+    dc_voltage : :numpy:`array`
+        DC voltage at min, nom and max.
+    p_dc_nom : :obj:`float`
+        Nominal DC power in W.
+    power_points : :numpy:`array`
+        Power points as fraction of `p_dc_nom`. Default: `POWER_POINTS`.
+
+    Returns
+    -------
+    :obj:`tuple`
+        ac_power, dc_power, dc_voltage and dc_voltage_level as flat arrays.
+
+    """
+    efficiency = np.asarray(efficiency, dtype=np.float64)
+    p_dc = np.asarray(power_points, dtype=np.float64) * p_dc_nom
+    count = len(p_dc)
+    return ((efficiency * p_dc).ravel(),
+            np.tile(p_dc, len(VOLTAGE_LEVELS)),
+            np.repeat(np.asarray(dc_voltage, dtype=np.float64), count),
+            np.repeat(VOLTAGE_LEVELS, count))
+
+
+def _validate_datasheet(datasheet):
+    """Returns the problems of a datasheet."""
+    name = datasheet.get('name')
+    errors = [f'inverter {name}: missing {key}' for key in
+              DATASHEET_KEYS + ['dc_voltage', 'efficiency']
+              if datasheet.get(key) is None]
+    if errors:
+        return errors
+    efficiency = datasheet['efficiency']
+    if len(efficiency) != len(VOLTAGE_LEVELS) or \
+            any(len(row) != len(datasheet['power_points'])
+                for row in efficiency):
+        errors.append(f'inverter {name}: efficiency table needs '
+                      f'{len(datasheet["power_points"])} power points at '
+                      f'{len(VOLTAGE_LEVELS)} voltage levels')
+    elif not all(value is not None and 0 <= value <= 1
+                 for row in efficiency for value in row):
+        errors.append(f'inverter {name}: efficiency must be between 0 and 1')
+    if len(datasheet['dc_voltage']) != len(VOLTAGE_LEVELS) or \
+            None in datasheet['dc_voltage']:
+        errors.append(f'inverter {name}: dc_voltage needs min, nom and max')
+    return errors
+
+
+def _datasheet(name, p_dc_nom, p_ac_0, p_nt, dc_voltage, efficiency,
+               power_points=None, source=None):
+    """
+    Returns a datasheet dictionary with floats and lists of floats, missing
+    values are None.
+    """
+    def number(value):
+        return None if value is None or pd.isna(value) else float(value)
+
+    return {'name': str(name), 'p_dc_nom': number(p_dc_nom),
+            'p_ac_0': number(p_ac_0), 'p_nt': number(p_nt),
+            'dc_voltage': None if dc_voltage is None else
+            [number(value) for value in dc_voltage],
+            'power_points': [float(value) for value in
+                             (POWER_POINTS if power_points is None
+                              else power_points)],
+            'efficiency': None if efficiency is None else
+            [[number(value) for value in row] for row in efficiency],
+            'source': source}
+
+
+def read_csv_datasheets(file_name):
+    """
+    Reads efficiency tables from a CSV file.
+
+    One row per inverter and voltage level with the columns 'name',
+    'voltage_level' (Vmin, Vnom, Vmax), 'dc_voltage', 'p_dc_nom', 'p_ac_0',
+    'p_nt' and one column 'eta_<percent>' per power point, e.g. 'eta_0',
+    'eta_20', ..., 'eta_100'.
+
+    Returns
+    -------
+    :obj:`list`
+        Datasheet dictionaries.
+
+    """
+    df = pd.read_csv(file_name)
+    eta_columns = sorted([column for column in df.columns
+                          if column.startswith('eta_')],
+                         key=lambda column: float(column[4:]))
+    power_points = [float(column[4:]) / 100 for column in eta_columns]
+    df = df[df['voltage_level'].isin(VOLTAGE_LEVELS)]
+    df = df.assign(level=df['voltage_level'].map(
+        VOLTAGE_LEVELS.index)).sort_values(['name', 'level'])
+
+    datasheets = []
+    for name, rows in df.groupby('name', sort=False):
+        first = rows.iloc[0]
+        datasheets.append(_datasheet(
+            name, first['p_dc_nom'], first['p_ac_0'], first['p_nt'],
+            rows['dc_voltage'].values, rows[eta_columns].values,
+            power_points=power_points, source=file_name))
+    return datasheets
+
+
+def read_json_datasheets(file_name):
+    """
+    Reads efficiency tables from a JSON file with one datasheet object or a
+    list of them.
+
+    A datasheet object has the keys 'name', 'p_dc_nom', 'p_ac_0', 'p_nt',
+    'dc_voltage' (min, nom, max), 'efficiency' (mapping of `VOLTAGE_LEVELS`
+    to efficiencies) and optionally 'power_points' (default:
+    `POWER_POINTS`).
+
+    Returns
+    -------
+    :obj:`list`
+        Datasheet dictionaries.
+
+    """
+    with open(file_name, encoding='utf-8') as f:
+        content = json.load(f)
+    if isinstance(content, dict):
+        content = [content]
+    datasheets = []
+    for entry in content:
+        efficiency = entry.get('efficiency')
+        if isinstance(efficiency, dict):
+            efficiency = [efficiency.get(level, []) for level in
+                          VOLTAGE_LEVELS]
+        datasheets.append(_datasheet(
+            entry.get('name'), entry.get('p_dc_nom'), entry.get('p_ac_0'),
+            entry.get('p_nt'), entry.get('dc_voltage'), efficiency,
+            power_points=entry.get('power_points'), source=file_name))
+    return datasheets
+
+
+def read_datasheets(file_names):
+    """
+    Reads and validates the datasheets of CSV and JSON files.
+
+    Raises
+    ------
+    ValueError
+        Listing all invalid or duplicate datasheets.
+
+    """
+    if isinstance(file_names, str):
+        file_names = [file_names]
+    datasheets = []
+    for file_name in file_names:
+        if file_name.lower().endswith('.json'):
+            datasheets += read_json_datasheets(file_name)
+        else:
+            datasheets += read_csv_datasheets(file_name)
+
+    errors = []
+    names = set()
+    for datasheet in datasheets:
+        errors += _validate_datasheet(datasheet)
+        if datasheet['name'] in names:
+            errors.append(f'inverter {datasheet["name"]}: duplicate name')
+        names.add(datasheet['name'])
+    if errors:
+        raise ValueError('Invalid inverter datasheets:\n' +
+                         '\n'.join(errors))
+    log.info(f'Read {len(datasheets)} inverter datasheets from '
+             f'{len(file_names)} files')
+    return datasheets
+
+
+def datasheet_hash(datasheet):
+    """Returns the content hash of the fit inputs of a datasheet."""
+    return fingerprint('sandia', pvlib.__version__,
+                       {key: datasheet[key] for key in
+                        DATASHEET_KEYS + ['dc_voltage', 'power_points',
+                                          'efficiency']})
+
+
+def fit_datasheet(datasheet):
+    """
+    Fits the sandia inverter model to the efficiency table of a datasheet.
+
+    Returns
+    -------
+    :obj:`dict`
+        Sandia inverter parameters.
+
+    """
+    ac_power, dc_power, dc_voltage, dc_voltage_level = sandia_fit_arrays(
+        datasheet['efficiency'], datasheet['dc_voltage'],
+        datasheet['p_dc_nom'], power_points=datasheet['power_points'])
+    inverter = pvlib.inverter.fit_sandia(
+        ac_power, dc_power, dc_voltage, dc_voltage_level,
+        datasheet['p_ac_0'], datasheet['p_nt'])
+    return {key: float(value) for key, value in inverter.items()}
+
+
+class InverterCatalogue:
+    """
+    Versioned local catalogue of fitted sandia inverters.
+
+    Every inverter is stored with its parameters, the hash of its datasheet
+    and the source file. The version is increased whenever inverters are
+    added, refitted or removed.
+
+    Parameters
+    ----------
+    file_name : :obj:`str`
+        JSON file of the catalogue. Default: `settings.INVERTER_CATALOGUE`.
+
+    """
+
+    def __init__(self, file_name=INVERTER_CATALOGUE):
+        self.file_name = file_name
+        self.version = 0
+        self.inverters = {}
+        if os.path.isfile(file_name):
+            with open(file_name, encoding='utf-8') as f:
+                content = json.load(f)
+            self.version = content['version']
+            self.inverters = content['inverters']
+
+    def __len__(self):
+        return len(self.inverters)
+
+    def __contains__(self, name):
+        return name in self.inverters
+
+    def parameters(self, name):
+        """Returns the sandia parameters of an inverter."""
+        if name not in self.inverters:
+            raise KeyError(f'Inverter {name} not in inverter catalogue '
+                           f'{self.file_name}')
+        return dict(self.inverters[name]['parameters'])
+
+    def is_current(self, datasheet):
+        """Returns True if the datasheet is fitted and unchanged."""
+        entry = self.inverters.get(datasheet['name'])
+        return entry is not None and \
+            entry['datasheet_hash'] == datasheet_hash(datasheet)
+
+    def update(self, fitted):
+        """
+        Adds or replaces fitted inverters and increases the version.
+
+        Parameters
+        ----------
+        fitted : :obj:`list`
+            Tuples (datasheet, parameters).
+
+        """
+        if not fitted:
+            return
+        for datasheet, parameters in fitted:
+            self.inverters[datasheet['name']] = {
+                'parameters': parameters,
+                'datasheet_hash': datasheet_hash(datasheet),
+                'source': datasheet.get('source')}
+        self.version += 1
+
+    def remove(self, names):
+        """Removes inverters and increases the version."""
+        names = [name for name in names if name in self.inverters]
+        for name in names:
+            del self.inverters[name]
+        if names:
+            self.version += 1
+
+    def write(self):
+        """Writes the catalogue via a temporary file."""
+        directory = os.path.dirname(self.file_name)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        content = {'format': CATALOGUE_FORMAT, 'version': self.version,
+                   'pvlib': pvlib.__version__,
+                   'updated': datetime.now(timezone.utc).isoformat(
+                       timespec='seconds'),
+                   'inverters': self.inverters}
+        tmp_file = f'{self.file_name}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(content, f, indent=1, sort_keys=True)
+        os.replace(tmp_file, self.file_name)
+        log.info(f'Write {len(self)} inverters (version {self.version}) to '
+                 f'file: {self.file_name}')
+
+
+def fit_inverters(datasheets, catalogue=None, workers=None, refit=False):
+    """
+    Fits the sandia inverter model for many datasheets.
+
+    Datasheets that are fitted and unchanged in the catalogue are skipped,
+    the others are fitted in a process pool (stage 'inverter_fit') and
+    added to the catalogue, which is then written.
+
+    Parameters
+    ----------
+    datasheets : :obj:`list`
+        Datasheet dictionaries, see `read_datasheets`.
+    catalogue : :class:`InverterCatalogue`, optional
+        Default: None (catalogue of `settings.INVERTER_CATALOGUE`).
+    workers : :obj:`int`, optional
+        Number of worker processes. If 1, all inverters are fitted in the
+        main process. Default: None (`settings.MODEL_WORKERS`, if that is
+        None too the number of CPUs).
+    refit : :obj:`bool`
+        If True, fit all datasheets. Default: False.
+
+    Returns
+    -------
+    :class:`InverterCatalogue`
+
+    """
+    if catalogue is None:
+        catalogue = InverterCatalogue()
+    pending = [datasheet for datasheet in datasheets
+               if refit or not catalogue.is_current(datasheet)]
+    log.info(f'Fit {len(pending)} of {len(datasheets)} inverters')
+
+    with stage('inverter_fit', rows=len(pending)):
+        if workers is None:
+            workers = MODEL_WORKERS or os.cpu_count()
+        workers = min(workers, len(pending))
+        if workers <= 1:
+            parameters = [fit_datasheet(datasheet) for datasheet in pending]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                parameters = list(pool.map(fit_datasheet, pending,
+                                           chunksize=16))
+
+    catalogue.update(list(zip(pending, parameters)))
+    if pending:
+        catalogue.write()
+    return catalogue
+
+
+def get_inverter_catalogue(file_name=INVERTER_CATALOGUE):
+    """
+    Returns the :class:`InverterCatalogue` of a file, read once and kept in
+    memory as long as the file is unchanged.
+    """
+    if not os.path.isfile(file_name):
+        raise FileNotFoundError(f'Inverter catalogue {file_name} not found, '
+                                f'create it with pv3_inverter_fitting.py')
+    key = (os.path.abspath(file_name), os.path.getmtime(file_name))
+    catalogue = _inverter_catalogues.get(key)
+    if catalogue is None:
+        catalogue = InverterCatalogue(file_name)
+        _inverter_catalogues.put(key, catalogue)
+    return catalogue
+
+
+def get_fitted_inverter(name, file_name=INVERTER_CATALOGUE):
+    """Returns the sandia parameters of a fitted inverter."""
+    return get_inverter_catalogue(file_name).parameters(name)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('datasheets', nargs='+',
+                        help='CSV or JSON files with efficiency tables')
+    parser.add_argument('--catalogue', default=INVERTER_CATALOGUE)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--refit', action='store_true',
+                        help='Fit unchanged datasheets again')
+    args = parser.parse_args()
+
+    log = setup_logger()
+    datasheets = read_datasheets(args.datasheets)
+    catalogue = fit_inverters(datasheets,
+                              catalogue=InverterCatalogue(args.catalogue),
+                              workers=args.workers, refit=args.refit)
+    log.info(f'Inverter catalogue {catalogue.file_name} version '
+             f'{catalogue.version} with {len(catalogue)} inverters')
+    log.info(instrumentation.summary().to_string())
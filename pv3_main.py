@@ -16,11 +16,17 @@ __url__ = "https://www.gnu.org/licenses/agpl-3.0.en.html"
 __author__ = "Ludee;"
 __version__ = "v0.0.2"
 
-from settings import setup_logger, postgres_session, query_database, read_from_csv, write_to_csv, HTW_LON, HTW_LAT
-from pv3_sonnja_pvlib import setup_pvlib_location_object, setup_modelchain, run_modelchain, setup_htw_pvsystem_wr3, \
-    setup_htw_pvsystem_wr4, setup_htw_pvsystem_wr2, setup_htw_pvsystem_wr1, setup_htw_pvsystem_wr5
-from pv3_weatherdata import calculate_diffuse_irradiation
-from pv3_results import results_modelchain, results_modelchain_annual_yield, results_modelchain_per_month
+from settings import setup_logger, postgres_session, query_database, read_from_csv, write_to_csv, \
+    MODEL_WORKERS, RUN_CACHE_DIR
+from pv3_sonnja_pvlib import setup_pvlib_location_object, run_modelchain_scenarios
+from pv3_catalogue import get_system_catalogue
+from pv3_weatherdata import setup_htw_pvlib_weather, setup_fred_pvlib_weather, HTW_WEATHERDATA_NAMES, \
+    PVLIB_WEATHER_COLUMNS
+from pv3_results import results_modelchain, results_modelchain_annual_yield, results_modelchain_per_month, \
+    modelchain_results, CsvResultSink, ParquetResultSink
+from pv3_streaming import run_chunked_pipeline
+from pv3_cache import RunCache
+from pv3_instrumentation import instrumentation, stage
 
 import pandas as pd
 from sqlalchemy import *
@@ -30,6 +36,33 @@ import time
 
 DATA_VERSION = 'htw_pv3_v0.0.1'
 
+# PV systems of the system catalogue (settings.SYSTEM_CATALOGUE)
+PV_SYSTEMS = ['wr1', 'wr2', 'wr3', 'wr4', 'wr5']
+
+# run the model period by period (e.g. 'M') to bound memory usage,
+# None reads the complete weather data at once
+STREAMING_FREQ = None
+CHUNKSIZE = 100000
+
+# format of the result files, 'parquet' or 'csv'
+RESULT_FORMAT = 'parquet'
+# additionally export CSV files if RESULT_FORMAT is 'parquet'
+RESULT_CSV_EXPORT = False
+
+# reuse stored ModelChain runs of unchanged scenarios
+USE_RUN_CACHE = True
+
+# interpolate DC output in precomputed diode tables of the modules instead of
+# solving the single diode equation (pv3_surrogate), error below 0.06 % of
+# STC power with the default grids
+SURROGATE_DC = False
+# (irradiance, temperature) grid of the diode tables, None uses the default
+# grids of pv3_surrogate
+SURROGATE_GRID = None
+
+# append timing and memory of all stages to this file, None only logs them
+METRICS_FILE = None
+
 if __name__ == "__main__":
 
     """logging"""
@@ -40,73 +73,100 @@ if __name__ == "__main__":
     con = postgres_session()
     log.info(f'PV3 model started with data version: {DATA_VERSION}')
 
-    """Read data"""
-    # read htw weatherdata from file
-    # fn_htw = r'.\data\pv3_2015\pv3_weather_2015_filled_mview.csv'
-    # df_htw_file = read_from_csv(fn_htw)
-    # fn_fred = r'.\data\pv3_2015\openfred_weatherdata_2015_htw.csv'
-    # df_fred_file = read_from_csv(fn_fred, sep=',')
-
-    # read htw weatherdata from sonnja_db
-    # ToDO: Create function for weather data import
-    schema = 'pv3'
-    table = 'pv3_weather_2015_filled_mview'
-    df_htw = query_database(con, schema, table)
-
-    htw_weatherdata_names = {"g_hor_si": "ghi",
-                             'v_wind': "wind_speed",
-                             't_luft': "temp_air",
-                             }
-    df_htw = df_htw.rename(columns=htw_weatherdata_names)
-    df_dhi = calculate_diffuse_irradiation(df_htw, "ghi", HTW_LAT, HTW_LON)
-    df_htw = df_htw.merge(df_dhi[['dhi', 'dni']], left_index=True, right_index=True)
-    df_htw_select = df_htw.loc[:, ["ghi", "dhi", 'dni', "wind_speed", "temp_air"]]
-    df_htw_pvlib = df_htw_select.resample('H').mean()
-    df_htw_pvlib = df_htw_pvlib.round(1)
-
-    # read open_FRED weatherdata from sonnja_db
-    schema = 'pv3'
-    table = 'openfred_weatherdata_2015_htw'
-    df_fred = query_database(con, schema, table)
-    df_fred_select = df_fred.loc[:, ["ghi", "dhi", 'dni', "wind_speed", "temp_air"]]
-    df_fred_pvlib = df_fred_select.resample('H').mean()
-    df_fred_pvlib = df_fred_pvlib.round(1)
-
-    """Run pvlib model"""
+    """Setup pvlib model"""
     # location
     htw_location = setup_pvlib_location_object()
 
     # pv system
-    wr1 = setup_htw_pvsystem_wr1()
-    wr2 = setup_htw_pvsystem_wr2()
-    wr3 = setup_htw_pvsystem_wr3()
-    wr4 = setup_htw_pvsystem_wr4()
-    wr5 = setup_htw_pvsystem_wr5()
-    pv_systems = [wr1, wr2, wr3, wr4, wr5]
-    weather = ['fred', 'htw']
-    # ToDo: include second loop with weather
-
-    # model chain
-    for idx, system in enumerate(pv_systems):
-        # setup Modelchain
-        mc_fred = setup_modelchain(system, htw_location)
-        mc_htw = setup_modelchain(system, htw_location)
-
-        # run modelchain
-        run_modelchain(mc_fred, df_fred_pvlib)
-        run_modelchain(mc_htw, df_htw_pvlib)
+    with stage('system_setup', rows=len(PV_SYSTEMS)):
+        pv_systems = get_system_catalogue().systems(PV_SYSTEMS)
 
+    schema = 'pv3'
+    table_htw = 'pv3_weather_2015_filled_mview'
+    table_fred = 'openfred_weatherdata_2015_htw'
+    # only needed columns are read, open_FRED is averaged hourly by the database
+    columns_htw = list(HTW_WEATHERDATA_NAMES)
+    columns_fred = PVLIB_WEATHER_COLUMNS
+
+    run_cache = RunCache(RUN_CACHE_DIR, DATA_VERSION) if USE_RUN_CACHE else None
+
+    """Setup result export"""
+    if RESULT_FORMAT == 'parquet':
+        sink = ParquetResultSink(csv_export=RESULT_CSV_EXPORT)
+    else:
+        sink = CsvResultSink()
+
+    if STREAMING_FREQ:
+        """Run pvlib model period by period"""
+        chunks_fred = query_database(con, schema, table_fred,
+                                     columns=columns_fred, resample='hour',
+                                     chunksize=CHUNKSIZE)
+        run_chunked_pipeline(chunks_fred, setup_fred_pvlib_weather,
+                             pv_systems, htw_location, 'fred',
+                             freq=STREAMING_FREQ, workers=MODEL_WORKERS,
+                             sink=sink, run_cache=run_cache,
+                             surrogate_dc=SURROGATE_DC,
+                             surrogate_grid=SURROGATE_GRID)
+        chunks_htw = query_database(con, schema, table_htw,
+                                    columns=columns_htw, chunksize=CHUNKSIZE)
+        run_chunked_pipeline(chunks_htw, setup_htw_pvlib_weather,
+                             pv_systems, htw_location, 'htw',
+                             freq=STREAMING_FREQ, workers=MODEL_WORKERS,
+                             sink=sink, run_cache=run_cache,
+                             surrogate_dc=SURROGATE_DC,
+                             surrogate_grid=SURROGATE_GRID)
+
+    else:
+        """Read data"""
+        # read htw weatherdata from file
+        # fn_htw = r'.\data\pv3_2015\pv3_weather_2015_filled_mview.csv'
+        # df_htw_file = read_from_csv(fn_htw)
+        # fn_fred = r'.\data\pv3_2015\openfred_weatherdata_2015_htw.csv'
+        # df_fred_file = read_from_csv(fn_fred, sep=',')
+
+        # read htw weatherdata from sonnja_db
+        with stage('load', weather='htw') as record:
+            df_htw = query_database(con, schema, table_htw,
+                                    columns=columns_htw)
+            record['rows'] = len(df_htw)
+        df_htw_pvlib = setup_htw_pvlib_weather(df_htw)
+
+        # read open_FRED weatherdata from sonnja_db
+        with stage('load', weather='fred') as record:
+            df_fred = query_database(con, schema, table_fred,
+                                     columns=columns_fred, resample='hour')
+            record['rows'] = len(df_fred)
+        df_fred_pvlib = setup_fred_pvlib_weather(df_fred)
+
+        """Run pvlib model"""
+        weather_data = {'fred': df_fred_pvlib,
+                        'htw': df_htw_pvlib}
+
+        # model chain
+        scenarios = run_modelchain_scenarios(pv_systems, weather_data,
+                                             htw_location,
+                                             workers=MODEL_WORKERS,
+                                             run_cache=run_cache,
+                                             surrogate_dc=SURROGATE_DC,
+                                             surrogate_grid=SURROGATE_GRID)
 
         """Export results"""
-        df_fred = results_modelchain(mc_fred, 'fred')
-        df_month_fred = results_modelchain_per_month(mc_fred, df_fred, 'fred')
-        annual_yield_fred = results_modelchain_annual_yield(mc_fred, 'fred')
-
-        df_htw = results_modelchain(mc_htw, 'htw')
-        df_month_htw = results_modelchain_per_month(mc_htw, df_htw, 'htw')
-        annual_yield_htw = results_modelchain_annual_yield(mc_htw, 'htw')
-
+        for system_name, weather, mc in scenarios:
+            with stage('export', rows=len(modelchain_results(mc).ac),
+                       system=system_name, weather=weather):
+                df_mc = results_modelchain(mc, weather, sink=sink)
+                df_month = results_modelchain_per_month(mc, df_mc, weather,
+                                                        sink=sink)
+                annual_yield = results_modelchain_annual_yield(mc, weather,
+                                                               sink=sink)
+
+    with stage('export_close'):
+        sink.close()
 
     """close"""
+    log.info(f'Stage summary:\n{instrumentation.summary().to_string()}')
+    if METRICS_FILE:
+        instrumentation.write_metrics(METRICS_FILE,
+                                      data_version=DATA_VERSION)
     log.info('PV3 SonnJA pvlib model successfully executed in {:.2f} seconds'
              .format(time.time() - start_time))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+HTW-PV3 - MERRA weather data store
+
+Parse a MERRA csv file once into (site x time) arrays;
+Look up the nearest grid points of many sites;
+Run decomposition models for many sites in one vectorized pass;
+
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+__copyright__ = "© Ludwig Hülk"
+__license__ = "GNU Affero General Public License Version 3 (AGPL-3.0)"
+__url__ = "https://www.gnu.org/licenses/agpl-3.0.en.html"
+__author__ = "Ludee;"
+__version__ = "v0.0.2"
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from pv3_cache import LRUCache
+from pv3_spatial import get_grid_index, site_codes
+from pv3_decomposition import apply_decomposition_model_sites
+
+import logging
+log = logging.getLogger(__name__)
+
+# MERRA variable names to pvlib names
+MERRA_VARIABLE_NAMES = {'T': 'temp_air', 'v_50m': 'wind_speed',
+                        'p': 'pressure', 'SWTDN': 'i0_h', 'SWGDN': 'ghi'}
+
+# parsed MERRA files, keyed by file name and modification time
+_merra_stores = LRUCache(maxsize=2)
+
+
+class MerraStore:
+    """
+    MERRA weather data of all grid points as (site x time) arrays.
+
+    Parameters
+    ----------
+    times : :pandas:`DatetimeIndex`
+        Time index in local time.
+    latitude, longitude : :numpy:`array`
+        Coordinates of the grid points, shape (sites,).
+    data : :obj:`dict`
+        Variable names (pvlib names, temperature in °C) as keys and arrays
+        of shape (sites, timesteps) as values, in the column order of the
+        csv file.
+
+    """
+
+    def __init__(self, times, latitude, longitude, data):
+        self.times = times
+        self.latitude = np.asarray(latitude, dtype=np.float64)
+        self.longitude = np.asarray(longitude, dtype=np.float64)
+        self.data = data
+        self._grid_index = None
+
+    @classmethod
+    def from_csv(cls, file_name, dtype=np.float64):
+        """
+        Parses a MERRA csv file with columns 'lat', 'lon' and one column per
+        variable, indexed by time (UTC). Non-numeric columns are skipped.
+        """
+        df = pd.read_csv(file_name, header=[0], index_col=[0],
+                         parse_dates=True)
+        time_codes, times = pd.factorize(df.index, sort=True)
+        sites, latitude, longitude = site_codes(df)
+
+        data = {}
+        columns = df.select_dtypes('number').columns.drop(['lat', 'lon'])
+        for column in columns:
+            values = np.full((len(latitude), len(times)), np.nan,
+                             dtype=dtype)
+            values[sites, time_codes] = df[column].values
+            data[MERRA_VARIABLE_NAMES.get(column, column)] = values
+        if 'temp_air' in data:
+            data['temp_air'] -= 273.15
+
+        times = pd.DatetimeIndex(times, name=df.index.name) \
+            .tz_localize('UTC').tz_convert('Europe/Berlin')
+        log.info(f'Read {len(latitude)} MERRA sites with {len(times)} '
+                 f'timesteps from file: {file_name}')
+        return cls(times, latitude, longitude, data)
+
+    def __len__(self):
+        return len(self.latitude)
+
+    def nearest_sites(self, latitude, longitude):
+        """
+        Returns the indices of the grid points closest to the given
+        coordinates (scalars or arrays), see `pv3_spatial.GridIndex`.
+        """
+        if self._grid_index is None:
+            self._grid_index = get_grid_index(self.latitude, self.longitude,
+                                              dataset='merra')
+        return self._grid_index.query(latitude, longitude)
+
+    def select(self, sites, variables=None):
+        """
+        Returns the data of the given site indices.
+
+        Returns
+        -------
+        :obj:`dict`
+            Arrays of shape (len(sites), timesteps) per variable.
+
+        """
+        return {variable: self.data[variable][sites]
+                for variable in variables or self.data}
+
+    def get_site_data(self, site):
+        """
+        Returns the data of one site in the format of
+        `pv3_pvlib_sonnja.load_merra_data`.
+        """
+        df = pd.DataFrame({variable: values[site]
+                           for variable, values in self.data.items()},
+                          index=self.times)
+        df.insert(0, 'lon', self.longitude[site])
+        df.insert(0, 'lat', self.latitude[site])
+        return df
+
+    def decompose(self, latitude, longitude, model='reindl', altitude=0):
+        """
+        Applies a decomposition model at many sites in one pass, each site
+        with the weather data of its closest grid point.
+
+        Parameters
+        ----------
+        latitude, longitude : :numpy:`array`
+            Coordinates of the sites.
+        model : :obj:`str`
+            'reindl', 'erbs' or 'disc'. Default: 'reindl'.
+        altitude : :numpy:`array` or :obj:`float`
+            Altitude of the sites in m. Default: 0.
+
+        Returns
+        -------
+        :obj:`dict`
+            Arrays of shape (sites, timesteps), see
+            `pv3_decomposition.apply_decomposition_model_sites`.
+
+        """
+        sites = self.nearest_sites(latitude, longitude)
+        return apply_decomposition_model_sites(
+            self.select(sites), self.times, latitude, longitude, model,
+            altitude=altitude)
+
+
+def get_merra_store(year, directory):
+    """
+    Returns the :class:`MerraStore` of `weather_data_GER_{year}.csv`.
+
+    The file is parsed once and kept in memory as long as it is unchanged.
+    """
+    file_name = os.path.join(directory, f'weather_data_GER_{year}.csv')
+    key = (os.path.abspath(file_name), os.path.getmtime(file_name))
+    store = _merra_stores.get(key)
+    if store is None:
+        store = MerraStore.from_csv(file_name)
+        _merra_stores.put(key, store)
+    return store
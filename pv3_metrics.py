@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+HTW-PV3 - Comparison metrics of time series
+
+Calculate correlation, RMSE, MBE and nMAE for many column pairs and
+resample rules from sums per period of one aligned array;
+Return the metrics as long table with one row per rule, period and pair;
+
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+__copyright__ = "© Ludwig Hülk"
+__license__ = "GNU Affero General Public License Version 3 (AGPL-3.0)"
+__url__ = "https://www.gnu.org/licenses/agpl-3.0.en.html"
+__author__ = "Ludee;"
+__version__ = "v0.0.2"
+
+import numpy as np
+import pandas as pd
+
+import logging
+log = logging.getLogger(__name__)
+
+METRICS = ['n', 'corr', 'rmse', 'mbe', 'nmae']
+
+# sums per period and pair, x: reference, y: compared column, d = y - x,
+# x and y shifted by their mean to avoid cancellation in the (co)variances
+_SUMS = ['n', 'x', 'y', 'xx', 'yy', 'xy', 'd', 'dd', 'ad']
+
+
+def _pair_sums(df, pairs):
+    """
+    Returns the per row terms of `_SUMS` of all pairs as array of shape
+    (rows, len(_SUMS), pairs) and the means of the reference columns.
+    """
+    reference = df[[pair[0] for pair in pairs]].to_numpy(dtype=np.float64)
+    column = df[[pair[1] for pair in pairs]].to_numpy(dtype=np.float64)
+    valid = ~(np.isnan(reference) | np.isnan(column))
+    reference = np.where(valid, reference, 0.)
+    column = np.where(valid, column, 0.)
+    count = np.maximum(valid.sum(axis=0), 1)
+    reference_mean = reference.sum(axis=0) / count
+    column_mean = column.sum(axis=0) / count
+
+    terms = np.empty((len(df), len(_SUMS), len(pairs)), dtype=np.float64)
+    terms[:, 0] = valid
+    np.subtract(reference, reference_mean, out=terms[:, 1])
+    np.subtract(column, column_mean, out=terms[:, 2])
+    terms[:, 1:3] *= valid[:, None]
+    np.multiply(terms[:, 1], terms[:, 1], out=terms[:, 3])
+    np.multiply(terms[:, 2], terms[:, 2], out=terms[:, 4])
+    np.multiply(terms[:, 1], terms[:, 2], out=terms[:, 5])
+    np.subtract(column, reference, out=terms[:, 6])
+    np.multiply(terms[:, 6], terms[:, 6], out=terms[:, 7])
+    np.abs(terms[:, 6], out=terms[:, 8])
+    return terms, reference_mean
+
+
+def _period_sums(terms, index, resample_rule):
+    """
+    Sums the terms per period of a resample rule.
+
+    Returns the period labels of `pandas.DataFrame.resample` (empty periods
+    included) and the sums of shape (periods, len(_SUMS), pairs).
+    """
+    first = pd.Series(np.arange(len(index)), index=index).resample(
+        resample_rule).min()
+    filled = first.notna().values
+    sums = np.zeros((len(first),) + terms.shape[1:], dtype=np.float64)
+    if filled.any():
+        sums[filled] = np.add.reduceat(
+            terms, first.values[filled].astype(np.int64), axis=0)
+    return first.index, sums
+
+
+def _metrics(sums, reference_mean, min_count=None):
+    """Returns the metrics of `METRICS` from period sums."""
+    n, x, y, xx, yy, xy, d, dd, ad = np.moveaxis(sums, 1, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_x = x / n
+        mean_y = y / n
+        covariance = xy / n - mean_x * mean_y
+        variance_x = xx / n - mean_x ** 2
+        variance_y = yy / n - mean_y ** 2
+        metrics = {
+            'n': n,
+            'corr': covariance / np.sqrt(variance_x * variance_y),
+            'rmse': np.sqrt(dd / n),
+            'mbe': d / n,
+            'nmae': ad / (x + n * reference_mean)}
+    empty = n < (min_count or 1)
+    for metric in METRICS[1:]:
+        metrics[metric][empty] = np.nan
+    return metrics
+
+
+def compare_columns(df, pairs, resample_rules, min_count=None):
+    """
+    Calculates comparison metrics of column pairs per period.
+
+    The terms of all pairs are calculated once from the aligned DataFrame
+    and summed per period for every resample rule. Only rows where both
+    columns of a pair are valid are used.
+
+    Metrics, with x the reference and y the compared column:
+
+    * n: number of valid pairs of values
+    * corr: Pearson correlation coefficient
+    * rmse: root mean square error of y - x
+    * mbe: mean bias error, mean of y - x
+    * nmae: mean absolute error normalized by the mean of x
+
+    Parameters
+    ----------
+    df : :pandas:`DataFrame`
+        Aligned time series with :pandas:`DatetimeIndex`.
+    pairs : :obj:`list`
+        Tuples (reference column, compared column).
+    resample_rules : :obj:`list` or :obj:`str`
+        Resample rules of the periods, e.g. ['1W', '1Y'].
+    min_count : :obj:`int`, optional
+        Minimum number of valid pairs of values per period, metrics of
+        periods with fewer values are NaN.
+
+    Returns
+    -------
+    :pandas:`DataFrame`
+        One row per resample rule, period and pair with the columns
+        'resample_rule', 'period', 'reference', 'column' and the metrics.
+
+    """
+    if isinstance(resample_rules, str):
+        resample_rules = [resample_rules]
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index()
+    terms, reference_mean = _pair_sums(df, pairs)
+
+    tables = []
+    for resample_rule in resample_rules:
+        periods, sums = _period_sums(terms, df.index, resample_rule)
+        metrics = _metrics(sums, reference_mean, min_count=min_count)
+        table = pd.DataFrame({
+            'resample_rule': resample_rule,
+            'period': np.repeat(periods.values, len(pairs)),
+            'reference': np.tile([pair[0] for pair in pairs], len(periods)),
+            'column': np.tile([pair[1] for pair in pairs], len(periods))})
+        for metric in METRICS:
+            table[metric] = metrics[metric].ravel()
+        if periods.tz is not None:
+            table['period'] = table['period'].dt.tz_localize('UTC') \
+                .dt.tz_convert(periods.tz)
+        tables.append(table)
+    table = pd.concat(tables, ignore_index=True)
+    table['n'] = table['n'].astype(np.int64)
+    return table
+
+
+def metric_frame(table, metric, resample_rule):
+    """
+    Returns one metric of a resample rule from a table of
+    :func:`compare_columns`.
+
+    Returns
+    -------
+    :pandas:`DataFrame`
+        Periods as index and the compared columns as columns.
+
+    """
+    table = table[table['resample_rule'] == resample_rule]
+    return table.pivot(index='period', columns='column',
+                       values=metric).rename_axis(columns=None)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+HTW-PV3 - Plotting stage for comparison figures
+
+Collect figure specifications during an analysis and render them afterwards;
+Render with object-oriented figures on the Agg backend in a process pool;
+Skip figures whose inputs are unchanged since they were last rendered;
+
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+__copyright__ = "© Ludwig Hülk"
+__license__ = "GNU Affero General Public License Version 3 (AGPL-3.0)"
+__url__ = "https://www.gnu.org/licenses/agpl-3.0.en.html"
+__author__ = "Ludee;"
+__version__ = "v0.0.2"
+
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from settings import PLOT_WORKERS
+from pv3_cache import fingerprint
+from pv3_instrumentation import stage
+
+import logging
+log = logging.getLogger(__name__)
+
+# name of the file in each plot directory with the input hashes of the
+# rendered figures
+FIGURE_MANIFEST = '.figures.json'
+
+
+class FigureSpec:
+    """
+    Specification of one figure with a single axes.
+
+    Layers are drawn in the order they were added with
+    `pandas.DataFrame.plot` or `pandas.Series.plot` on the same axes.
+
+    Parameters
+    ----------
+    file_name : :obj:`str`
+        Name of the image file, including directory and extension.
+    title : :obj:`str`, optional
+        Title of the axes.
+    ylabel : :obj:`str`, optional
+        Label of the y-axis.
+    legend_loc : :obj:`int` or :obj:`str`, optional
+        Location of the legend.
+    grid : :obj:`bool`
+        If True, draw a grid. Default: False.
+    figsize : :obj:`tuple`, optional
+        Width and height of the figure in inches.
+
+    """
+
+    def __init__(self, file_name, title=None, ylabel=None, legend_loc=None,
+                 grid=False, figsize=None):
+        self.file_name = file_name
+        self.title = title
+        self.ylabel = ylabel
+        self.legend_loc = legend_loc
+        self.grid = grid
+        self.figsize = figsize
+        self.layers = []
+
+    def plot(self, data, **kwargs):
+        """
+        Adds a layer.
+
+        Parameters
+        ----------
+        data : :pandas:`DataFrame` or :pandas:`Series`
+            Data of the layer.
+        kwargs
+            Arguments of `pandas.DataFrame.plot`, e.g. legend=True.
+
+        Returns
+        -------
+        :class:`FigureSpec`
+
+        """
+        self.layers.append((data, kwargs))
+        return self
+
+    def fingerprint(self):
+        """Returns the content hash of the data and the layout."""
+        return fingerprint(
+            [self.title, self.ylabel, self.legend_loc, self.grid,
+             self.figsize],
+            [(data, kwargs) for data, kwargs in self.layers])
+
+
+def render_figure(spec):
+    """
+    Renders a :class:`FigureSpec` to its image file with the Agg backend,
+    independent of the state of `matplotlib.pyplot`.
+    """
+    fig = Figure(figsize=spec.figsize)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    for data, kwargs in spec.layers:
+        data.plot(ax=ax, **kwargs)
+    if spec.title:
+        ax.set_title(spec.title)
+    if spec.ylabel:
+        ax.set_ylabel(spec.ylabel)
+    if spec.legend_loc:
+        ax.legend(loc=spec.legend_loc)
+    if spec.grid:
+        ax.grid(True)
+    fig.savefig(spec.file_name)
+    return spec.file_name
+
+
+def _init_plot_worker():
+    """Selects the Agg backend in a worker process."""
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def _read_manifest(directory):
+    file_name = os.path.join(directory, FIGURE_MANIFEST)
+    if not os.path.isfile(file_name):
+        return {}
+    with open(file_name) as f:
+        return json.load(f)
+
+
+def _write_manifest(directory, manifest):
+    file_name = os.path.join(directory, FIGURE_MANIFEST)
+    tmp_file = f'{file_name}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, file_name)
+
+
+class PlotStage:
+    """
+    Collects figure specifications and renders them in one stage.
+
+    Parameters
+    ----------
+    workers : :obj:`int`, optional
+        Number of worker processes. If 1, figures are rendered in the main
+        process. Default: None (`settings.PLOT_WORKERS`, if that is None
+        too the number of CPUs).
+    skip_unchanged : :obj:`bool`
+        If True, figures whose image file exists and whose inputs have the
+        same hash as when the file was rendered are skipped. The hashes are
+        kept in `FIGURE_MANIFEST` in every plot directory. Default: True.
+
+    """
+
+    def __init__(self, workers=None, skip_unchanged=True):
+        self.workers = workers
+        self.skip_unchanged = skip_unchanged
+        self.specs = []
+
+    def __len__(self):
+        return len(self.specs)
+
+    def add(self, spec):
+        """Adds a :class:`FigureSpec` and returns it."""
+        self.specs.append(spec)
+        return spec
+
+    def render(self):
+        """
+        Renders all collected figures and clears the stage.
+
+        Returns
+        -------
+        :obj:`list`
+            File names of the rendered figures.
+
+        """
+        specs, self.specs = self.specs, []
+        with stage('plot', rows=len(specs)) as record:
+            manifests = {}
+            pending = []
+            hashes = []
+            for spec in specs:
+                directory = os.path.dirname(spec.file_name) or '.'
+                if directory not in manifests:
+                    os.makedirs(directory, exist_ok=True)
+                    manifests[directory] = _read_manifest(directory)
+                key = os.path.basename(spec.file_name)
+                spec_hash = spec.fingerprint()
+                if self.skip_unchanged and \
+                        manifests[directory].get(key) == spec_hash and \
+                        os.path.isfile(spec.file_name):
+                    continue
+                pending.append(spec)
+                hashes.append((directory, key, spec_hash))
+            record['skipped'] = len(specs) - len(pending)
+
+            workers = self.workers
+            if workers is None:
+                workers = PLOT_WORKERS or os.cpu_count()
+            workers = min(workers, len(pending))
+            if workers <= 1:
+                file_names = [render_figure(spec) for spec in pending]
+            else:
+                log.info(f'Render {len(pending)} figures with {workers} '
+                         f'workers')
+                with ProcessPoolExecutor(
+                        max_workers=workers,
+                        initializer=_init_plot_worker) as pool:
+                    file_names = list(pool.map(render_figure, pending))
+
+            for directory, key, spec_hash in hashes:
+                manifests[directory][key] = spec_hash
+            for directory in {directory for directory, _, _ in hashes}:
+                _write_manifest(directory, manifests[directory])
+        return file_names
+
+
+def submit(spec, figures=None):
+    """
+    Adds a figure to a :class:`PlotStage`, or renders it right away if
+    `figures` is None.
+    """
+    if figures is None:
+        render_figure(spec)
+    else:
+        figures.add(spec)
+    return spec
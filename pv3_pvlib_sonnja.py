@@ -2,7 +2,6 @@ import pandas as pd
 import matplotlib.pyplot as mpl
 import numpy as np
 import os
-from collections import OrderedDict
 
 import pvlib
 
@@ -12,7 +11,12 @@ from pvlib import irradiance
 import read_htw_data
 import get_weather_data
 import analysis_tools
-import tools
+
+from pv3_cache import get_location_solarposition
+import pv3_decomposition
+from pv3_merra import get_merra_store
+from pv3_metrics import compare_columns, metric_frame
+from pv3_plotting import FigureSpec, PlotStage, submit
 
 
 def reindl(ghi, i0_h, elevation):
@@ -33,41 +37,11 @@ def reindl(ghi, i0_h, elevation):
     :collections:`OrderedDict`
         Dictionary with time series for DNI, DHI and clearness index kt.
 
-    """
-
-    elevation = pvlib.tools.sind(elevation)
-
-    # calculate clearness index kt
-    kt = np.maximum(0, ghi / (i0_h * elevation))
-
-    # calculate diffuse fraction DHI/GHI
-    # for kt <= 0.3
-    df = 1.02 - 0.254 * kt + 0.0123 * elevation
-    # for kt > 0.3 and kt <= 0.78
-    df = np.where((kt > 0.3) & (kt <= 0.78),
-                  np.fmin(0.97, np.fmax(
-                      0.1, 1.4 - 1.794 * kt + 0.177 * elevation)),
-                  df)
-    # for kt > 0.78
-    df = np.where(kt > 0.78, np.fmax(0.1, 0.486 * kt + 0.182 * elevation), df)
+    See `pv3_decomposition.reindl` for the implementation.
 
-    # eliminate extreme data according to limits Case 1 and Case 2 in Reindl
-    df = np.where(((df < 0.9) & (kt < 0.2)) |
-                  ((df > 0.8) & (kt > 0.6)) |
-                  (df > 1) | (ghi - i0_h > 0), 0, df)
-
-    dhi = df * ghi
-    dni = (ghi - dhi) / elevation
-
-    data = OrderedDict()
-    data['dni'] = dni
-    data['dhi'] = dhi
-    data['kt'] = kt
-
-    if isinstance(ghi, pd.Series):
-        data = pd.DataFrame(data)
+    """
 
-    return data
+    return pv3_decomposition.reindl(ghi, i0_h, elevation)
 
 
 def apply_decomposition_model(weather_df, model, location):
@@ -90,16 +64,12 @@ def apply_decomposition_model(weather_df, model, location):
 
     """
 
-    solar_position = location.get_solarposition(
-        weather_df.index, pressure=weather_df['pressure'].mean(),
+    solar_position = get_location_solarposition(
+        location, weather_df.index, pressure=weather_df['pressure'].mean(),
         temperature=weather_df['temp_air'].mean())
 
     if model == 'reindl':
 
-        solar_position = location.get_solarposition(
-            weather_df.index, pressure=weather_df['pressure'].mean(),
-            temperature=weather_df['temp_air'].mean())
-
         df = reindl(weather_df.ghi, weather_df.i0_h, solar_position.elevation)
         df['dni_corrected'] = irradiance.dni(
             weather_df['ghi'], df['dhi'], solar_position.zenith,
@@ -134,7 +104,8 @@ def apply_decomposition_model(weather_df, model, location):
 
 def compare_decomposition_models(merra_df, location, htw_weather_df,
                                  plot=False,
-                                 plot_directory='plot/decomposition'):
+                                 plot_directory='plot/decomposition',
+                                 figures=None):
     """
     Compares the decomposition models Reindl, Erbs and Disc. Calculates
     correlation and RMSE and optionally plots these plus a winter and summer
@@ -151,6 +122,9 @@ def compare_decomposition_models(merra_df, location, htw_weather_df,
         If true plots are created. Default: False.
     plot_directory : :obj:`str`
         Path to directory plot is saved to.
+    figures : :class:`pv3_plotting.PlotStage`, optional
+        Stage the figures are added to. Default: None (figures are rendered
+        at the end of the function).
 
     Returns
     -------
@@ -188,53 +162,46 @@ def compare_decomposition_models(merra_df, location, htw_weather_df,
 
     # calculate correlation and rmse
     parameter_list = ['gni_disc', 'gni_corrected_reindl', 'gni_corrected_erbs']
-    count = 0
-    for param in parameter_list:
-        df = htw_weather_df['gni'].to_frame().join(
-            df_comp[param].to_frame(), how='outer')
-        corr = analysis_tools.correlation_tmp(
-            df, resample_rule, min_count=100).rename(
-            'corr_gni_htw_{}'.format(param))
-        var = analysis_tools.variability(
-            df, resample_rule, min_count=100).rename(
-            'rmse_gni_htw_{}'.format(param))
-        corr_year = np.round(analysis_tools.correlation_tmp(df, '1Y').iloc[0],
-                             2)
-        var_year = np.round(analysis_tools.variability(df, '1Y').iloc[0], 2)
-        if plot:
+    df_all = htw_weather_df['gni'].to_frame().join(
+        df_comp[parameter_list], how='outer')
+    metrics = compare_columns(
+        df_all, [('gni', param) for param in parameter_list],
+        [resample_rule, '1Y'], min_count=100)
+    corr_df = metric_frame(metrics, 'corr', resample_rule)[
+        parameter_list].add_prefix('corr_gni_htw_')
+    var_df = metric_frame(metrics, 'rmse', resample_rule)[
+        parameter_list].add_prefix('rmse_gni_htw_')
+    corr_year = np.round(metric_frame(metrics, 'corr', '1Y').iloc[0], 2)
+    var_year = np.round(metric_frame(metrics, 'rmse', '1Y').iloc[0], 2)
+    plot_figures = PlotStage() if figures is None else figures
+    if plot:
+        for param in parameter_list:
+            df = df_all[['gni', param]]
             for week in weeks:
                 filename = 'decomposition_comparison_week_{}_to_{}_{}_{}_{}_' \
                            'annual_corr_{}_annual_RMSE_{}'.format(
                     week[0].replace('/', '_'), week[1].replace('/', '_'),
-                    param, weather_data, measured_data, corr_year, var_year)
+                    param, weather_data, measured_data, corr_year[param],
+                    var_year[param])
                 plot_time_range(df.fillna(0), week, filename, plot_directory,
-                                weather_data)
-        if count == 0:
-            corr_df = corr.to_frame()
-            var_df = var.to_frame()
-        else:
-            corr_df = corr_df.join(corr.to_frame())
-            var_df = var_df.join(var.to_frame())
-        count += 1
+                                weather_data, figures=plot_figures)
 
     if plot:
         # plot correlation
-        corr_df.plot(title='Correlation')
-        mpl.ylabel('Correlation coefficient')
-        mpl.savefig(
+        submit(FigureSpec(
             os.path.join(
                 plot_directory, 'decomposition_comparison_correlation_'
                                 '{}_{}_{}.png'.format(
-                    resample_rule, weather_data, measured_data)))
-        mpl.clf()
+                    resample_rule, weather_data, measured_data)),
+            title='Correlation', ylabel='Correlation coefficient').plot(
+            corr_df), plot_figures)
         # plot RMSE
-        var_df.plot(title='RMSE')
-        mpl.ylabel('RMSE in W/m²')
-        mpl.savefig(
+        submit(FigureSpec(
             os.path.join(
                 plot_directory, 'decomposition_comparison_RMSE_'
                                 '{}_{}_{}.png'.format(
-                    resample_rule, weather_data, measured_data)))
+                    resample_rule, weather_data, measured_data)),
+            title='RMSE', ylabel='RMSE in W/m²').plot(var_df), plot_figures)
         # plot weeks
         df_week = df_comp.loc[:, ['gni_disc', 'gni_corrected_reindl',
                                   'gni_corrected_erbs']].fillna(0).join(
@@ -245,7 +212,9 @@ def compare_decomposition_models(merra_df, location, htw_weather_df,
                 week[0].replace('/', '_'), week[1].replace('/', '_'),
                 weather_data, measured_data)
             plot_time_range(df_week, week, filename, plot_directory,
-                            weather_data)
+                            weather_data, figures=plot_figures)
+        if figures is None:
+            plot_figures.render()
     return df_comp
 
 
@@ -267,23 +236,10 @@ def load_merra_data(year, lat, lon, directory):
         DataFrame with weather data.
 
     """
-    # read csv file
-    merra_df = pd.read_csv(
-        os.path.join(directory, 'weather_data_GER_{}.csv'.format(year)),
-        header=[0], index_col=[0], parse_dates=True)
-    # get closest coordinates to given location
-    lat_lon = tools.get_closest_coordinates(merra_df, [lat, lon])
+    # parsed once per file, see pv3_merra.MerraStore
+    store = get_merra_store(year, directory)
     # get weather data for closest location
-    df = merra_df[(merra_df['lon'] == lat_lon['lon']) &
-                  (merra_df['lat'] == lat_lon['lat'])]
-    # convert time index to local time
-    df.index = df.index.tz_localize('UTC').tz_convert('Europe/Berlin')
-    # rename columns to fit needs of pvlib
-    df.rename(columns={'T': 'temp_air', 'v_50m': 'wind_speed', 'p': 'pressure',
-                       'SWTDN': 'i0_h', 'SWGDN': 'ghi'}, inplace=True)
-    # convert temperature to °C
-    df.loc[:, 'temp_air'] = df.temp_air - 273.15
-    return df
+    return store.get_site_data(store.nearest_sites(lat, lon)[0])
 
 
 def get_index(start_date, end_date, weather_data):
@@ -315,7 +271,8 @@ def get_index(start_date, end_date, weather_data):
 
 
 def plot_time_range(data, time_range, filename, plot_directory,
-                    weather_data, ylabel=None, legend_loc=None, title=None):
+                    weather_data, ylabel=None, legend_loc=None, title=None,
+                    figures=None):
     """
     Plots data for the given time range.
 
@@ -335,21 +292,21 @@ def plot_time_range(data, time_range, filename, plot_directory,
     legend_loc : :obj:`int`, optional
         Location of legend.
     title : :obj:`str`, optional
+    figures : :class:`pv3_plotting.PlotStage`, optional
+        Stage the figure is added to. Default: None (rendered right away).
 
     """
 
     # set frequency of index
     index = get_index(time_range[0], time_range[1], weather_data)
 
-    data.loc[index, :].plot(title=title)
-    if ylabel:
-        mpl.ylabel(ylabel)
-    if legend_loc:
-        mpl.legend(loc=legend_loc)
-    mpl.savefig(os.path.join(plot_directory, '{}.png'.format(filename)))
+    spec = FigureSpec(os.path.join(plot_directory, '{}.png'.format(filename)),
+                      title=title, ylabel=ylabel, legend_loc=legend_loc)
+    submit(spec.plot(data.loc[index, :]), figures)
 
 
-def compare_parameters_2(dict, parameter, resample_rule, plot_directory):
+def compare_parameters_2(dict, parameter, resample_rule, plot_directory,
+                         figures=None):
     """
     Calculates and plots correlation and RMSE between three time series.
 
@@ -357,6 +314,8 @@ def compare_parameters_2(dict, parameter, resample_rule, plot_directory):
     :param parameter:
     :param resample_rule:
     :param plot_directory:
+    :param figures: :class:`pv3_plotting.PlotStage` the figures are added
+        to, if None they are rendered right away.
     :return:
     """
     corr = {}
@@ -364,40 +323,41 @@ def compare_parameters_2(dict, parameter, resample_rule, plot_directory):
     rmse = {}
     rmse_annual = {}
     for key in dict.keys():
-
-        # calculate correlation
-        corr[key] = analysis_tools.correlation_tmp(
-            dict[key], resample_rule=resample_rule)
-        corr_annual[key] = np.round(analysis_tools.correlation_tmp(
-            dict[key], resample_rule='1Y').iloc[0], 2)
-
-        # calculate RMSE
-        rmse[key] = analysis_tools.variability(
-            dict[key], resample_rule=resample_rule)
-        rmse_annual[key] = np.round(analysis_tools.variability(
-            dict[key], resample_rule='1Y').iloc[0], 2)
+        # calculate correlation and RMSE
+        pair = tuple(dict[key].columns[:2])
+        metrics = compare_columns(dict[key], [pair],
+                                  [resample_rule, '1Y'])
+        corr[key] = metric_frame(metrics, 'corr', resample_rule)[
+            pair[1]].rename(key)
+        corr_annual[key] = np.round(
+            metric_frame(metrics, 'corr', '1Y')[pair[1]].iloc[0], 2)
+        rmse[key] = metric_frame(metrics, 'rmse', resample_rule)[
+            pair[1]].rename(key)
+        rmse_annual[key] = np.round(
+            metric_frame(metrics, 'rmse', '1Y')[pair[1]].iloc[0], 2)
 
     # plot correlation
-    corr['MERRA'].plot(legend=True)
-    corr['open_FRED'].plot(legend=True, grid=True,
-                           title='Correlation {}'.format(corr_annual))
-    mpl.savefig(os.path.join(
-        plot_directory, '{}_correlation_{}.png'.format(
-            parameter, resample_rule)))
-    mpl.clf()
-    
+    spec = FigureSpec(
+        os.path.join(plot_directory, '{}_correlation_{}.png'.format(
+            parameter, resample_rule)),
+        title='Correlation {}'.format(corr_annual), grid=True)
+    spec.plot(corr['MERRA'], legend=True)
+    spec.plot(corr['open_FRED'], legend=True)
+    submit(spec, figures)
+
     # plot RMSE
-    rmse['MERRA'].plot(legend=True)
-    rmse['open_FRED'].plot(legend=True, grid=True,
-                           title='RMSE {}'.format(rmse_annual))
-    mpl.savefig(os.path.join(
-        plot_directory, '{}_rmse_{}.png'.format(
-            parameter, resample_rule)))
-    mpl.clf()
+    spec = FigureSpec(
+        os.path.join(plot_directory, '{}_rmse_{}.png'.format(
+            parameter, resample_rule)),
+        title='RMSE {}'.format(rmse_annual), grid=True)
+    spec.plot(rmse['MERRA'], legend=True)
+    spec.plot(rmse['open_FRED'], legend=True)
+    submit(spec, figures)
 
 
 def plot_time_range_multiple_datasets(data_dict, column, time_range, filename,
-                                      plot_directory, figsize=None):
+                                      plot_directory, figsize=None,
+                                      figures=None):
     """
     Plots data for the given time range and weather data sets.
 
@@ -413,22 +373,27 @@ def plot_time_range_multiple_datasets(data_dict, column, time_range, filename,
         Path to directory plot is saved to.
     figsize : :obj:`list`, optional
         List with height and breadth of figure, e.g. [20, 15]. Default: None.
+    figures : :class:`pv3_plotting.PlotStage`, optional
+        Stage the figure is added to. Default: None (rendered right away).
 
     """
 
-    weather_data_sets = data_dict.keys()
+    weather_data_sets = list(data_dict.keys())
 
     # set frequency of index
     index = {}
     for data_set in weather_data_sets:
         index[data_set] = get_index(time_range[0], time_range[1], data_set)
 
-    data_dict[data_set].loc[index[data_set], :].plot(
-        legend=True, figsize=figsize)
-    for data_set in weather_data_sets[1:-1]:
-        data_dict[data_set].loc[index[data_set], column].plot(
-            legend=True, grid=True)
-    mpl.savefig(os.path.join(plot_directory, '{}.png'.format(filename)))
+    # all columns of the first data set, `column` of the others
+    spec = FigureSpec(os.path.join(plot_directory, '{}.png'.format(filename)),
+                      grid=len(weather_data_sets) > 1, figsize=figsize)
+    data_set = weather_data_sets[0]
+    spec.plot(data_dict[data_set].loc[index[data_set], :], legend=True)
+    for data_set in weather_data_sets[1:]:
+        spec.plot(data_dict[data_set].loc[index[data_set], column],
+                  legend=True)
+    submit(spec, figures)
 
 
 def calculate_dni_pvlib(weather_df, corrected=True):
@@ -443,8 +408,8 @@ def calculate_dni_pvlib(weather_df, corrected=True):
     # calculate DNI
     times = weather_df.index
     location = read_htw_data.setup_pvlib_location_object()
-    solarposition = location.get_solarposition(
-        times, pressure=None, temperature=weather_df['temp_air'])
+    solarposition = get_location_solarposition(
+        location, times, pressure=None, temperature=weather_df['temp_air'])
     if corrected:
         # calculate corrected DNI
         clearsky = location.get_clearsky(times, solar_position=solarposition)
@@ -559,9 +524,10 @@ def compare_weather_data_fred_htw(fred_weather_data):
     plot_week(parameter + '_uncorrected', weather_data, plot_directory)
 
 
-def compare_feedin_htw(converters, weather_data_sets):
+def compare_feedin_htw(converters, weather_data_sets, figures=None):
     plot_directory = 'plot'
     resample_rule = '1W'
+    plot_figures = PlotStage() if figures is None else figures
 
     ###########################################################################
     # read HTW converter data
@@ -633,7 +599,7 @@ def compare_feedin_htw(converters, weather_data_sets):
         gni_dict['open_FRED'].loc[
             gni_dict['open_FRED'].index.year == 2015]
     compare_parameters_2(
-        gni_dict, 'GNI', resample_rule, plot_directory)
+        gni_dict, 'GNI', resample_rule, plot_directory, figures=plot_figures)
 
     winter_week = ('3/9/2015', '3/16/2015')
     index = {}
@@ -643,11 +609,12 @@ def compare_feedin_htw(converters, weather_data_sets):
     index['MERRA'] = pd.date_range(start=winter_week[0], end=winter_week[1],
                                    freq='60Min', tz='UTC')
 
-    gni_dict['MERRA'].loc[index['MERRA'], :].plot(legend=True)
-    gni_dict['open_FRED'].loc[index['open_FRED'],
-                          'gni_open_FRED'].plot(legend=True, grid=True)
-    mpl.savefig(os.path.join(plot_directory, '{}_march_week.png'.format(
-        'GNI')))
+    spec = FigureSpec(os.path.join(plot_directory, '{}_march_week.png'.format(
+        'GNI')), grid=True)
+    spec.plot(gni_dict['MERRA'].loc[index['MERRA'], :], legend=True)
+    spec.plot(gni_dict['open_FRED'].loc[index['open_FRED'], 'gni_open_FRED'],
+              legend=True)
+    plot_figures.add(spec)
 
     # dhi_monthly_sums = {}
     # dhi_monthly_sums['MERRA'] = weather_data_dict['MERRA'].dhi.resample(
@@ -692,7 +659,8 @@ def compare_feedin_htw(converters, weather_data_sets):
         # calculate monthly correlation and RMSE for feed-in
         parameter = 'pv_feedin_{}'.format(converter)
         compare_parameters_2(
-            feedin[converter], parameter, resample_rule, plot_directory)
+            feedin[converter], parameter, resample_rule, plot_directory,
+            figures=plot_figures)
 
         plot_week_2(feedin[converter], parameter, plot_directory)
 
@@ -702,13 +670,14 @@ def compare_feedin_htw(converters, weather_data_sets):
             'MERRA'].resample(resample_rule).sum()
         monthly_energy['open_FRED'] = feedin[converter][
             'open_FRED'].resample(resample_rule).sum() / 2
-        monthly_energy['MERRA'].plot(legend=True)
-        monthly_energy['open_FRED'].loc[:, 'energy_calculated_open_FRED'].plot(
-            legend=True, grid=True, title='Energy feed-in')
-        mpl.savefig(os.path.join(plot_directory,
-                                 'pv_feedin_{}_energy.png'.format(
-                                     converter)))
-        mpl.clf()
+        spec = FigureSpec(os.path.join(plot_directory,
+                                       'pv_feedin_{}_energy.png'.format(
+                                           converter)),
+                          title='Energy feed-in', grid=True)
+        spec.plot(monthly_energy['MERRA'], legend=True)
+        spec.plot(monthly_energy['open_FRED'].loc[
+                  :, 'energy_calculated_open_FRED'], legend=True)
+        plot_figures.add(spec)
 
     ###########################################################################
     # call modelchain with HTW data
@@ -746,7 +715,8 @@ def compare_feedin_htw(converters, weather_data_sets):
         # calculate monthly correlation and RMSE for feed-in
         parameter = 'pv_feedin_{}_htw'.format(converter)
         compare_parameters_2(
-            feedin[converter], parameter, resample_rule, plot_directory)
+            feedin[converter], parameter, resample_rule, plot_directory,
+            figures=plot_figures)
 
         plot_week_2(feedin[converter], parameter, plot_directory)
 
@@ -757,14 +727,17 @@ def compare_feedin_htw(converters, weather_data_sets):
         monthly_energy['open_FRED'] = feedin[converter][
                                           'open_FRED'].resample(
             resample_rule).sum() / 2
-        monthly_energy['MERRA'].plot(legend=True)
-        monthly_energy['open_FRED'].loc[:,
-        'energy_calculated_open_FRED'].plot(
-            legend=True, grid=True, title='Energy feed-in')
-        mpl.savefig(os.path.join(plot_directory,
-                                 'pv_feedin_{}_energy_htw.png'.format(
-                                     converter)))
-        mpl.clf()
+        spec = FigureSpec(os.path.join(plot_directory,
+                                       'pv_feedin_{}_energy_htw.png'.format(
+                                           converter)),
+                          title='Energy feed-in', grid=True)
+        spec.plot(monthly_energy['MERRA'], legend=True)
+        spec.plot(monthly_energy['open_FRED'].loc[
+                  :, 'energy_calculated_open_FRED'], legend=True)
+        plot_figures.add(spec)
+
+    if figures is None:
+        plot_figures.render()
 
 
 if __name__ == '__main__':
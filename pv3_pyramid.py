@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+HTW-PV3 - Resolution pyramid of measured data
+
+Aggregate measured data once to 15 min, 30 min, 60 min, daily and monthly
+resolution, each level from the one below;
+Store sums and counts per level next to the channel store of the raw data;
+Read means, sums or counts at a target resolution instead of resampling;
+
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+__copyright__ = "© Ludwig Hülk"
+__license__ = "GNU Affero General Public License Version 3 (AGPL-3.0)"
+__url__ = "https://www.gnu.org/licenses/agpl-3.0.en.html"
+__author__ = "Ludee;"
+__version__ = "v0.0.2"
+
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from pv3_channelstore import ChannelStore
+
+import logging
+log = logging.getLogger(__name__)
+
+# level: (parent level, bin width, bin offset, label)
+# Intraday bins are labelled with their center, the convention of the
+# weather data sets: 30 min bins starting at full and half hours, labelled
+# hh:15 and hh:45 (open_FRED), and 60 min bins starting at hh:30, labelled
+# with the full hour (MERRA). Days and months are labelled with their
+# start. Days are built from 30 min bins, as 60 min bins cross midnight.
+PYRAMID_LEVELS = OrderedDict([
+    ('15min', ('raw', '15Min', None, 'center')),
+    ('30min', ('15min', '30Min', None, 'center')),
+    ('60min', ('30min', '60Min', '30Min', 'center')),
+    ('day', ('30min', 'D', None, 'start')),
+    ('month', ('day', 'MS', None, 'start')),
+])
+
+# pyramid level matching the resolution of a weather data set
+WEATHER_DATA_LEVELS = {'open_FRED': '30min', 'MERRA': '60min'}
+
+
+def _bin_starts(times, width, offset):
+    """Returns the start of the bin of every (naive) timestamp."""
+    if width == 'MS':
+        return times.to_period('M').to_timestamp()
+    offset = pd.Timedelta(offset or 0)
+    return (times - offset).floor(width) + offset
+
+
+def _aggregate(starts, sums, counts, width, offset):
+    """
+    Sums the sums and counts of sorted bins into the bins of the next level.
+
+    Returns the complete range of bin starts (empty bins included, as in
+    `pandas.DataFrame.resample`) and the sums and counts per bin.
+    """
+    bins = _bin_starts(starts, width, offset)
+    first = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+    full = pd.date_range(bins[0], bins[-1], freq=width)
+    positions = full.get_indexer(bins[first])
+    level_sums = np.zeros((len(full), sums.shape[1]), dtype=np.float64)
+    level_counts = np.zeros((len(full), counts.shape[1]), dtype=np.int64)
+    level_sums[positions] = np.add.reduceat(sums, first, axis=0)
+    level_counts[positions] = np.add.reduceat(counts, first, axis=0)
+    return full, level_sums, level_counts
+
+
+class ResolutionPyramid:
+    """
+    Sums and counts of the channels of a :class:`ChannelStore` at the
+    resolutions of `PYRAMID_LEVELS`.
+
+    Each level is stored as two channel stores, `pyramid/<level>/sum` and
+    `pyramid/<level>/count`, in the directory of the raw data, indexed by
+    the bin labels. Means are sums divided by counts of valid values, equal
+    to `resample(...).mean()` of the raw data. Bins are formed in the wall
+    time of the store, so the raw data should have a fixed UTC offset, like
+    the SonnJA data in Etc/GMT-1.
+
+    Parameters
+    ----------
+    store : :class:`ChannelStore`
+        Raw data.
+
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.directory = os.path.join(store.directory, 'pyramid')
+        with open(os.path.join(self.directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self._levels = {}
+
+    @classmethod
+    def build(cls, store):
+        """
+        Builds all levels of the pyramid of a channel store.
+
+        The raw data is read once, every level is aggregated from its
+        parent level.
+        """
+        directory = os.path.join(store.directory, 'pyramid')
+        channels = store.channels
+        values = np.column_stack([store.values(channel)
+                                  for channel in channels]).astype(np.float64)
+        valid = ~np.isnan(values)
+        levels = {'raw': (store.index().tz_localize(None),
+                          np.where(valid, values, 0.), valid.astype(np.int64))}
+        del values, valid
+
+        for level, (parent, width, offset, label) in PYRAMID_LEVELS.items():
+            starts, sums, counts = _aggregate(*levels[parent], width, offset)
+            levels[level] = starts, sums, counts
+            labels = starts
+            if label == 'center':
+                labels = starts + pd.Timedelta(width) / 2
+            if store.tz is not None:
+                labels = labels.tz_localize(store.tz)
+            labels.name = store.meta.get('index_name')
+            for statistic, data in [('sum', sums), ('count', counts)]:
+                ChannelStore.write(
+                    pd.DataFrame(data, index=labels, columns=channels),
+                    os.path.join(directory, level, statistic))
+
+        meta = {'levels': list(PYRAMID_LEVELS), 'source': store.meta['source'],
+                'rows': len(store)}
+        with open(os.path.join(directory, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        log.info(f'Build resolution pyramid of {len(channels)} channels '
+                 f'in: {directory}')
+        return cls(store)
+
+    def _level(self, level, statistic):
+        if level not in PYRAMID_LEVELS:
+            raise ValueError(f'Unknown pyramid level {level}, choose from '
+                             f'{list(PYRAMID_LEVELS)}.')
+        key = (level, statistic)
+        if key not in self._levels:
+            self._levels[key] = ChannelStore(
+                os.path.join(self.directory, level, statistic))
+        return self._levels[key]
+
+    def read(self, level, channels=None, start=None, end=None,
+             statistic='mean'):
+        """
+        Reads channels at the resolution of a pyramid level.
+
+        Parameters
+        ----------
+        level : :obj:`str`
+            Level of `PYRAMID_LEVELS`, e.g. '30min', or 'raw' for the data
+            of the channel store.
+        channels : :obj:`list` or :obj:`str`, optional
+            Channel names. Default: all channels.
+        start, end : :obj:`str` or :pandas:`Timestamp`, optional
+            First and last bin label. Default: whole time range.
+        statistic : :obj:`str`
+            'mean', 'sum' or 'count'. Default: 'mean'.
+
+        Returns
+        -------
+        :pandas:`DataFrame`
+
+        """
+        if level == 'raw':
+            return self.store.read(channels, start, end)
+        if statistic in ['sum', 'count']:
+            return self._level(level, statistic).read(channels, start, end)
+        if statistic != 'mean':
+            raise ValueError(f'Unknown statistic {statistic}, choose from '
+                             f"'mean', 'sum' and 'count'.")
+        sums = self._level(level, 'sum').read(channels, start, end)
+        counts = self._level(level, 'count').read(channels, start, end)
+        return sums / counts.where(counts > 0)
+
+
+def get_pyramid(store):
+    """
+    Returns the :class:`ResolutionPyramid` of a channel store.
+
+    The pyramid is built on first use and rebuilt if the store was rebuilt
+    from a changed source file.
+    """
+    meta_file = os.path.join(store.directory, 'pyramid', 'meta.json')
+    if os.path.isfile(meta_file):
+        pyramid = ResolutionPyramid(store)
+        if pyramid.meta.get('source') == store.meta.get('source') and \
+                pyramid.meta.get('rows') == len(store):
+            return pyramid
+    return ResolutionPyramid.build(store)
@@ -18,56 +18,213 @@ __version__ = "v0.0.2"
 
 from settings import setup_logger, write_to_csv
 
+import os
+import shutil
+
 import pandas as pd
 
 """logging"""
 log = setup_logger()
 
 
-def results_modelchain(mc, weather):
+class CsvResultSink:
+    """
+    Writes result tables to semicolon separated CSV files in `directory`.
+
+    Time series are written to one file per weather and system, monthly and
+    annual results are appended to shared files.
+    """
+
+    def __init__(self, directory='./data'):
+        self.directory = directory
+
+    def write(self, table, df, weather, system_name, append=True):
+        if table == 'timeseries':
+            filename = f'pv3_pvlib_{weather}_{system_name}'
+        else:
+            filename = f'pv3_pvlib_{table}'
+        write_to_csv(os.path.join(self.directory, f'{filename}.csv'), df,
+                     append=append)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ParquetResultSink:
+    """
+    Collects the result tables of a run and writes them as Parquet datasets.
+
+    Each table ('timeseries', 'month', 'annual') is stored in
+    `directory`/<table>, partitioned by weather and system name. Data is
+    buffered in memory and written on `flush` or `close`; existing data of
+    a table is replaced by the first flush of the run.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the datasets. Default: './data/pv3_pvlib'.
+    compression : str
+        Parquet compression codec. Default: 'snappy'.
+    csv_export : bool
+        If True, also write the CSV files of `CsvResultSink`. Default: False.
+    """
+
+    partition_cols = ['weather', 'system_name']
+
+    def __init__(self, directory='./data/pv3_pvlib', compression='snappy',
+                 csv_export=False):
+        self.directory = directory
+        self.compression = compression
+        self.csv_sink = CsvResultSink() if csv_export else None
+        self._frames = {}
+        self._written = set()
+
+    def write(self, table, df, weather, system_name, append=True):
+        if self.csv_sink:
+            self.csv_sink.write(table, df, weather, system_name, append)
+        df = df.reset_index()
+        df['weather'] = weather
+        df['system_name'] = system_name
+        self._frames.setdefault(table, []).append(df)
+
+    def flush(self):
+        """Writes all buffered tables to the Parquet datasets."""
+        for table, frames in self._frames.items():
+            path = os.path.join(self.directory, table)
+            if table not in self._written and os.path.isdir(path):
+                shutil.rmtree(path)
+            pd.concat(frames, ignore_index=True).to_parquet(
+                path, partition_cols=self.partition_cols,
+                compression=self.compression, index=False)
+            self._written.add(table)
+            log.info(f'Write {len(frames)} results to dataset: {path}')
+        self._frames = {}
+
+    def close(self):
+        self.flush()
+
+
+# ModelChain attributes exported by results_modelchain
+MODELCHAIN_OUTPUTS = ['ac', 'cell_temperature', 'dc', 'weather']
+
+# resample rule of monthly sums, labelled with the month end ('M' before
+# pandas 2.2, removed in pandas 3)
+try:
+    MONTH_END = pd.tseries.frequencies.to_offset('ME').freqstr
+except ValueError:
+    MONTH_END = 'M'
+
+# sink used by the result functions if none is given
+default_sink = CsvResultSink()
+
+
+def modelchain_results(mc):
+    """
+    Returns the object holding the outputs of a ModelChain run,
+    `mc.results` since pvlib 0.9 and the ModelChain itself before.
+    """
+    return getattr(mc, 'results', mc)
+
+
+def assemble_modelchain_results(mc, outputs=None, dtype=None):
+    """
+    Collects ModelChain outputs in one DataFrame without joins.
+
+    All outputs of a ModelChain run share the index of the weather data, so
+    the columns are concatenated after the index identity has been checked
+    once.
+
+    Parameters
+    ----------
+    mc : :pvlib:`ModelChain`
+        ModelChain after `run_model`.
+    outputs : :obj:`list`, optional
+        ModelChain attributes to retain, Series are named after the
+        attribute, DataFrames contribute all of their columns.
+        Default: None (`MODELCHAIN_OUTPUTS`).
+    dtype : :obj:`str` or :numpy:`dtype`, optional
+        Data type of the columns, e.g. 'float32'. Default: None (unchanged).
+
+    Returns
+    -------
+    :pandas:`DataFrame`
+        Results with a 'timestamp' index.
+
+    """
+    outputs = outputs or MODELCHAIN_OUTPUTS
+    results = modelchain_results(mc)
+    columns = {}
+    index = None
+    for output in outputs:
+        data = getattr(results, output)
+        if data is None:
+            raise ValueError(f'ModelChain output {output} is missing')
+        if index is None:
+            index = data.index
+        elif data.index is not index and not data.index.equals(index):
+            raise ValueError(f'Index of ModelChain output {output} differs '
+                             f'from {outputs[0]}')
+        if isinstance(data, pd.Series):
+            data = {output: data}
+        for name, values in data.items():
+            if name in columns:
+                raise ValueError(f'Duplicate result column {name}')
+            columns[name] = values.values if dtype is None \
+                else values.values.astype(dtype, copy=False)
+
+    return pd.DataFrame(columns, index=index.rename('timestamp'))
+
+
+def results_modelchain(mc, weather, append=False, sink=None, outputs=None,
+                       dtype=None):
     system_name = mc.system.name
-    li_mc_ac = mc.ac
-    li_mc_temp = mc.cell_temperature
-    df_mc_dc = mc.dc
-    df_mc_dc.index.name = 'timestamp'
-    df_mc_weather = mc.weather
-    df_mc_weather.index.name = 'timestamp'
+    df = assemble_modelchain_results(mc, outputs=outputs, dtype=dtype)
 
-    df = pd.DataFrame({'ac': li_mc_ac,
-                       'cell_temperature': li_mc_temp,
-                       })
-    df.index.name = 'timestamp'
+    (sink or default_sink).write('timeseries', df, weather, system_name,
+                                 append=append)
 
-    df = df.merge(df_mc_dc, on='timestamp', how='right')
-    df = df.merge(df_mc_weather, on='timestamp', how='right')
+    return df
 
-    filename = f'pv3_pvlib_{weather}_{system_name}'
-    write_to_csv(f'./data/{filename}.csv', df, append=False)
 
-    return df
+def monthly_sums(df):
+    """Monthly sums of AC and DC power of a result time series."""
+    return df[['ac', 'p_mp']].resample(MONTH_END).sum()
 
 
-def results_modelchain_per_month(mc, df, weather):
-    system_name = mc.system.name
-    df_month = df[['ac', 'p_mp']].resample('M').sum()
+def results_modelchain_per_month(mc, df, weather, sink=None):
+    return write_monthly_sums(mc.system.name, monthly_sums(df), weather,
+                              sink=sink)
+
+
+def write_monthly_sums(system_name, df_month, weather, sink=None):
+    """Write monthly sums of AC and DC power to file."""
+    df_month = df_month.copy()
     df_month.insert(0, "weather", weather, True)
     df_month.insert(0, "system_name", system_name, True)
 
-    write_to_csv(f'./data/pv3_pvlib_month.csv', df_month, append=True)
+    (sink or default_sink).write('month', df_month, weather, system_name)
 
     return df_month
 
 
-def results_modelchain_annual_yield(mc, weather):
-    mc_ac = mc.ac
+def results_modelchain_annual_yield(mc, weather, sink=None):
+    mc_ac = modelchain_results(mc).ac
     system_name = mc.system.name
 
-    annual_yield = round(mc_ac.sum() / 1000, 3)
+    return write_annual_yield(system_name, mc_ac.sum(), weather, sink=sink)
+
+
+def write_annual_yield(system_name, ac_energy, weather, sink=None):
+    """Write annual yield (sum of AC power / 1000) to file."""
+    annual_yield = round(ac_energy / 1000, 3)
     df = pd.DataFrame([[weather, system_name, annual_yield]],
                       columns=['weather', 'system', 'annual_yield'])
     df.set_index(["weather", 'system'], inplace=True)
 
-    write_to_csv('./data/pv3_pvlib_annual.csv', df)
+    (sink or default_sink).write('annual', df, weather, system_name)
 
     log.info(f'Annual yield for {system_name}: {annual_yield}')
 
@@ -15,32 +15,46 @@ __url__ = "https://www.gnu.org/licenses/agpl-3.0.en.html"
 __author__ = "Ludee;"
 __version__ = "v0.0.2"
 
-import pvlib
-from pvlib.location import Location
-from pvlib.pvsystem import PVSystem
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import pandas as pd
 from pvlib.modelchain import ModelChain
-from pvlib.temperature import TEMPERATURE_MODEL_PARAMETERS
 
-from settings import HTW_LAT, HTW_LON
+from settings import HTW_LAT, HTW_LON, MODEL_WORKERS
 
-from component_import import get_sma_sb_3000hf, get_danfoss_dlx_2_9, get_aleo_s18_240, get_aleo_s19_245, get_aleo_s19_285, get_schott_asi_105
+from pv3_batch import get_orientation
+from pv3_cache import CachedLocation, fingerprint, poa_cache
+from pv3_catalogue import get_pvsystem
+from pv3_instrumentation import Instrumentation, instrumentation, stage
+from pv3_surrogate import surrogate_dc as surrogate_dc_model, \
+    surrogate_key
 
 import logging
 log = logging.getLogger(__name__)
 
-temperature_model_parameters = TEMPERATURE_MODEL_PARAMETERS['sapm']['open_rack_glass_glass']
+# keyword arguments of the ModelChain created by setup_modelchain
+MODELCHAIN_OPTIONS = {'aoi_model': 'no_loss', 'spectral_model': 'no_loss'}
+
+# location, weather data and POA irradiance shared by all scenarios of a
+# worker process
+_scenario_data = {}
 
 
 def setup_pvlib_location_object():
     """
     Sets up pvlib Location object for HTW.
 
+    Solar positions of the location are cached, so that ModelChains with the
+    same weather data share them.
+
     Returns
     -------
     :pvlib:`Location`
 
     """
-    return Location(latitude=HTW_LAT, longitude=HTW_LON,
+    return CachedLocation(latitude=HTW_LAT, longitude=HTW_LON,
                     tz='Europe/Berlin', altitude=80, name='HTW Berlin')
 
 
@@ -48,6 +62,9 @@ def setup_htw_pvlib_pvsystems(converter_number):
     """
     Sets up pvlib PVSystem for HTW Modules.
 
+    The systems are defined as 'HTW_module_1' to 'HTW_module_5' in the
+    system catalogue, see `pv3_catalogue`.
+
     Parameters
     -----------
     converter_number : :obj:`str`
@@ -59,208 +76,212 @@ def setup_htw_pvlib_pvsystems(converter_number):
     :pvlib:`PVSystem`
 
     """
-
-    # get module and inverter parameters
-    sandia_modules = pvlib.pvsystem.retrieve_sam('SandiaMod')
-    sandia_inverters = pvlib.pvsystem.retrieve_sam('sandiainverter')
-    CEC_modules = pvlib.pvsystem.retrieve_sam('CECMod')
-    CEC_inverters = pvlib.pvsystem.retrieve_sam('sandiainverter')
-
-    inv_sma = 'SMA_Solar_Technology_AG__SB3000HFUS_30___240V_240V__CEC_2011_'
-    inv_danfoss = 'Danfoss_Solar__DLX_2_9_UL__240V__240V__CEC_2013_'
-
-    # module 1 - Schott aSi 105W / Danfoss DLX 2.9
-    if converter_number == 'wr1':
-        pv_module = PVSystem(module='schott_aSi_105', inverter=inv_danfoss,
-                             module_parameters=CEC_modules[
-                                 'schott_aSi_105'],
-                             inverter_parameters=CEC_inverters[inv_danfoss],
-                             surface_tilt=14.57, surface_azimuth=215.,
-                             albedo=0.2,
-                             modules_per_string=10, strings_per_inverter=3,
-                             name='HTW_module_1')
-        pv_module.module_parameters['EgRef'] = 1.121  # The energy bandgap at reference temperature in eV.
-        pv_module.module_parameters['dEgdT'] = -0.0002677 #The temperature dependence of EgRef at reference conditions in 1/K.
-        pv_module.module_parameters['alpha_sc'] = 0.04 # The short-circuit current temperature coefficient
-
-    # module 2 - Aleo S19 285W / Danfoss DLX 2.9 'Aleo_Solar_S19H270' CEC
-    elif converter_number == 'wr2':
-        pv_module = PVSystem(module='aleo_solar_S19_285', inverter=inv_danfoss,
-                             module_parameters=CEC_modules[
-                                 'aleo_solar_S19_285'],
-                             inverter_parameters=CEC_inverters[inv_danfoss],
-                             surface_tilt=14.57, surface_azimuth=215.,
-                             albedo=0.2,
-                             modules_per_string=11, strings_per_inverter=1,
-                             name='HTW_module_2')
-        pv_module.module_parameters['EgRef'] = 1.121
-        pv_module.module_parameters['dEgdT'] = -0.0002677
-        pv_module.module_parameters['alpha_sc'] = 0.04
-
-    # module 3 - Aleo S18 240W / Danfoss DLX 2.9
-    elif converter_number == 'wr3':
-        pv_module = PVSystem(module='aleo_solar_S18_240', inverter=inv_danfoss,
-                             module_parameters=CEC_modules[
-                                 'aleo_solar_S18_240'],
-                             inverter_parameters=CEC_inverters[inv_danfoss],
-                             surface_tilt=14.57, surface_azimuth=215.,
-                             albedo=0.2,
-                             modules_per_string=14, strings_per_inverter=1,
-                             name='HTW_module_3')
-        pv_module.module_parameters['EgRef'] = 1.121
-        pv_module.module_parameters['dEgdT'] = -0.0002677
-        pv_module.module_parameters['alpha_sc'] = 0.04
-
-    # module 4 - Aleo S19 245W / SMA SB 3000HF-30
-    elif converter_number == 'wr4':
-        pv_module = PVSystem(module='Aleo_Solar_S19U245_ulr', inverter=inv_sma,
-                             module_parameters=CEC_modules[
-                                 'Aleo_Solar_S19U245_ulr'],
-                             inverter_parameters=CEC_inverters[inv_sma],
-                             surface_tilt=14.57, surface_azimuth=215.,
-                             albedo=0.2,
-                             modules_per_string=13, strings_per_inverter=1,
-                             name='HTW_module_4')
-        pv_module.module_parameters['EgRef'] = 1.121
-        pv_module.module_parameters['dEgdT'] = -0.0002677
-        pv_module.module_parameters['alpha_sc'] = 0.03
-    # module 5 - Schott aSi 105W / SMA SB 3000HF-30
-    elif converter_number == 'wr5':
-        pv_module = PVSystem(module='schott_aSi_105', inverter=inv_danfoss,
-                             module_parameters=CEC_modules[
-                                 'schott_aSi_105'],
-                             inverter_parameters=CEC_inverters[inv_danfoss],
-                             surface_tilt=14.57, surface_azimuth=215.,
-                             albedo=0.2,
-                             modules_per_string=10, strings_per_inverter=3,
-                             name='HTW_module_5')
-        pv_module.module_parameters['EgRef'] = 1.121
-        pv_module.module_parameters['dEgdT'] = -0.0002677
-        pv_module.module_parameters['alpha_sc'] = 0.04
-    return pv_module
+    return get_pvsystem('HTW_module_{}'.format(converter_number[2:]))
 
 
 def setup_htw_pvsystem_wr1():
-
-    inv = 'Danfoss_Solar__DLX_2_9'
-    inv_data = get_danfoss_dlx_2_9()
-    wr1_module = 'Schott a-Si 105 W'
-    module_data = get_schott_asi_105()
-
-    model_wr1 = PVSystem(module=wr1_module,
-                         inverter=inv,
-                         module_parameters=module_data,
-                         inverter_parameters=inv_data,
-                         surface_tilt=14.57,
-                         surface_azimuth=215.,
-                         albedo=0.2,
-                         modules_per_string=10,
-                         strings_per_inverter=3,
-                         temperature_model_parameters=temperature_model_parameters,
-                         name='wr1')
-
-    return model_wr1
+    """Returns the PVSystem 'wr1' of the system catalogue."""
+    return get_pvsystem('wr1')
 
 
 def setup_htw_pvsystem_wr2():
+    """Returns the PVSystem 'wr2' of the system catalogue."""
+    return get_pvsystem('wr2')
 
-    # Download parameters for pv
-    cec_modules = pvlib.pvsystem.retrieve_sam('CECMod')
 
-    inv = 'Danfoss_Solar__DLX_2_9'
-    inv_data = get_danfoss_dlx_2_9()
-    wr2_module = 'Aleo_Solar_S19y285'
-
-    model_wr2 = PVSystem(module=wr2_module,
-                         inverter=inv,
-                         module_parameters=cec_modules[wr2_module],
-                         inverter_parameters=inv_data,
-                         surface_tilt=14.57,
-                         surface_azimuth=215.,
-                         albedo=0.2,
-                         modules_per_string=11,
-                         strings_per_inverter=1,
-                         temperature_model_parameters=temperature_model_parameters,
-                         name='wr2')
+def setup_htw_pvsystem_wr3():
+    """Returns the PVSystem 'wr3' of the system catalogue."""
+    return get_pvsystem('wr3')
 
-    return model_wr2
 
+def setup_htw_pvsystem_wr4():
+    """Returns the PVSystem 'wr4' of the system catalogue."""
+    return get_pvsystem('wr4')
 
-def setup_htw_pvsystem_wr3():
 
-    inv = 'Danfoss_Solar__DLX_2_9'
-    inv_data = get_danfoss_dlx_2_9()
-    pv3_module = 'aleo_solar_s18_240'
-    module_data = get_aleo_s18_240()
+def setup_htw_pvsystem_wr5():
+    """Returns the PVSystem 'wr5' of the system catalogue."""
+    return get_pvsystem('wr5')
 
-    model_wr3 = PVSystem(module=pv3_module,
-                         inverter=inv,
-                         module_parameters=module_data,
-                         inverter_parameters=inv_data,
-                         surface_tilt=14.57,
-                         surface_azimuth=215.,
-                         albedo=0.2,
-                         modules_per_string=14,
-                         strings_per_inverter=1,
-                         temperature_model_parameters=temperature_model_parameters,
-                         name='wr3')
 
-    return model_wr3
+def setup_modelchain(pv_system, location, surrogate_dc=False,
+                     surrogate_grid=None):
+    """
+    Sets up the ModelChain of a PVSystem with `MODELCHAIN_OPTIONS`.
 
+    With `surrogate_dc`, DC output is interpolated in the diode table of the
+    module (`pv3_surrogate.surrogate_dc`) instead of solving the single
+    diode equation for every timestep. `surrogate_grid` is the
+    (irradiance, temperature) grid of the table, default: grids of
+    `pv3_surrogate`.
+    """
+    options = dict(MODELCHAIN_OPTIONS)
+    if surrogate_dc:
+        irradiance, temperature = (None, None) if surrogate_grid is None \
+            else surrogate_grid
+        options['dc_model'] = partial(surrogate_dc_model,
+                                      irradiance=irradiance,
+                                      temperature=temperature)
+    mc = ModelChain(system=pv_system, location=location, **options)
+    return mc
 
-def setup_htw_pvsystem_wr4():
 
-    inv = 'SMA_SB_3000HF_30'
-    inv_data = get_sma_sb_3000hf()
-    pv3_module = 'aleo_solar_s19_245'
-    module_data = get_aleo_s19_245()
+def run_modelchain(mc, weather_data):
 
-    model_wr4 = PVSystem(module=pv3_module,
-                         inverter=inv,
-                         module_parameters=module_data,
-                         inverter_parameters=inv_data,
-                         surface_tilt=14.57,
-                         surface_azimuth=215.,
-                         albedo=0.2,
-                         modules_per_string=13,
-                         strings_per_inverter=1,
-                         temperature_model_parameters=temperature_model_parameters,
-                         name='wr4')
+    mc.run_model(weather=weather_data)
 
-    return model_wr4
+    return mc
 
 
-def setup_htw_pvsystem_wr5():
+def run_modelchain_from_poa(mc, weather_data, poa):
+    """
+    Runs a ModelChain with precalculated plane of array irradiance, e.g. of
+    `pv3_cache.poa_cache`, and the weather data for cell temperature.
+    """
+    mc.run_model_from_poa(pd.concat([weather_data, poa], axis=1))
 
-    inv = 'SMA_SB_3000HF_30'
-    inv_data = get_sma_sb_3000hf()
-    wr5_module = 'Schott a-Si 105 W'
-    module_data = get_schott_asi_105()
+    return mc
 
-    model_wr5 = PVSystem(module=wr5_module,
-                         inverter=inv,
-                         module_parameters=module_data,
-                         inverter_parameters=inv_data,
-                         surface_tilt=14.57,
-                         surface_azimuth=215.,
-                         albedo=0.2,
-                         modules_per_string=10,
-                         strings_per_inverter=3,
-                         temperature_model_parameters=temperature_model_parameters,
-                         name='wr5')
 
-    return model_wr5
+def _init_scenario_worker(location, weather_data, poa=None,
+                          surrogate_dc=False, surrogate_grid=None):
+    """
+    Stores location, weather data, POA irradiance and the DC model option
+    once per worker process.
+    """
+    _scenario_data['location'] = location
+    _scenario_data['weather_data'] = weather_data
+    _scenario_data['poa'] = poa or {}
+    _scenario_data['surrogate_dc'] = surrogate_dc
+    _scenario_data['surrogate_grid'] = surrogate_grid
 
 
-def setup_modelchain(pv_system, location):
+def _run_scenario(scenario):
+    """
+    Sets up and runs the ModelChain of one (PVSystem, weather) scenario.
 
-    mc = ModelChain(system=pv_system, location=location,
-                    aoi_model='no_loss', spectral_model='no_loss')
-    return mc
+    Returns the ModelChain and the stage record of the run.
+    """
+    pv_system, weather_name = scenario
+    weather_data = _scenario_data['weather_data'][weather_name]
+    poa = _scenario_data['poa'].get(
+        (get_orientation(pv_system), weather_name))
+    recorder = Instrumentation(log_records=False)
+    with recorder.stage('modelchain', rows=len(weather_data),
+                        system=pv_system.name, weather=weather_name):
+        mc = setup_modelchain(pv_system, _scenario_data['location'],
+                              surrogate_dc=_scenario_data['surrogate_dc'],
+                              surrogate_grid=_scenario_data['surrogate_grid'])
+        if poa is None:
+            mc = run_modelchain(mc, weather_data)
+        else:
+            mc = run_modelchain_from_poa(mc, weather_data, poa)
+    return mc, recorder.records[0]
+
+
+def run_modelchain_scenarios(pv_systems, weather_data, location,
+                             workers=None, run_cache=None,
+                             surrogate_dc=False, surrogate_grid=None):
+    """
+    Runs a ModelChain for every combination of PVSystem and weather data.
 
+    The scenarios are distributed over a process pool. Location and weather
+    data are sent to each worker process only once. Plane of array
+    irradiance is calculated once per orientation and weather data set with
+    `pv3_cache.poa_cache` and shared by all systems of that orientation
+    (stage 'poa'). With a `run_cache`, stored runs of unchanged scenarios
+    are reused and only the remaining scenarios are computed. Every
+    computed run is recorded as stage 'modelchain' in
+    `pv3_instrumentation.instrumentation`.
 
-def run_modelchain(mc, weather_data):
+    Parameters
+    ----------
+    pv_systems : :obj:`list`
+        List of :pvlib:`PVSystem`.
+    weather_data : :obj:`dict`
+        Dictionary with the name of the weather data set as key and the
+        weather :pandas:`DataFrame` as value.
+    location : :pvlib:`Location`
+    workers : :obj:`int`, optional
+        Number of worker processes. If 1, all scenarios are run in the main
+        process. Default: None (`settings.MODEL_WORKERS`, if that is None
+        too the number of CPUs).
+    run_cache : :obj:`pv3_cache.RunCache`, optional
+        Store of previous runs. Default: None (compute all scenarios).
+    surrogate_dc : :obj:`bool`
+        If True, use the surrogate DC model, see `setup_modelchain`.
+        Default: False.
+    surrogate_grid : :obj:`tuple`, optional
+        Grid of the diode tables, see `setup_modelchain`. Default: None.
 
-    mc.run_model(weather=weather_data)
+    Returns
+    -------
+    :obj:`list`
+        List of tuples (system name, weather name, :pvlib:`ModelChain`).
+        The order is deterministic: systems as in `pv_systems`, for each
+        system the weather data sets as in `weather_data`.
 
-    return mc
+    """
+    scenarios = [(pv_system, weather_name) for pv_system in pv_systems
+                 for weather_name in weather_data]
+
+    mcs = [None] * len(scenarios)
+    keys = [None] * len(scenarios)
+    weather_fingerprints = {weather_name: fingerprint(df)
+                            for weather_name, df in weather_data.items()}
+    if run_cache:
+        options = dict(MODELCHAIN_OPTIONS)
+        if surrogate_dc:
+            # grids and code version of the tables change the results
+            options['dc_model'] = 'surrogate'
+            options['surrogate'] = surrogate_key(surrogate_grid)
+        for idx, (pv_system, weather_name) in enumerate(scenarios):
+            keys[idx] = run_cache.key(pv_system, location, options,
+                                      weather_fingerprints[weather_name])
+            mcs[idx] = run_cache.get(keys[idx])
+        log.info(f'Reuse {len(scenarios) - mcs.count(None)} of '
+                 f'{len(scenarios)} scenarios from run cache')
+    pending = [idx for idx, mc in enumerate(mcs) if mc is None]
+
+    orientations = {(get_orientation(scenarios[idx][0]), scenarios[idx][1])
+                    for idx in pending}
+    with stage('poa', rows=len(orientations)) as record:
+        poa = {(orientation, weather_name): poa_cache.get(
+                   location, weather_data[weather_name], *orientation,
+                   transposition_model=MODELCHAIN_OPTIONS.get(
+                       'transposition_model', 'haydavies'),
+                   airmass_model=MODELCHAIN_OPTIONS.get(
+                       'airmass_model', 'kastenyoung1989'),
+                   weather_fingerprint=weather_fingerprints[weather_name])
+               for orientation, weather_name in orientations}
+        record['hits'] = poa_cache.memory.hits
+        record['misses'] = poa_cache.memory.misses
+    log.info(f'POA irradiance of {len(orientations)} orientations for '
+             f'{len(pending)} scenarios')
+
+    if workers is None:
+        workers = MODEL_WORKERS or os.cpu_count()
+    workers = min(workers, len(pending))
+
+    if workers <= 1:
+        _init_scenario_worker(location, weather_data, poa, surrogate_dc,
+                              surrogate_grid)
+        results = [_run_scenario(scenarios[idx]) for idx in pending]
+    else:
+        log.info(f'Run {len(pending)} scenarios with {workers} workers')
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_scenario_worker,
+                                 initargs=(location, weather_data, poa,
+                                           surrogate_dc,
+                                           surrogate_grid)) as pool:
+            results = list(pool.map(_run_scenario,
+                                    [scenarios[idx] for idx in pending]))
+
+    for idx, (mc, record) in zip(pending, results):
+        instrumentation.add(record)
+        mcs[idx] = mc
+        if run_cache:
+            run_cache.put(keys[idx], mc)
+
+    return [(pv_system.name, weather_name, mc)
+            for (pv_system, weather_name), mc in zip(scenarios, mcs)]
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+HTW-PV3 - Spatial index for weather data grids
+
+Nearest grid point lookup for many sites at once, by arithmetic on
+regular grids (MERRA, open_FRED) or with a KD-tree otherwise;
+Indices point directly into (site x time) stores;
+Indices are cached in memory and on disk per dataset;
+
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+__copyright__ = "© Ludwig Hülk"
+__license__ = "GNU Affero General Public License Version 3 (AGPL-3.0)"
+__url__ = "https://www.gnu.org/licenses/agpl-3.0.en.html"
+__author__ = "Ludee;"
+__version__ = "v0.0.2"
+
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from settings import SPATIAL_INDEX_CACHE_DIR
+from pv3_cache import LRUCache, fingerprint, write_pickle
+
+import logging
+log = logging.getLogger(__name__)
+
+# grid indices of the current process, keyed by dataset and coordinates
+_grid_indices = LRUCache(maxsize=8)
+
+
+def site_codes(df, columns=('lat', 'lon')):
+    """
+    Numbers the sites of a long format DataFrame.
+
+    Parameters
+    ----------
+    df : :pandas:`DataFrame`
+        Data with one row per site and timestep.
+    columns : :obj:`tuple`
+        Names of the latitude and longitude columns. Default: ('lat', 'lon').
+
+    Returns
+    -------
+    :obj:`tuple`
+        Site number of every row and the latitude and longitude of the
+        sites, sorted by latitude and longitude.
+
+    """
+    columns = list(columns)
+    codes = df.groupby(columns, sort=True).ngroup().values
+    coordinates = (df[columns].drop_duplicates().sort_values(columns)
+                   .values.astype(np.float64))
+    return codes, coordinates[:, 0], coordinates[:, 1]
+
+
+class GridIndex:
+    """
+    Nearest neighbour index over the coordinates of a weather dataset.
+
+    If the sites form a complete regular grid, the closest grid point is
+    found by rounding (O(1) per site), otherwise with a KD-tree
+    (O(log n) per site). Distances are euclidean in degrees, like
+    `tools.get_closest_coordinates`.
+
+    Parameters
+    ----------
+    latitude, longitude : :numpy:`array`
+        Coordinates of the sites, shape (sites,). Query results are
+        positions in these arrays.
+
+    """
+
+    def __init__(self, latitude, longitude):
+        self.latitude = np.asarray(latitude, dtype=np.float64)
+        self.longitude = np.asarray(longitude, dtype=np.float64)
+        self.grid = self._regular_grid()
+        self.tree = None
+        if self.grid is None:
+            self.tree = cKDTree(np.column_stack([self.latitude,
+                                                 self.longitude]))
+
+    def __len__(self):
+        return len(self.latitude)
+
+    def _regular_grid(self):
+        """
+        Returns (lat0, dlat, lon0, dlon, site number per grid cell) for a
+        complete regular grid, None otherwise.
+        """
+        lats = np.unique(self.latitude)
+        lons = np.unique(self.longitude)
+        if len(lats) < 2 or len(lons) < 2 or \
+                len(lats) * len(lons) != len(self):
+            return None
+        dlat = np.diff(lats)
+        dlon = np.diff(lons)
+        if not (np.allclose(dlat, dlat[0]) and np.allclose(dlon, dlon[0])):
+            return None
+
+        rows = np.searchsorted(lats, self.latitude)
+        cols = np.searchsorted(lons, self.longitude)
+        sites = np.full((len(lats), len(lons)), -1, dtype=np.int64)
+        sites[rows, cols] = np.arange(len(self))
+        if (sites < 0).any():
+            return None
+        return lats[0], dlat[0], lons[0], dlon[0], sites
+
+    def query(self, latitude, longitude, return_distance=False):
+        """
+        Returns the positions of the sites closest to the given coordinates.
+
+        Parameters
+        ----------
+        latitude, longitude : :obj:`float` or :numpy:`array`
+            Coordinates to look up.
+        return_distance : :obj:`bool`
+            If True, also return the distances in degrees. Default: False.
+
+        Returns
+        -------
+        :numpy:`array` or :obj:`tuple`
+            Positions in the coordinate arrays of the index, and the
+            distances if `return_distance`.
+
+        """
+        latitude = np.atleast_1d(np.asarray(latitude, dtype=np.float64))
+        longitude = np.atleast_1d(np.asarray(longitude, dtype=np.float64))
+
+        if self.grid is not None:
+            lat0, dlat, lon0, dlon, sites = self.grid
+            rows = np.clip(np.rint((latitude - lat0) / dlat), 0,
+                           sites.shape[0] - 1).astype(np.int64)
+            cols = np.clip(np.rint((longitude - lon0) / dlon), 0,
+                           sites.shape[1] - 1).astype(np.int64)
+            positions = sites[rows, cols]
+            if not return_distance:
+                return positions
+            distances = np.hypot(self.latitude[positions] - latitude,
+                                 self.longitude[positions] - longitude)
+            return positions, distances
+
+        distances, positions = self.tree.query(
+            np.column_stack([latitude, longitude]))
+        if return_distance:
+            return positions, distances
+        return positions
+
+
+def get_grid_index(latitude, longitude, dataset=None,
+                   directory=SPATIAL_INDEX_CACHE_DIR):
+    """
+    Returns the :class:`GridIndex` of the given coordinates.
+
+    Indices are kept in memory and, if `directory` is set, stored as
+    pickle files named after the dataset and a hash of the coordinates.
+
+    Parameters
+    ----------
+    latitude, longitude : :numpy:`array`
+        Coordinates of the sites.
+    dataset : :obj:`str`, optional
+        Name of the dataset, e.g. 'merra' or 'open_FRED'.
+    directory : :obj:`str`, optional
+        Directory of the on-disk cache. Default: `SPATIAL_INDEX_CACHE_DIR`.
+
+    """
+    latitude = np.asarray(latitude, dtype=np.float64)
+    longitude = np.asarray(longitude, dtype=np.float64)
+    key = fingerprint('grid_index', latitude, longitude)
+    grid_index = _grid_indices.get(key)
+    if grid_index is not None:
+        return grid_index
+
+    file_name = None
+    if directory:
+        file_name = os.path.join(directory,
+                                 f'{dataset or "grid"}_{key[:16]}.pkl')
+    if file_name and os.path.isfile(file_name):
+        grid_index = pd.read_pickle(file_name)
+    else:
+        grid_index = GridIndex(latitude, longitude)
+        log.info(f'Build {"regular grid" if grid_index.grid else "KD-tree"}'
+                 f' index over {len(grid_index)} sites of '
+                 f'{dataset or "dataset"}')
+        if file_name:
+            write_pickle(grid_index, file_name)
+
+    _grid_indices.put(key, grid_index)
+    return grid_index
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+HTW-PV3 - Chunked model execution
+
+Stream weather data from database or CSV file in chunks, regroup the rows
+into complete periods (e.g. months), run decomposition and ModelChains per
+period and append the results to the output files. Peak memory is bounded
+by one chunk plus one period, independent of the length of the data.
+
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+__copyright__ = "© Ludwig Hülk"
+__license__ = "GNU Affero General Public License Version 3 (AGPL-3.0)"
+__url__ = "https://www.gnu.org/licenses/agpl-3.0.en.html"
+__author__ = "Ludee;"
+__version__ = "v0.0.2"
+
+import pandas as pd
+
+from pv3_sonnja_pvlib import run_modelchain_scenarios
+from pv3_results import results_modelchain, modelchain_results, \
+    monthly_sums, write_annual_yield, write_monthly_sums
+from pv3_instrumentation import stage
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def _period_labels(index, freq):
+    """Period of each timestamp, in local time for timezone aware data."""
+    if getattr(index, 'tz', None) is not None:
+        index = index.tz_localize(None)
+    return index.to_period(freq)
+
+
+def iter_periods(chunks, freq='M'):
+    """
+    Regroups chunks of time series data into complete periods.
+
+    Rows of the last, possibly incomplete period of a chunk are carried over
+    and prepended to the next chunk, so that no period is split at a chunk
+    boundary.
+
+    Parameters
+    ----------
+    chunks : iterable of :pandas:`DataFrame`
+        Chunks with a :pandas:`DatetimeIndex`, sorted by time.
+    freq : :obj:`str`
+        Period frequency, e.g. 'M' (month) or 'D' (day). Default: 'M'.
+
+    Yields
+    ------
+    :pandas:`DataFrame`
+        Data of one complete period.
+
+    """
+    carry = None
+    for chunk in chunks:
+        if carry is not None:
+            chunk = pd.concat([carry, chunk])
+        if chunk.empty:
+            continue
+        periods = _period_labels(chunk.index, freq)
+        complete = periods != periods[-1]
+        for _, df_period in chunk[complete].groupby(periods[complete],
+                                                    sort=False):
+            yield df_period
+        carry = chunk[~complete]
+
+    if carry is not None and not carry.empty:
+        yield carry
+
+
+def run_chunked_pipeline(chunks, setup_weather, pv_systems, location,
+                         weather, freq='M', workers=None, sink=None,
+                         run_cache=None, surrogate_dc=False,
+                         surrogate_grid=None):
+    """
+    Runs the pvlib model period by period and appends the results to file.
+
+    Time series are written after every period. Monthly sums and annual
+    yields are summed up over all periods and written at the end, so periods
+    shorter than a month (e.g. 'D') give one complete row per month.
+
+    Parameters
+    ----------
+    chunks : iterable of :pandas:`DataFrame`
+        Raw weather data, e.g. from `settings.query_database` or
+        `settings.read_from_csv` with `chunksize`.
+    setup_weather : callable
+        Function that prepares the raw weather data of one period for pvlib,
+        e.g. `pv3_weatherdata.setup_htw_pvlib_weather`.
+    pv_systems : :obj:`list`
+        List of :pvlib:`PVSystem`.
+    location : :pvlib:`Location`
+    weather : :obj:`str`
+        Name of the weather data set used in result file names.
+    freq : :obj:`str`
+        Period frequency. Default: 'M'.
+    workers : :obj:`int`, optional
+        Number of worker processes, see `run_modelchain_scenarios`.
+    sink : :obj:`CsvResultSink` or :obj:`ParquetResultSink`, optional
+        Result sink, flushed after every period. Default: None (CSV files).
+    run_cache : :obj:`pv3_cache.RunCache`, optional
+        Store of previous runs, see `run_modelchain_scenarios`.
+    surrogate_dc : :obj:`bool`
+        If True, use the surrogate DC model, see `run_modelchain_scenarios`.
+        Default: False.
+    surrogate_grid : :obj:`tuple`, optional
+        Grid of the diode tables, see `run_modelchain_scenarios`.
+        Default: None.
+
+    Returns
+    -------
+    :obj:`dict`
+        Annual yield per system name.
+
+    """
+    ac_energy = dict.fromkeys([pv_system.name for pv_system in pv_systems],
+                              0.)
+    month_sums = {system_name: [] for system_name in ac_energy}
+    for count, df_period in enumerate(iter_periods(chunks, freq=freq)):
+        weather_data = {weather: setup_weather(df_period)}
+        log.info(f'Run {weather} period {count + 1} with {len(df_period)} '
+                 f'rows from {df_period.index[0]}')
+
+        scenarios = run_modelchain_scenarios(pv_systems, weather_data,
+                                             location, workers=workers,
+                                             run_cache=run_cache,
+                                             surrogate_dc=surrogate_dc,
+                                             surrogate_grid=surrogate_grid)
+        with stage('export', rows=sum(len(modelchain_results(mc).ac)
+                                      for _, _, mc in scenarios),
+                   weather=weather, period=count + 1):
+            for system_name, weather_name, mc in scenarios:
+                df_mc = results_modelchain(mc, weather_name,
+                                           append=count > 0, sink=sink)
+                month_sums[system_name].append(monthly_sums(df_mc))
+                ac_energy[system_name] += modelchain_results(mc).ac.sum()
+            if sink:
+                sink.flush()
+
+    for system_name, frames in month_sums.items():
+        if frames:
+            # months split over several periods are summed up
+            df_month = pd.concat(frames)
+            write_monthly_sums(system_name,
+                               df_month.groupby(level=0, sort=True).sum(),
+                               weather, sink=sink)
+    return {system_name: write_annual_yield(system_name, energy, weather,
+                                            sink=sink)
+            for system_name, energy in ac_energy.items()}
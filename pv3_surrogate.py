@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+HTW-PV3 - Surrogate single diode DC model
+
+Solve the single diode equation of a CEC module once on a grid of
+effective irradiance and cell temperature;
+Evaluate DC output by bilinear interpolation in the table instead of a full
+solve per timestep;
+Estimate the error of the table against the exact solve;
+Use the table as DC model of a ModelChain or of the batch model;
+
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+__copyright__ = "© Ludwig Hülk"
+__license__ = "GNU Affero General Public License Version 3 (AGPL-3.0)"
+__url__ = "https://www.gnu.org/licenses/agpl-3.0.en.html"
+__author__ = "Ludee;"
+__version__ = "v0.0.2"
+
+import numpy as np
+import pandas as pd
+import pvlib
+
+from pv3_cache import LRUCache, fingerprint
+
+import logging
+log = logging.getLogger(__name__)
+
+# CEC module parameters with default values of pvlib.pvsystem.calcparams_cec
+CEC_PARAMETERS = {'alpha_sc': None, 'a_ref': None, 'I_L_ref': None,
+                  'I_o_ref': None, 'R_sh_ref': None, 'R_s': None,
+                  'Adjust': None, 'EgRef': 1.121, 'dEgdT': -0.0002677,
+                  'irrad_ref': 1000, 'temp_ref': 25}
+
+# outputs of pvlib.pvsystem.singlediode
+DIODE_TABLE_COLUMNS = ['i_sc', 'v_oc', 'i_mp', 'v_mp', 'p_mp', 'i_x', 'i_xx']
+
+# version of the table and interpolation code, part of `surrogate_key`;
+# increase it on changes that alter the surrogate output
+SURROGATE_VERSION = 1
+
+# default grids, the estimated p_mp error of the modules of the system
+# catalogue is below 0.06 % of STC power (thin film modules are the most
+# sensitive to cell temperature)
+# effective irradiance in W/m², finer at low irradiance where the voltage
+# changes fastest
+IRRADIANCE_GRID = np.concatenate([np.arange(0., 50., 5.),
+                                  np.arange(50., 1501., 20.)])
+# cell temperature in °C
+TEMPERATURE_GRID = np.arange(-40., 90.1, 0.5)
+
+# tables of the current process, keyed by module parameters and grid
+_diode_tables = LRUCache(maxsize=32)
+
+
+def _grid(grid):
+    """Returns the (irradiance, temperature) grid with defaults."""
+    irradiance, temperature = (None, None) if grid is None else grid
+    return (IRRADIANCE_GRID if irradiance is None else irradiance,
+            TEMPERATURE_GRID if temperature is None else temperature)
+
+
+def surrogate_key(grid=None):
+    """
+    Returns a fingerprint of the surrogate DC model, e.g. for keys of
+    stored runs.
+
+    Parameters
+    ----------
+    grid : :obj:`tuple`, optional
+        (irradiance, temperature) grid of the tables, see
+        `DiodeTable.from_module`. Default: None (`IRRADIANCE_GRID`,
+        `TEMPERATURE_GRID`).
+
+    Returns
+    -------
+    :obj:`str`
+
+    """
+    irradiance, temperature = _grid(grid)
+    return fingerprint('surrogate', SURROGATE_VERSION,
+                       np.asarray(irradiance, dtype=np.float64),
+                       np.asarray(temperature, dtype=np.float64))
+
+
+def cec_module_parameters(module_parameters):
+    """
+    Returns the parameters of `pvlib.pvsystem.calcparams_cec` of a module,
+    with defaults for missing optional parameters.
+    """
+    parameters = {}
+    for parameter, default in CEC_PARAMETERS.items():
+        value = module_parameters.get(parameter, default)
+        if value is None:
+            raise ValueError(f'CEC module parameter {parameter} is missing')
+        parameters[parameter] = float(value)
+    return parameters
+
+
+def _solve(module_parameters, effective_irradiance, cell_temperature):
+    """
+    Exact single diode solve like `pvlib.modelchain.ModelChain.cec`, for
+    arrays of any shape.
+    """
+    # singlediode of newer pvlib versions returns a DataFrame and needs
+    # 1-D inputs
+    shape = np.shape(effective_irradiance)
+    dc = pvlib.pvsystem.singlediode(*pvlib.pvsystem.calcparams_cec(
+        np.ravel(effective_irradiance), np.ravel(cell_temperature),
+        **module_parameters))
+    return {key: np.nan_to_num(np.asarray(dc[key], dtype=np.float64))
+            .reshape(shape) for key in DIODE_TABLE_COLUMNS}
+
+
+def _cells(grid, values):
+    """
+    Returns the lower grid index and the interpolation weight of every
+    value. Values outside the grid get the value of the closest edge.
+    """
+    idx = np.clip(np.searchsorted(grid, values, side='right') - 1, 0,
+                  len(grid) - 2)
+    weight = (values - grid[idx]) / (grid[idx + 1] - grid[idx])
+    return idx, np.clip(weight, 0., 1.)
+
+
+class DiodeTable:
+    """
+    Single diode outputs of one module on a grid of effective irradiance
+    and cell temperature.
+
+    Parameters
+    ----------
+    irradiance : :numpy:`array`
+        Ascending effective irradiance grid in W/m², starting at 0.
+    temperature : :numpy:`array`
+        Ascending cell temperature grid in °C.
+    values : :obj:`dict`
+        `DIODE_TABLE_COLUMNS` as keys and arrays of shape
+        (len(irradiance), len(temperature)) as values.
+    error : :obj:`dict`, optional
+        Error estimate, see `estimate_error`.
+
+    """
+
+    def __init__(self, irradiance, temperature, values, error=None):
+        self.irradiance = np.asarray(irradiance, dtype=np.float64)
+        self.temperature = np.asarray(temperature, dtype=np.float64)
+        self.values = values
+        self.error = error
+
+    @classmethod
+    def from_module(cls, module_parameters, irradiance=None,
+                    temperature=None):
+        """
+        Solves the single diode equation of a CEC module on a grid.
+
+        Parameters
+        ----------
+        module_parameters : :pandas:`Series` or :obj:`dict`
+            CEC module parameters.
+        irradiance : :numpy:`array`, optional
+            Effective irradiance grid in W/m². Default: `IRRADIANCE_GRID`.
+        temperature : :numpy:`array`, optional
+            Cell temperature grid in °C. Default: `TEMPERATURE_GRID`.
+
+        Returns
+        -------
+        :class:`DiodeTable`
+
+        """
+        irradiance, temperature = _grid((irradiance, temperature))
+        parameters = cec_module_parameters(module_parameters)
+        grid_irradiance, grid_temperature = np.meshgrid(
+            irradiance, temperature, indexing='ij')
+        table = cls(irradiance, temperature,
+                    _solve(parameters, grid_irradiance, grid_temperature))
+        table.error = table.estimate_error(parameters)
+        return table
+
+    @property
+    def shape(self):
+        return len(self.irradiance), len(self.temperature)
+
+    def interpolate(self, effective_irradiance, cell_temperature):
+        """
+        Returns the DC output of one module by bilinear interpolation.
+
+        Irradiance of 0 W/m² or below gives zero output, values outside the
+        grid get the value of the closest edge.
+
+        Parameters
+        ----------
+        effective_irradiance, cell_temperature : :numpy:`array`
+            Arrays of the same shape.
+
+        Returns
+        -------
+        :obj:`dict`
+            `DIODE_TABLE_COLUMNS` as keys and arrays of the input shape as
+            values.
+
+        """
+        effective_irradiance = np.asarray(effective_irradiance,
+                                          dtype=np.float64)
+        cell_temperature = np.asarray(cell_temperature, dtype=np.float64)
+        outside = np.count_nonzero(
+            (effective_irradiance > self.irradiance[-1]) |
+            (cell_temperature < self.temperature[0]) |
+            (cell_temperature > self.temperature[-1]))
+        if outside:
+            log.warning(f'{outside} values outside the grid of the diode '
+                        f'table are clipped')
+
+        i, wi = _cells(self.irradiance, effective_irradiance)
+        t, wt = _cells(self.temperature, cell_temperature)
+        lower = i * len(self.temperature) + t
+        upper = lower + len(self.temperature)
+        w00 = (1 - wi) * (1 - wt)
+        w01 = (1 - wi) * wt
+        w10 = wi * (1 - wt)
+        w11 = wi * wt
+        result = {}
+        for key in DIODE_TABLE_COLUMNS:
+            values = self.values[key].ravel()
+            result[key] = (w00 * values[lower] + w01 * values[lower + 1] +
+                           w10 * values[upper] + w11 * values[upper + 1])
+        return result
+
+    def estimate_error(self, module_parameters):
+        """
+        Estimates the interpolation error against the exact solve.
+
+        The exact solve is evaluated at the centre of every grid cell, where
+        bilinear interpolation is least accurate.
+
+        Parameters
+        ----------
+        module_parameters : :obj:`dict`
+            CEC module parameters, see `cec_module_parameters`.
+
+        Returns
+        -------
+        :obj:`dict`
+            'p_mp_max_abs' (W) and 'p_mp_max_rel' (relative to `p_mp` at
+            1000 W/m² and 25 °C), maximum error of one module.
+
+        """
+        irradiance = (self.irradiance[:-1] + self.irradiance[1:]) / 2
+        temperature = (self.temperature[:-1] + self.temperature[1:]) / 2
+        grid_irradiance, grid_temperature = np.meshgrid(
+            irradiance, temperature, indexing='ij')
+        exact = _solve(module_parameters, grid_irradiance, grid_temperature)
+        surrogate = self.interpolate(grid_irradiance, grid_temperature)
+        p_mp_stc = _solve(module_parameters, np.array([1000.]),
+                          np.array([25.]))['p_mp'][0]
+        error = np.abs(surrogate['p_mp'] - exact['p_mp']).max()
+        return {'p_mp_max_abs': error, 'p_mp_max_rel': error / p_mp_stc}
+
+
+def get_diode_table(module_parameters, irradiance=None, temperature=None):
+    """
+    Returns the :class:`DiodeTable` of a module, built once per process
+    and kept in memory for modules with the same parameters and grid.
+    """
+    parameters = cec_module_parameters(module_parameters)
+    key = fingerprint('diode_table', parameters,
+                      surrogate_key((irradiance, temperature)))
+    table = _diode_tables.get(key)
+    if table is None:
+        table = DiodeTable.from_module(parameters, irradiance=irradiance,
+                                       temperature=temperature)
+        log.info(f'Diode table {table.shape} of module '
+                 f'{getattr(module_parameters, "name", None)}, estimated '
+                 f'p_mp error {table.error["p_mp_max_rel"]:.3%} of STC power')
+        _diode_tables.put(key, table)
+    return table
+
+
+def surrogate_dc(mc, irradiance=None, temperature=None):
+    """
+    DC model of a :pvlib:`ModelChain` using the :class:`DiodeTable` of the
+    module instead of the exact single diode solve.
+
+    Use as `ModelChain(system, location, dc_model=surrogate_dc)`, or
+    with `functools.partial` to set the grids. Like
+    `pvlib.modelchain.ModelChain.cec`, the output is scaled to the string
+    layout and missing values are set to zero. Only ModelChains of
+    PVSystems with a single array are supported.
+
+    Parameters
+    ----------
+    mc : :pvlib:`ModelChain`
+    irradiance, temperature : :numpy:`array`, optional
+        Grids of the table, see `DiodeTable.from_module`.
+
+    Returns
+    -------
+    :pvlib:`ModelChain`
+
+    """
+    # pvlib 0.9 keeps the outputs in mc.results and the modules on arrays
+    results = getattr(mc, 'results', mc)
+    array = getattr(mc.system, 'arrays', [mc.system])[0]
+    table = get_diode_table(array.module_parameters,
+                            irradiance=irradiance, temperature=temperature)
+    dc = table.interpolate(results.effective_irradiance.values,
+                           results.cell_temperature.values)
+    results.dc = mc.system.scale_voltage_current_power(
+        pd.DataFrame(dc, index=results.effective_irradiance.index)).fillna(0)
+    return mc
@@ -8,11 +8,11 @@ PDX-License-Identifier: AGPL-3.0-or-later
 
 import json
 import pandas as pd
-import pvlib as pvl
 import re
 import os
 
 from settings import setup_logger
+from component_import import retrieve_sam
 
 """logging"""
 log = setup_logger()
@@ -29,7 +29,7 @@ def search_dbs(path):
     DB_NAMES = ['CECInverter', 'CECMod', 'SandiaMod', 'ADRInverter']
     dbs = {}
     for db in DB_NAMES:
-        dbs[db] = pvl.pvsystem.retrieve_sam(db)
+        dbs[db] = retrieve_sam(db)
 
     print("enter 'str' to extend keywordlist to search dbs")
     print("enter '-' to clear keywordlist")
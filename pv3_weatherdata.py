@@ -18,8 +18,6 @@ __version__ = "v0.0.2"
 import datetime
 
 import pandas as pd
-import os
-from datetime import timedelta
 from collections import OrderedDict
 import pvlib
 from pvlib import tools
@@ -27,7 +25,19 @@ import numpy as np
 
 from pvlib.irradiance import clearness_index, get_extra_radiation
 
+from settings import HTW_LAT, HTW_LON
+from pv3_cache import solar_position_cache
+from pv3_channelstore import get_converter_store, get_htw_weather_store
+from pv3_instrumentation import instrumented, stage
+from pv3_pyramid import WEATHER_DATA_LEVELS, get_pyramid
 
+HTW_WEATHERDATA_NAMES = {'g_hor_si': 'ghi',
+                         'v_wind': 'wind_speed',
+                         't_luft': 'temp_air'}
+PVLIB_WEATHER_COLUMNS = ['ghi', 'dhi', 'dni', 'wind_speed', 'temp_air']
+
+
+@instrumented('decomposition', rows=len)
 def calculate_diffuse_irradiation(df, parameter_name, lat, lon):
     """
     Calculate diffuse irradiation
@@ -52,7 +62,8 @@ def calculate_diffuse_irradiation(df, parameter_name, lat, lon):
     """
 
     # calculate dhi and dni for htw weatherdata
-    df_solarpos = pvlib.solarposition.spa_python(df.index, lat, lon)
+    df_solarpos = solar_position_cache.get(df.index, lat, lon, altitude=0,
+                                           pressure=101325.)
 
     # Calculate dhi and dni from parameter
     df_irradiance = pvlib.irradiance.erbs(ghi=df.loc[:, parameter_name],
@@ -65,10 +76,67 @@ def calculate_diffuse_irradiation(df, parameter_name, lat, lon):
     return df_irradiance
 
 
-def setup_converter_dataframe(converter, weather_data):
+def setup_htw_pvlib_weather(df_htw, resample_rule='h'):
+    """
+    Sets up HTW weather data from sonnja_db for the pvlib model.
+
+    Renames the columns, calculates DHI and DNI from GHI and resamples the
+    data.
+
+    Parameters
+    ----------
+    df_htw : DataFrame
+        HTW weather data from pv3.pv3_weather_2015_filled_mview
+    resample_rule : str
+        Resolution of the returned data. Default: 'h'.
+
+    Returns
+    -------
+    DataFrame
+        GHI, DHI, DNI, wind speed and air temperature
     """
-    Reads HTW converter data from original files for given converter and sets
-    up a dataframe.
+    df_htw = df_htw.rename(columns=HTW_WEATHERDATA_NAMES)
+    df_dhi = calculate_diffuse_irradiation(df_htw, 'ghi', HTW_LAT, HTW_LON)
+    df_htw = df_htw.merge(df_dhi[['dhi', 'dni']], left_index=True,
+                          right_index=True)
+    # decomposition is recorded as its own stage, time only the resampling
+    with stage('resample', rows=len(df_htw)):
+        df_htw_select = df_htw.loc[:, PVLIB_WEATHER_COLUMNS]
+        df_htw_pvlib = df_htw_select.resample(resample_rule).mean()
+        return df_htw_pvlib.round(1)
+
+
+@instrumented('resample', rows=len)
+def setup_fred_pvlib_weather(df_fred, resample_rule='h'):
+    """
+    Sets up open_FRED weather data from sonnja_db for the pvlib model.
+
+    Parameters
+    ----------
+    df_fred : DataFrame
+        open_FRED weather data from pv3.openfred_weatherdata_2015_htw
+    resample_rule : str
+        Resolution of the returned data. Default: 'h'.
+
+    Returns
+    -------
+    DataFrame
+        GHI, DHI, DNI, wind speed and air temperature
+    """
+    df_fred_select = df_fred.loc[:, PVLIB_WEATHER_COLUMNS]
+    df_fred_pvlib = df_fred_select.resample(resample_rule).mean()
+    return df_fred_pvlib.round(1)
+
+
+def setup_converter_dataframe(converter, weather_data, channels=None,
+                              start=None, end=None):
+    """
+    Reads HTW converter data for given converter and sets up a dataframe.
+
+    The data is read from the memory-mapped channel store of the converter
+    (see `pv3_channelstore`) and, for a weather data set, from the level of
+    its resolution pyramid (see `pv3_pyramid`) that matches the resolution
+    of the weather data. Store and pyramid are built on first use.
 
     Parameters
     ----------
@@ -79,6 +147,11 @@ def setup_converter_dataframe(converter, weather_data):
         Weather data that is used for calculated feed-in. The HTW data
         is resampled depending on the weather data. Possible choices are
         'open_FRED' and 'MERRA'.
+    channels : list, optional
+        Channels to read, e.g. ['P_DC']. Default: all channels.
+    start, end : str or pandas.Timestamp, optional
+        First and last timestamp to read, in local time of the original
+        file (GMT+1). Default: whole year.
 
     Returns
     --------
@@ -86,25 +159,17 @@ def setup_converter_dataframe(converter, weather_data):
         DataFrame with time series for feed-in etc..
 
     """
-    file_directory = 'data/htw_2015/einleuchtend_data_2015'
-    data = pd.read_csv(
-        os.path.join(file_directory,
-                     'einleuchtend_wrdata_2015_{}.csv'.format(converter)),
-        sep=';', header=[0], index_col=[0], parse_dates=True)
-    # resample to same resolution as weather data
-    if weather_data == 'open_FRED':
-        data = data.resample('30Min', loffset=timedelta(hours=0.25)).mean()
-    elif weather_data == 'MERRA':
-        data = data.resample('60Min', base=30,
-                             loffset=timedelta(hours=0.5)).mean()
-    data = data.tz_localize('Etc/GMT-1')
-    data = data.tz_convert('Europe/Berlin')
-    return data
+    data = read_measured_data(get_converter_store(converter), weather_data,
+                              channels, start, end)
+    return data.tz_convert('Europe/Berlin')
 
 
-def setup_weather_dataframe(weather_data):
+def setup_weather_dataframe(weather_data, start=None, end=None):
     """
-    Reads HTW weather data from original file and sets up a dataframe.
+    Reads HTW weather data and sets up a dataframe.
+
+    The data is read like in `setup_converter_dataframe`, from the channel
+    store of the weather station.
 
     Parameters
     ----------
@@ -112,6 +177,9 @@ def setup_weather_dataframe(weather_data):
         Weather data that is used for calculated feed-in. The HTW data
         is resampled depending on the weather data. Possible choices are
         'open_FRED' and 'MERRA'.
+    start, end : str or pandas.Timestamp, optional
+        First and last timestamp to read, in local time of the original
+        file (GMT+1). Default: whole year.
 
     Returns
     --------
@@ -120,28 +188,47 @@ def setup_weather_dataframe(weather_data):
         and air temperature in °C.
 
     """
-    file_directory = 'data/pv3_2015'
-    data = pd.read_csv(
-        os.path.join(file_directory, 'htw_wetter_weatherdata_2015.csv'),
-        sep=';', header=[0], index_col=[0], parse_dates=True)
-
     # select and rename columns
     columns = {'G_hor_CMP6': 'ghi',
                'G_gen_CMP11': 'gni',
                'v_Wind': 'wind_speed',
                'T_Luft': 'temp_air'}
-    data = data[list(columns.keys())]
+    data = read_measured_data(get_htw_weather_store(), weather_data,
+                              list(columns.keys()), start, end)
     data.rename(columns=columns, inplace=True)
-    # resample to same resolution as weather data
-    if weather_data == 'open_FRED':
-        data = data.resample('30Min', loffset=timedelta(hours=0.25)).mean()
-    elif weather_data == 'MERRA':
-        data = data.resample('60Min', base=30,
-                             loffset=timedelta(hours=0.5)).mean()
-    data = data.tz_localize('Etc/GMT-1')  # GMT+1??
     data = data.tz_convert('Europe/Berlin')
     return data
 
+
+def read_measured_data(store, weather_data, channels=None, start=None,
+                       end=None):
+    """
+    Reads measured data in the resolution of a weather data set.
+
+    Parameters
+    ----------
+    store : pv3_channelstore.ChannelStore
+        Channel store of the measured data.
+    weather_data : String
+        'open_FRED' (30 min means labelled hh:15 and hh:45) or 'MERRA'
+        (60 min means from hh:30 to hh+1:30, labelled hh+1:00), see
+        `pv3_pyramid.WEATHER_DATA_LEVELS`. Other values return the raw data.
+    channels : list, optional
+        Channels to read. Default: all channels.
+    start, end : str or pandas.Timestamp, optional
+        First and last timestamp. Default: whole time range.
+
+    Returns
+    --------
+    pandas.DataFrame
+        Means per timestep, in the time zone of the store.
+
+    """
+    level = WEATHER_DATA_LEVELS.get(weather_data)
+    if level is None:
+        return store.read(channels, start, end)
+    return get_pyramid(store).read(level, channels, start, end)
+
 # def erbs (ghi, zenith,datetime_or_doy, min_cos_zenith=0.065, max_zenith=87):
     # dni_extra = get_extra_radiation(datetime_or_doy)
 
@@ -17,6 +17,9 @@ __author__ = "Ludee;"
 __version__ = "v0.0.2"
 
 import os
+import re
+import sys
+from urllib.parse import quote_plus
 import pandas as pd
 from sqlalchemy import *
 
@@ -30,6 +33,47 @@ log_file = 'pv3.log'
 HTW_LAT = 52.45544
 HTW_LON = 13.52481
 
+# database connection, credentials are read by database_url
+DB_NAME = 'sonnja_db'
+DB_DEFAULTS = {'host': 'localhost', 'port': 5432, 'user': 'sonnja'}
+DB_POOL_SIZE = 5
+DB_MAX_OVERFLOW = 10
+# pooled engines per (process id, url)
+_engines = {}
+
+# fields of postgres date_trunc supported by query_database
+DATE_TRUNC_FIELDS = ['minute', 'hour', 'day', 'week', 'month', 'quarter',
+                     'year']
+
+# number of worker processes for model runs, None uses all CPUs
+MODEL_WORKERS = None
+
+# number of worker processes for rendering figures, None uses all CPUs
+PLOT_WORKERS = None
+
+# catalogue of PV systems with components, string layout and orientation
+SYSTEM_CATALOGUE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'pv3_systems.yml')
+
+# local catalogue of sandia inverters fitted to datasheet efficiency tables
+INVERTER_CATALOGUE = os.path.join('data', 'inverters', 'sandia_inverters.json')
+
+# directory for cached component tables and intermediate results
+CACHE_DIR = os.path.join('data', 'cache')
+
+# set to a directory (e.g. os.path.join(CACHE_DIR, 'solarposition')) to
+# store calculated solar positions on disk, None keeps them in memory only
+SOLARPOSITION_CACHE_DIR = None
+
+# directory of stored ModelChain runs, reused for unchanged scenarios
+RUN_CACHE_DIR = os.path.join(CACHE_DIR, 'modelchain')
+
+# directory of spatial indices over weather dataset coordinates
+SPATIAL_INDEX_CACHE_DIR = os.path.join(CACHE_DIR, 'spatial')
+
+# directory of memory-mapped channel stores of measured data
+CHANNEL_STORE_DIR = os.path.join(CACHE_DIR, 'channels')
+
 
 def setup_logger():
     """Configure logging in console and log file.
@@ -63,45 +107,182 @@ def setup_logger():
     return rl
 
 
-def postgres_session():
-    """SQLAlchemy session object with valid connection to local database
-    Inputs
+def database_url():
+    """Database URL from environment, config file or defaults.
+
+    The environment variable PV3_DB_URL overrides everything. Otherwise each
+    of host, port, user and password is taken from PV3_DB_HOST, PV3_DB_PORT,
+    PV3_DB_USER and PV3_DB_PASSWORD, then from the section `DB_NAME` in
+    config.ini (keys host, port, user, pw, see config.config_section_set),
+    then from `DB_DEFAULTS`. The password is only asked for interactively
+    if it is not found and a terminal is attached.
+
+    Returns
+    -------
+    url : str
+        SQLAlchemy database URL.
+    """
+    url = os.environ.get('PV3_DB_URL')
+    if url:
+        return url
+
+    from config import config_section_get
+    cfg = config_section_get(DB_NAME)
+    params = {}
+    for key, cfg_key in [('host', 'host'), ('port', 'port'), ('user', 'user'),
+                         ('password', 'pw')]:
+        params[key] = (os.environ.get(f'PV3_DB_{key.upper()}') or
+                       cfg.get(cfg_key) or DB_DEFAULTS.get(key))
+    if params['password'] is None:
+        if not sys.stdin.isatty():
+            raise ValueError('No database password found, set PV3_DB_PASSWORD '
+                             'or create config.ini')
+        params['password'] = input('password: ')
+        # password = getpass.getpass(prompt='password: ',
+        #                           stream=sys.stderr)
+
+    return 'postgresql://' + '%s:%s@%s:%s/%s' % (params['user'],
+                                                  quote_plus(params['password']),
+                                                  params['host'],
+                                                  params['port'],
+                                                  DB_NAME)
+
+
+def get_engine(url=None):
+    """SQLAlchemy engine with connection pool, created once per process.
+
+    Connections are checked with pre-ping before use. Engines are not shared
+    with forked worker processes, each process creates its own.
+
+    Parameters
+    ----------
+    url : str
+        Database URL. Default: None (see database_url).
+
+    Returns
     -------
-    port : int
-        Database port
-    password : str
-        Database password
+    engine : Engine
+        SQLAlchemy engine.
+    """
+    if url is None:
+        url = database_url()
+    key = (os.getpid(), url)
+    if key not in _engines:
+        kwargs = {'pool_pre_ping': True}
+        if not url.startswith('sqlite'):
+            kwargs.update(pool_size=DB_POOL_SIZE,
+                          max_overflow=DB_MAX_OVERFLOW)
+        _engines[key] = create_engine(url, **kwargs)
+    return _engines[key]
+
+
+def postgres_session(url=None):
+    """SQLAlchemy connection to the database from the pooled engine.
+
+    Parameters
+    ----------
+    url : str
+        Database URL, e.g. 'sqlite://' for tests. Default: None
+        (see database_url).
+
     Returns
     -------
     con : connection
         SQLAlchemy connection object.
     """
 
-    print('Please provide connection parameters to database:\n' +
-          'Hit [Enter] to take defaults')
-    host = 'localhost'  # input('host (default 127.0.0.1): ')
-    port = int(input('port (default 5432): ') or 5432)  # port = '5435'
-    database = 'sonnja_db'  # input("database name (default 'sonnja_db'): ")
-    user = 'sonnja'  # input('user (default postgres): ')
-    password = input('password: ')
-    # password = getpass.getpass(prompt='password: ',
-    #                           stream=sys.stderr)
-    con = create_engine(
-        'postgresql://' + '%s:%s@%s:%s/%s' % (user,
-                                              password,
-                                              host,
-                                              port,
-                                              database)).connect()
-    print('Password correct! Database connection established.')
+    con = get_engine(url).connect()
+    log.info('Database connection established.')
     return con
 
 
-def query_database(con, schema_name, table_name):
+def _check_identifier(name):
+    """Raise ValueError if name is not a plain SQL identifier."""
+    if not re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', name):
+        raise ValueError(f'Invalid column name: {name}')
+    return name
+
+
+def query_database(con, schema_name, table_name, columns=None, start=None,
+                   end=None, resample=None, chunksize=None, dtype=None):
+    """Read a database table into a DataFrame indexed by timestamp.
+
+    Column selection, time range and aggregation are done by the database,
+    so that only the needed data is transferred.
+
+    Parameters
+    ----------
+    con : connection
+        SQLAlchemy connection object.
+    schema_name : str
+        Name of the schema.
+    table_name : str
+        Name of the table or view.
+    columns : list of str
+        Columns to read besides timestamp. Default: None (all columns).
+    start : str or datetime
+        Read rows with timestamp >= start. Default: None.
+    end : str or datetime
+        Read rows with timestamp < end. Default: None.
+    resample : str
+        Average the columns per 'minute', 'hour', 'day', 'week', 'month',
+        'quarter' or 'year' with date_trunc. The period start is used as
+        timestamp, like pandas resample. Requires `columns`. Default: None.
+    chunksize : int
+        If given, stream the table with a server-side cursor and return an
+        iterator of DataFrames with `chunksize` rows.
+    dtype : type or dict
+        Data types of the columns, see pandas.read_sql_query. Default: None
+        (float64 for aggregated columns).
+
+    Returns
+    -------
+    df : DataFrame or iterator of DataFrames
+    """
+    if resample and resample not in DATE_TRUNC_FIELDS:
+        raise ValueError(f'resample must be one of {DATE_TRUNC_FIELDS}')
+    if columns is None:
+        if resample:
+            raise ValueError('Aggregation with resample requires columns')
+        select = '*'
+    else:
+        columns = [_check_identifier(column) for column in columns]
+        if resample:
+            select = ', '.join([f"date_trunc('{resample}', timestamp) "
+                                f"AS timestamp"] +
+                               [f'avg({column}) AS {column}'
+                                for column in columns])
+            if dtype is None:
+                dtype = dict.fromkeys(columns, 'float64')
+        else:
+            select = ', '.join(['timestamp'] + columns)
+
+    conditions = []
+    params = {}
+    if start is not None:
+        conditions.append('timestamp >= :start')
+        params['start'] = start
+    if end is not None:
+        conditions.append('timestamp < :end')
+        params['end'] = end
+    where = f"WHERE   {' AND '.join(conditions)}" if conditions else ''
+    group_by = 'GROUP BY 1' if resample else ''
+
     sql_query = text(f"""
-            SELECT  *
+            SELECT  {select}
             FROM    {schema_name}.{table_name}
-            """)
-    df = pd.read_sql_query(sql_query, con)
+            {where}
+            {group_by}
+            ORDER BY timestamp
+            """).bindparams(**params)
+
+    if chunksize:
+        print(f'Query database {schema_name}.{table_name} in chunks')
+        return (df.set_index('timestamp') for df in pd.read_sql_query(
+            sql_query, con.execution_options(stream_results=True),
+            chunksize=chunksize, dtype=dtype))
+
+    df = pd.read_sql_query(sql_query, con, dtype=dtype)
     df = df.set_index('timestamp')
     print(f'Query database {schema_name}.{table_name}')
     return df
@@ -115,9 +296,11 @@ def query_database_metadata(con, schema_name, table_name):
     return meta_str
 
 
-def read_from_csv(file_name, sep=';'):
+def read_from_csv(file_name, sep=';', chunksize=None):
+    """Read CSV file into a DataFrame, or an iterator of DataFrames with
+    `chunksize` rows if `chunksize` is given."""
     df = pd.read_csv(file_name, encoding='latin1', sep=sep, index_col=0,
-                     parse_dates=True)  # , skiprows=3)
+                     parse_dates=True, chunksize=chunksize)  # , skiprows=3)
 
     return df
 
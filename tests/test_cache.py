@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+HTW-PV3 - Tests of the run cache keys
+
+A changed module, temperature model, orientation, string layout or inverter
+must change the key of a scenario, an unchanged one must not.
+
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+__copyright__ = "© Ludwig Hülk"
+__license__ = "GNU Affero General Public License Version 3 (AGPL-3.0)"
+__url__ = "https://www.gnu.org/licenses/agpl-3.0.en.html"
+__author__ = "Ludee;"
+__version__ = "v0.0.2"
+
+import pytest
+from pvlib.location import Location
+from pvlib.pvsystem import PVSystem
+
+from pv3_cache import RunCache
+
+MODULE = {'pdc0': 240., 'gamma_pdc': -0.004}
+INVERTER = {'pdc0': 5000., 'eta_inv_nom': 0.96}
+TEMPERATURE_MODEL = {'a': -3.56, 'b': -0.075, 'deltaT': 3}
+OPTIONS = {'aoi_model': 'physical', 'spectral_model': 'no_loss'}
+
+
+def pv_system(surface_tilt=30, module=None, temperature_model=None,
+              modules_per_string=10, strings_per_inverter=2, inverter=None):
+    return PVSystem(surface_tilt=surface_tilt, surface_azimuth=180,
+                    module_parameters=dict(module or MODULE),
+                    temperature_model_parameters=dict(
+                        temperature_model or TEMPERATURE_MODEL),
+                    modules_per_string=modules_per_string,
+                    strings_per_inverter=strings_per_inverter,
+                    inverter_parameters=dict(inverter or INVERTER),
+                    name='test')
+
+
+@pytest.fixture
+def key(tmp_path):
+    cache = RunCache(str(tmp_path), version='test')
+    location = Location(52.45, 13.52, tz='Europe/Berlin', altitude=81)
+    return lambda system: cache.key(system, location, OPTIONS, 'weather')
+
+
+def test_run_cache_key_unchanged(key):
+    assert key(pv_system()) == key(pv_system())
+
+
+@pytest.mark.parametrize('changes', [
+    {'module': dict(MODULE, gamma_pdc=-0.005)},
+    {'temperature_model': dict(TEMPERATURE_MODEL, deltaT=1)},
+    {'surface_tilt': 35},
+    {'modules_per_string': 11},
+    {'strings_per_inverter': 3},
+    {'inverter': dict(INVERTER, pdc0=4000.)}])
+def test_run_cache_key_changed(key, changes):
+    assert key(pv_system(**changes)) != key(pv_system())
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+HTW-PV3 - Tests of the channel store
+
+A store is replaced as a whole, and a store with channels of different
+lengths is rejected on opening.
+
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+__copyright__ = "© Ludwig Hülk"
+__license__ = "GNU Affero General Public License Version 3 (AGPL-3.0)"
+__url__ = "https://www.gnu.org/licenses/agpl-3.0.en.html"
+__author__ = "Ludee;"
+__version__ = "v0.0.2"
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pv3_channelstore import ChannelStore
+
+
+def measurements(rows, channels=('p_ac', 'u_dc')):
+    index = pd.date_range('2015-01-01', periods=rows, freq='min',
+                          tz='Etc/GMT-1', name='timestamp')
+    return pd.DataFrame({channel: np.arange(rows, dtype=np.float64) + i
+                         for i, channel in enumerate(channels)}, index=index)
+
+
+def test_channel_store_write_read(tmp_path):
+    df = measurements(10)
+    store = ChannelStore.write(df, str(tmp_path / 'store'))
+    # the store returns nanosecond timestamps
+    pd.testing.assert_frame_equal(store.read(), df, check_freq=False,
+                                  check_index_type=False)
+    assert store.values('u_dc', '2015-01-01 00:02',
+                        '2015-01-01 00:04').tolist() == [3., 4., 5.]
+
+
+def test_channel_store_rewrite_replaces_store(tmp_path):
+    directory = str(tmp_path / 'store')
+    ChannelStore.write(measurements(10), directory)
+    store = ChannelStore.write(measurements(5, channels=['p_ac']), directory)
+    assert store.channels == ['p_ac']
+    assert len(store) == 5
+    assert sorted(os.listdir(directory)) == ['index.npy', 'meta.json',
+                                             'p_ac.npy']
+    assert sorted(os.listdir(str(tmp_path))) == ['store']
+
+
+def test_channel_store_rejects_mixed_lengths(tmp_path):
+    directory = str(tmp_path / 'store')
+    ChannelStore.write(measurements(10), directory)
+    np.save(os.path.join(directory, 'u_dc.npy'), np.zeros(4))
+    store = ChannelStore(directory)
+    assert len(store.values('p_ac')) == 10
+    with pytest.raises(ValueError, match='has 4 values'):
+        store.values('u_dc')
+    np.save(os.path.join(directory, 'index.npy'),
+            np.zeros(4, dtype='datetime64[ns]'))
+    with pytest.raises(ValueError, match='has 4 timestamps'):
+        ChannelStore(directory)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+HTW-PV3 - Tests of the Reindl decomposition kernel
+
+The kernel of `pv3_decomposition` must give the same bits as the former
+`np.where` implementation of `pv3_pvlib_sonnja.reindl`, which is kept here
+as reference.
+
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+__copyright__ = "© Ludwig Hülk"
+__license__ = "GNU Affero General Public License Version 3 (AGPL-3.0)"
+__url__ = "https://www.gnu.org/licenses/agpl-3.0.en.html"
+__author__ = "Ludee;"
+__version__ = "v0.0.2"
+
+import numpy as np
+import pandas as pd
+import pvlib
+import pytest
+
+import pv3_decomposition
+from pv3_decomposition import reindl
+
+COLUMNS = ['dni', 'dhi', 'kt']
+
+
+def reindl_reference(ghi, i0_h, elevation):
+    """Reindl model with `np.where`, as before the blocked kernel."""
+    elevation = pvlib.tools.sind(elevation)
+    kt = np.maximum(0, ghi / (i0_h * elevation))
+    df = 1.02 - 0.254 * kt + 0.0123 * elevation
+    df = np.where((kt > 0.3) & (kt <= 0.78),
+                  np.fmin(0.97, np.fmax(
+                      0.1, 1.4 - 1.794 * kt + 0.177 * elevation)),
+                  df)
+    df = np.where(kt > 0.78, np.fmax(0.1, 0.486 * kt + 0.182 * elevation), df)
+    df = np.where(((df < 0.9) & (kt < 0.2)) |
+                  ((df > 0.8) & (kt > 0.6)) |
+                  (df > 1) | (ghi - i0_h > 0), 0, df)
+    dhi = df * ghi
+    dni = (ghi - dhi) / elevation
+    return {'dni': np.asarray(dni), 'dhi': np.asarray(dhi),
+            'kt': np.asarray(kt)}
+
+
+def assert_bits_equal(actual, expected):
+    """Same shape and bits, NaN at the same positions."""
+    for column in COLUMNS:
+        a = np.ascontiguousarray(actual[column], dtype=np.float64)
+        b = np.ascontiguousarray(expected[column], dtype=np.float64)
+        assert a.shape == b.shape, column
+        assert np.array_equal(a, b, equal_nan=True), column
+        finite = ~np.isnan(b)
+        assert np.array_equal(a[finite].view(np.int64),
+                              b[finite].view(np.int64)), column
+
+
+@pytest.fixture(scope='module')
+def series():
+    """GHI, I0_h and elevation with NaN, zero elevation and zero I0_h."""
+    rng = np.random.default_rng(1)
+    n = 3 * pv3_decomposition.REINDL_BLOCK_SIZE + 17
+    index = pd.date_range('2015-01-01', periods=n, freq='min')
+    ghi = pd.Series(rng.uniform(-5, 1200, n), index)
+    i0_h = pd.Series(rng.uniform(0, 1400, n), index)
+    elevation = pd.Series(rng.uniform(-10, 60, n), index)
+    ghi.iloc[::97] = np.nan
+    i0_h.iloc[::89] = 0
+    elevation.iloc[::83] = 0
+    # clearness index on the limits of the piecewise diffuse fraction
+    for kt, position in [(0.2, 5), (0.3, 7), (0.6, 11), (0.78, 13)]:
+        ghi.iloc[position] = kt * i0_h.iloc[position] * \
+            pvlib.tools.sind(elevation.iloc[position])
+    return ghi, i0_h, elevation
+
+
+@pytest.mark.parametrize('backend', ['auto', 'numpy'])
+def test_reindl_series_bits_equal(series, backend):
+    with np.errstate(all='ignore'):
+        expected = reindl_reference(*series)
+        result = reindl(*series, backend=backend)
+    assert isinstance(result, pd.DataFrame)
+    assert list(result.columns) == COLUMNS
+    assert result.index.equals(series[0].index)
+    assert_bits_equal(result, expected)
+
+
+def test_reindl_arrays_bits_equal(series):
+    ghi, i0_h, elevation = [values.values for values in series]
+    with np.errstate(all='ignore'):
+        expected = reindl_reference(ghi, i0_h, elevation)
+        result = reindl(ghi, i0_h, elevation, backend='numpy')
+    assert not isinstance(result, pd.DataFrame)
+    assert_bits_equal(result, expected)
+
+
+@pytest.mark.parametrize('backend', ['auto', 'numpy'])
+def test_reindl_sites_bits_equal(backend):
+    rng = np.random.default_rng(2)
+    ghi = rng.uniform(0, 1000, (7, 2000))
+    i0_h = rng.uniform(0, 1400, 2000)
+    elevation = rng.uniform(-5, 60, (7, 2000))
+    ghi[3, ::50] = np.nan
+    elevation[:, ::40] = 0
+    with np.errstate(all='ignore'):
+        expected = reindl_reference(ghi, i0_h[np.newaxis, :], elevation)
+        result = reindl(ghi, i0_h, elevation, backend=backend)
+    assert result['dhi'].shape == (7, 2000)
+    assert_bits_equal(result, expected)
+
+
+def test_reindl_float32(series):
+    with np.errstate(all='ignore'):
+        expected = reindl_reference(*series)
+        result = reindl(*series, dtype=np.float32, backend='numpy')
+    for column in COLUMNS:
+        assert result[column].dtype == np.float32
+    # away from the limits of the diffuse fraction, float32 rounding does
+    # not change the branch of the piecewise model
+    kt = expected['kt']
+    stable = np.isfinite(expected['dni']) & (np.abs(kt - 0.2) > 1e-4) & \
+        (np.abs(kt - 0.3) > 1e-4) & (np.abs(kt - 0.6) > 1e-4) & \
+        (np.abs(kt - 0.78) > 1e-4)
+    np.testing.assert_allclose(result['dhi'].values[stable],
+                               expected['dhi'][stable],
+                               rtol=1e-5, atol=1e-3)
+    np.testing.assert_allclose(result['kt'].values[stable],
+                               expected['kt'][stable], rtol=1e-5, atol=1e-6)
+
+
+def test_reindl_numexpr_bits_equal(series):
+    pytest.importorskip('numexpr')
+    ghi, i0_h, elevation = series
+    with np.errstate(all='ignore'):
+        expected = reindl_reference(ghi, i0_h, elevation)
+        result = reindl(ghi, i0_h, elevation, backend='numexpr')
+        sites = reindl(np.vstack([ghi.values] * 3), i0_h.values,
+                       np.vstack([elevation.values] * 3), backend='numexpr')
+    assert_bits_equal(result, expected)
+    assert_bits_equal({column: sites[column][2] for column in COLUMNS},
+                      expected)
+
+
+def test_reindl_numexpr_missing(monkeypatch, series):
+    monkeypatch.setattr(pv3_decomposition, 'numexpr', None)
+    with pytest.raises(ImportError):
+        reindl(*series, backend='numexpr')
+
+
+@pytest.mark.parametrize('unit', ['s', 'ms', 'us'])
+def test_solar_position_sites_time_unit(unit):
+    times = pd.date_range('2015-06-01', periods=48, freq='30min',
+                          tz='Europe/Berlin')
+    if not hasattr(times, 'as_unit'):
+        pytest.skip('pandas before 2.0 has nanosecond indexes only')
+    latitude, longitude = np.array([52.45, 48.1]), np.array([13.52, 11.6])
+    expected = pv3_decomposition.solar_position_sites(
+        times.as_unit('ns'), latitude, longitude)
+    result = pv3_decomposition.solar_position_sites(
+        times.as_unit(unit), latitude, longitude)
+    for key, values in expected.items():
+        np.testing.assert_array_equal(result[key], values)
+    position = pvlib.solarposition.spa_python(
+        times.as_unit('ns'), latitude[0], longitude[0], delta_t=67.0)
+    np.testing.assert_allclose(result['elevation'][0],
+                               position['elevation'].values, atol=1e-8)
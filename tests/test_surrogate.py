@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+HTW-PV3 - Tests of the surrogate DC model
+
+The interpolated single diode outputs of a diode table must match the exact
+solve on the grid nodes and stay close to it between them.
+
+SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+__copyright__ = "© Ludwig Hülk"
+__license__ = "GNU Affero General Public License Version 3 (AGPL-3.0)"
+__url__ = "https://www.gnu.org/licenses/agpl-3.0.en.html"
+__author__ = "Ludee;"
+__version__ = "v0.0.2"
+
+import numpy as np
+import pytest
+
+from pv3_surrogate import DiodeTable, DIODE_TABLE_COLUMNS, _solve, \
+    cec_module_parameters
+
+# CEC parameters of the Canadian Solar CS5P-220M
+MODULE = {'alpha_sc': 0.004539, 'a_ref': 2.6373, 'I_L_ref': 5.114,
+          'I_o_ref': 8.196e-10, 'R_sh_ref': 381.68, 'R_s': 1.065,
+          'Adjust': 8.7}
+
+
+@pytest.fixture(scope='module')
+def table():
+    return DiodeTable.from_module(MODULE, irradiance=np.arange(0., 1201., 25.),
+                                  temperature=np.arange(-10., 70.1, 2.))
+
+
+def test_diode_table_grid_nodes(table):
+    grid_irradiance, grid_temperature = np.meshgrid(
+        table.irradiance, table.temperature, indexing='ij')
+    exact = _solve(cec_module_parameters(MODULE), grid_irradiance,
+                   grid_temperature)
+    result = table.interpolate(grid_irradiance, grid_temperature)
+    for key in DIODE_TABLE_COLUMNS:
+        assert table.values[key].shape == table.shape
+        np.testing.assert_allclose(result[key], exact[key], rtol=1e-12,
+                                   atol=1e-12)
+
+
+def test_diode_table_interpolate(table):
+    rng = np.random.default_rng(3)
+    effective_irradiance = rng.uniform(0, 1200, (4, 50))
+    cell_temperature = rng.uniform(-10, 70, (4, 50))
+    exact = _solve(cec_module_parameters(MODULE), effective_irradiance,
+                   cell_temperature)
+    result = table.interpolate(effective_irradiance, cell_temperature)
+    p_mp_stc = _solve(cec_module_parameters(MODULE), np.array([1000.]),
+                      np.array([25.]))['p_mp'][0]
+    assert result['p_mp'].shape == (4, 50)
+    error = np.abs(result['p_mp'] - exact['p_mp']).max()
+    assert error <= table.error['p_mp_max_abs'] * 1.5
+    assert error / p_mp_stc < 0.005